@@ -0,0 +1,208 @@
+## Evaluates many (model, data source, output type)-combinations in parallel ##
+# Reproduces qubicc_models_r2_and_mean_values.txt and narval_models_r2_and_mean_values.txt in one command:
+# python evaluate_models.py --jobs paper --workers 8 --output_dir ~/my_work/evaluation
+#
+# 1) Preparation (main process): The model-ready input/output data of every distinct (model_type, data_source,
+#    output_type) is written to an InputCache once. The NARVAL data is loaded at most once for all of them.
+# 2) Evaluation (process pool): Every worker memory-maps the same cached/preprocessed npy-files read-only,
+#    so the data is shared via the page cache instead of being loaded once per worker.
+# 3) Results are written to results.json (incl. timing per job) and results.npz. With --write_txt also in
+#    the format of write_to_file.
+
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import get_context
+
+# Add path with my_classes and input_cache to sys.path
+sys.path.insert(0, '/pf/b/b309170/workspace_icon-ml/cloud_cover_parameterization/')
+# Add path with functions to sys.path (also needed in the worker processes)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from my_classes import load_data, read_mean_and_std
+from input_cache import InputCache
+from data_paths import data_path
+import functions
+
+CACHE_PATH = data_path('my_work/icon-ml_data/cloud_cover_parameterization/input_cache')
+
+def _qubicc_jobs():
+    # Best QUBICC models: Cell-based fold 2, region-based fold 3, column-based fold 2
+    # The cloud area models use the same scaling as the cloud cover models of the same fold
+    best_models = [('Cell-based', 'grid_cell_based_QUBICC_R02B05', 'cross_validation_cell_based_fold_2'),
+                   ('Region-based', 'region_based_one_nn_R02B05', 'cross_validation_region_based_fold_3'),
+                   ('Column-based', 'grid_column_based_QUBICC_R02B05', 'cross_validation_column_based_fold_2')]
+    jobs = []
+    for output_type in ['cloud_cover', 'cloud_area']:
+        for data_source in ['qubicc', 'narval']:
+            for (model_type_short, model_type, model) in best_models:
+                jobs.append({'name': '%s_%s_%s_%s'%(model_type, model[-6:], output_type, data_source),
+                             'model_type': model_type, 'model': model + '.h5', 'data_source': data_source,
+                             'output_type': output_type, 'model_type_short': model_type_short,
+                             'model_training_source': 'qubicc',
+                             'scaling_file': os.path.join(os.path.dirname(functions.get_model_path(model_type, model)),
+                                                          model + '.txt')})
+    return jobs
+
+def _narval_jobs():
+    # NARVAL R2B4 models on NARVAL R2B5 data
+    jobs = []
+    for (model_type_short, model_type, model) in [('Cell-based', 'grid_cell_based_v3', 'model_grid_cell_based_v3_final_1'),
+                                                  ('Column-based', 'grid_column_based', 'model_grid_column_based_final_1')]:
+        jobs.append({'name': '%s_cloud_cover_narval'%model_type, 'model_type': model_type, 'model': model + '.h5',
+                     'data_source': 'narval', 'output_type': 'cloud_cover', 'model_type_short': model_type_short,
+                     'model_training_source': 'narval',
+                     'scaling_file': functions.get_model_path(model_type, model + '.txt')})
+    # The region-based model consists of one NN per layer with its own scaling (see run_job)
+    jobs.append({'name': 'region_based_cloud_cover_narval', 'model_type': 'region_based',
+                 'model': 'model_clc_all_days_final_1', 'data_source': 'narval', 'output_type': 'cloud_cover',
+                 'model_type_short': 'Region-based', 'model_training_source': 'narval'})
+    return jobs
+
+def get_jobs(which):
+    '''
+        which: 'paper' (all tables), 'qubicc' (qubicc_models_r2_and_mean_values.txt),
+               'narval' (narval_models_r2_and_mean_values.txt) or a path to a json-file with a list of jobs
+
+        A job is a dictionary with the keys name, model_type, model, data_source, output_type and either
+        scaling_file (a txt-file for read_mean_and_std) or model_mean and model_std (neither for the region-based
+        model_type 'region_based', whose NNs have one scaling per layer).
+    '''
+    if which == 'qubicc':
+        return _qubicc_jobs()
+    elif which == 'narval':
+        return _narval_jobs()
+    elif which == 'paper':
+        return _qubicc_jobs() + _narval_jobs()
+    with open(which) as file:
+        return json.load(file)
+
+def prepare_inputs(jobs, cache):
+    '''
+        Writes the model-ready data of all jobs into the cache (if not already there).
+        The NARVAL data is only loaded if one of the NARVAL jobs is not yet in the cache.
+    '''
+    narval_data = {}
+    def get_narval_data():
+        if 'data' not in narval_data:
+            narval_data['data'] = load_data(source='narval', days='all', vert_interp=True, resolution='R02B05',
+                                            order_of_vars=functions.NARVAL_LOAD_VARS)
+        return narval_data['data']
+
+    timing = {}
+    for job in jobs:
+        key = (job['model_type'], job['data_source'], job['output_type'])
+        if key in timing or job['model_type'] == 'region_based':
+            # The region-based NARVAL model reads its data itself
+            continue
+        t0 = time.time()
+        functions.get_input_and_output(job['model_type'], job['data_source'], job['output_type'],
+                                       narval_data=get_narval_data, cache=cache)
+        timing[key] = time.time() - t0
+        print('Prepared %s, %s, %s in %.1fs'%(key + (timing[key],)), flush=True)
+    return timing
+
+def _init_worker(threads_per_worker):
+    # Otherwise every worker would use all cores
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(threads_per_worker)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+
+def run_job(job, cache_path):
+    '''
+        Evaluates one job. Returns a dictionary with the results and the timing.
+    '''
+    t0 = time.time()
+    c0 = time.process_time()
+    if job['model_type'] == 'region_based':
+        data_means, pred_means, r2_profile = functions.get_R2_and_means_region_based_narval()
+    else:
+        if 'scaling_file' in job:
+            model_mean, model_std = read_mean_and_std(job['scaling_file'])
+        else:
+            model_mean, model_std = np.array(job['model_mean']), np.array(job['model_std'])
+        data_means, pred_means, r2_profile = functions.get_R2_and_means(job['model_type'], job['model'], model_mean,
+                                                                        model_std, job['data_source'],
+                                                                        job['output_type'], cache=InputCache(cache_path))
+    result = dict(job)
+    result.pop('model_mean', None)
+    result.pop('model_std', None)
+    result['data_means'] = [float(x) for x in data_means]
+    result['pred_means'] = [float(x) for x in pred_means]
+    result['r2_profile'] = [float(x) for x in r2_profile]
+    result['timing'] = {'wall_s': time.time() - t0, 'cpu_s': time.process_time() - c0, 'pid': os.getpid(),
+                        'started': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(t0))}
+    return result
+
+def evaluate(jobs, output_dir, workers=None, threads_per_worker=1, cache_path=CACHE_PATH):
+    '''
+        Runs all jobs in a pool of worker processes and saves results.json and results.npz in output_dir.
+
+        workers: Number of worker processes (by default the number of cores divided by threads_per_worker)
+    '''
+    if workers is None:
+        workers = max(1, (os.cpu_count() or 1)//threads_per_worker)
+    os.makedirs(output_dir, exist_ok=True)
+    cache = InputCache(cache_path)
+
+    t0 = time.time()
+    prepare_timing = prepare_inputs(jobs, cache)
+
+    # Spawn instead of fork: TensorFlow is not fork-safe
+    results = []
+    with ProcessPoolExecutor(max_workers=workers, mp_context=get_context('spawn'), initializer=_init_worker,
+                             initargs=(threads_per_worker,)) as executor:
+        futures = {executor.submit(run_job, job, cache_path): job['name'] for job in jobs}
+        for future in as_completed(futures):
+            result = future.result()
+            print('%s: %.1fs'%(result['name'], result['timing']['wall_s']), flush=True)
+            results.append(result)
+    # Keep the order of the jobs
+    order = [job['name'] for job in jobs]
+    results.sort(key=lambda result: order.index(result['name']))
+
+    summary = {'workers': workers, 'threads_per_worker': threads_per_worker, 'total_wall_s': time.time() - t0,
+               'prepare_wall_s': {'%s/%s/%s'%key: t for key, t in prepare_timing.items()}, 'jobs': results}
+    with open(os.path.join(output_dir, 'results.json'), 'w') as file:
+        json.dump(summary, file, indent=1)
+    arrays = {}
+    for result in results:
+        for key in ['data_means', 'pred_means', 'r2_profile']:
+            arrays['%s/%s'%(result['name'], key)] = np.array(result[key])
+    np.savez(os.path.join(output_dir, 'results.npz'), **arrays)
+    return summary
+
+def write_txt(results, output_dir):
+    '''
+        Writes the results into [qubicc/narval]_models_r2_and_mean_values.txt in the format of functions.write_to_file
+    '''
+    for result in results:
+        file_name = '%s_models_r2_and_mean_values.txt'%result.get('model_training_source', 'qubicc')
+        with open(os.path.join(output_dir, file_name), 'a') as file:
+            file.write('%s model, %s, %s data: \n'%(result.get('model_type_short', result['model_type']),
+                                                    result['output_type'], result['data_source'].upper()))
+            file.write('Data averages: \n')
+            file.write(str(result['data_means']) + '\n')
+            file.write('Prediction averages: \n')
+            file.write(str(result['pred_means']) + '\n')
+            file.write('R2 profile: \n')
+            file.write(str(result['r2_profile']) + '\n\n')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Evaluate models in parallel')
+    parser.add_argument('--jobs', default='paper', help="'paper', 'qubicc', 'narval' or a json-file with jobs")
+    parser.add_argument('--output_dir', required=True)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--threads_per_worker', type=int, default=1)
+    parser.add_argument('--cache_path', default=CACHE_PATH)
+    parser.add_argument('--write_txt', action='store_true')
+    args = parser.parse_args()
+
+    summary = evaluate(get_jobs(args.jobs), args.output_dir, args.workers, args.threads_per_worker, args.cache_path)
+    if args.write_txt:
+        write_txt(summary['jobs'], args.output_dir)
+    print('Total: %.1fs'%summary['total_wall_s'])
@@ -4,20 +4,25 @@ import os
 import gc
 import sys
 import numpy as np
-import pandas as pd
-import matplotlib.pyplot as plt
 
 # Add path with my_classes to sys.path
 sys.path.insert(0, '/pf/b/b309170/workspace_icon-ml/cloud_cover_parameterization/')
 
-from my_classes import load_data
+from iconml.io import load_data, get_data_files
+from iconml.features import above_and_below
+from iconml.metrics import compute_R2_and_means
+from input_cache import files_fingerprint
+from data_paths import data_path
+from telemetry import profiled
 
-from tensorflow.keras import backend as K
-from tensorflow import nn 
-from tensorflow.keras.models import load_model
+# TensorFlow is imported in the functions that need it (predict, get_R2_and_means)
 
 ORDER_OF_VARS_NARVAL = ['qv', 'qc', 'qi', 'temp', 'pres', 'u', 'v', 'zg', 'coriolis', 'fr_land', 'clc', 'cl_area']
 (TIME_STEPS, VERT_LAYERS, HORIZ_FIELDS) = (1721, 31, 4450) # For Narval data
+# All NARVAL variables any of the models needs
+NARVAL_LOAD_VARS = ['qv', 'qc', 'qi', 'temp', 'pres', 'rho', 'u', 'v', 'zg', 'coriolis', 'fr_land', 'fr_lake', 'clc', 'cl_area']
+# Increase whenever the cached input/output data would change
+CACHE_VERSION = 1
 
 path = '/pf/b/b309170/workspace_icon-ml/cloud_cover_parameterization'
 
@@ -25,29 +30,167 @@ path = '/pf/b/b309170/workspace_icon-ml/cloud_cover_parameterization'
 
 # To load the data
 def get_data_path(model_type):
-    return '/pf/b/b309170/my_work/icon-ml_data/cloud_cover_parameterization/%s/based_on_var_interpolated_data'%model_type
+    return data_path('my_work/icon-ml_data/cloud_cover_parameterization/%s/based_on_var_interpolated_data'%model_type)
+
+# To load the models
+def get_model_path(model_type, model, output_type='cloud_cover'):
+    if model_type in ['grid_cell_based_QUBICC_R02B05', 'region_based_one_nn_R02B05', 'region_based_one_nn_with_rh_R02B05', 'grid_column_based_QUBICC_R02B05']:
+        return os.path.join(path, '%s/saved_models/%s_R2B5_QUBICC/%s'%(model_type, output_type, model))
+    else:
+        return os.path.join(path, '%s/saved_models/%s'%(model_type, model))
 
 # For NARVAL, region-based model
 def add_above_and_below(var_array, key):
     '''
         var_array: 3D tensor
     '''
-    if key == 'pres':
-        factor = 3/4
+    # It is a bit suboptimal that the grid cells above can be nan in NARVAL. At least decrease pressure by 3/4.
+    return above_and_below(var_array, 3/4 if key == 'pres' else 1)
+
+# For NARVAL, the input features of every model type (in the order the models expect them)
+def get_narval_features(model_type):
+    '''
+        Returns the names of the input features of model_type when evaluated on NARVAL data.
+        The order is the same as the one the models were trained with.
+        
+        Cell-/region-based models: 'var', 'var_below', 'var_above', 'temp_sfc' or 'rh' (relative humidity)
+        Column-based models: 'var_k' with k in 21, ..., 47 denoting the vertical layer, 2D variables without suffix
+    '''
+    if model_type == 'grid_cell_based_QUBICC_R02B05':
+        return ['qv', 'qc', 'qi', 'temp', 'pres', 'u', 'v', 'zg', 'coriolis', 'fr_land']
+    elif model_type == 'grid_cell_based_v3':
+        return ['qv', 'qi', 'temp', 'pres', 'zg', 'fr_land']
+    elif model_type == 'region_based_one_nn_R02B05':
+        features = ORDER_OF_VARS_NARVAL[:-3]
+        for key in ORDER_OF_VARS_NARVAL[:-4]:
+            features = features + ['%s_below'%key, '%s_above'%key]
+        return features + ['temp_sfc']
+    elif model_type == 'region_based_one_nn_with_rh_R02B05':
+        features = ['qc', 'qi', 'temp', 'rh']
+        for key in ['qc', 'qi', 'temp', 'rh']:
+            features = features + ['%s_below'%key, '%s_above'%key]
+        return features
+    elif model_type in ['grid_column_based_QUBICC_R02B05', 'grid_column_based']:
+        if model_type == 'grid_column_based_QUBICC_R02B05':
+            vars_3d = ['qv', 'qc', 'qi', 'temp', 'pres', 'zg']
+            vars_2d = ['fr_land']
+            # Remove features that were constant
+            remove_fields = [27, 28, 29, 30, 31, 32, 135, 136, 137]
+        else:
+            vars_3d = ['qv', 'qc', 'qi', 'temp', 'pres', 'rho', 'zg']
+            vars_2d = ['fr_lake']
+            remove_fields = [27, 162, 163, 164]
+        # Removing data above 21kms
+        features = ['{}{}{:d}'.format(key,'_',(i+17)) for key in vars_3d for i in range(4, VERT_LAYERS)] + vars_2d
+        return list(np.delete(features, remove_fields))
+    else:
+        raise ValueError('Unknown model type: %s'%model_type)
+
+def _narval_values(narval_data, name, ind, t0, t1):
+    '''
+        Values of the feature name for the time steps t0:t1 at the flattened (vertical layer, cell) indices ind.
+        Returns a (t1-t0, len(ind))-array (possibly a broadcasted view).
+    '''
+    vert_layers, horiz_fields = narval_data['zg'].shape
+    if name.endswith('_above') or name.endswith('_below'):
+        return _narval_above_or_below(narval_data, name, ind, t0, t1)
+    elif name == 'rh':
+        # Specific humidity to Relative humidity
+        T0 = 273.15
+        pres = _narval_values(narval_data, 'pres', ind, t0, t1)
+        qv = _narval_values(narval_data, 'qv', ind, t0, t1)
+        temp = _narval_values(narval_data, 'temp', ind, t0, t1)
+        return 0.00263*pres*qv*np.exp((17.67*(temp-T0))/(temp-29.65))**(-1)
+    elif name == 'temp_sfc':
+        return _narval_values(narval_data, 'temp', (vert_layers-1)*horiz_fields + ind%horiz_fields, t0, t1)
+    elif name == 'zg':
+        return np.broadcast_to(np.reshape(narval_data['zg'], -1)[ind], (t1-t0, len(ind)))
+    elif narval_data[name].ndim == 1:
+        # coriolis, fr_land, fr_lake
+        return np.broadcast_to(narval_data[name][ind%horiz_fields], (t1-t0, len(ind)))
     else:
-        factor = 1
-    above = (np.insert(var_array, obj=0, values=1000*np.ones((TIME_STEPS, HORIZ_FIELDS)), axis=1))[:, :-1, :]
+        return np.reshape(narval_data[name][t0:t1], (t1-t0, -1))[:, ind]
+
+def _narval_above_or_below(narval_data, name, ind, t0, t1):
+    '''
+        The same as add_above_and_below, but only for the indices ind.
+    '''
+    vert_layers, horiz_fields = narval_data['zg'].shape
+    key = name[:-6]
+    layer = ind//horiz_fields
+    if name.endswith('_below'):
+        # Below is the same value as the grid cell for surface-closest layer
+        return _narval_values(narval_data, key, np.where(layer < vert_layers - 1, ind + horiz_fields, ind), t0, t1)
+    factor = 3/4 if key == 'pres' else 1
+    # The uppermost layer gets 1000 as its value above
+    above = np.array(_narval_values(narval_data, key, np.where(layer > 0, ind - horiz_fields, ind), t0, t1))
+    above[:, layer == 0] = 1000
     # Replace by the entry from the same cell if the one above is nan.
-    # It is a bit suboptimal that the grid cells above can be nan in NARVAL. At least decrease pressure by 3/4.
     nan_indices = np.where(np.isnan(above))
-    above[nan_indices] = factor*above[nan_indices[0], nan_indices[1]+1, nan_indices[2]]
+    if len(nan_indices[0]) > 0:
+        same_cell = _narval_values(narval_data, key, ind, t0, t1)
+        above[nan_indices] = factor*same_cell[nan_indices]
+    return above
+
+@profiled('build_narval_input_and_output', samples=lambda result: len(result[0]))
+def build_narval_input_and_output(model_type, narval_data, output_type='cloud_cover', time_chunk=36):
+    '''
+        Writes the NARVAL input features of model_type directly into one preallocated float32 array.
+        Yields the same input_data and output_data as the former pd.DataFrame-based approach, 
+        without copying the entire dataset several times. narval_data is not modified.
+        
+        narval_data: Dictionary from load_data. 3D variables have the shape (TIME_STEPS, VERT_LAYERS, HORIZ_FIELDS).
+        output_type: 'cloud_cover' or 'cloud_area'
+        time_chunk:  Number of time steps that are processed at once
+        
+        Returns: input_data, output_data
+    '''
+    if output_type == 'cloud_cover':
+        output_var = 'clc'
+    elif output_type == 'cloud_area':
+        output_var = 'cl_area'
+        if model_type == 'region_based_one_nn_with_rh_R02B05':
+            raise Exception("Cloud area. Be careful here.") 
+        
+    features = get_narval_features(model_type)
+    (time_steps, vert_layers, horiz_fields) = narval_data[output_var].shape
     
-    # Below is the same value as the grid cell for surface-closest layer
-    below = (np.append(var_array, values=var_array[:, -1:, :], axis=1))[:, 1:, :]
-    return above, below
+    if model_type in ['grid_column_based_QUBICC_R02B05', 'grid_column_based']:
+        # One sample per column (and time step). Layers 4, ..., 30 correspond to 21, ..., 47.
+        input_data = np.empty((time_steps*horiz_fields, len(features)), dtype=np.float32)
+        output_data = np.empty((time_steps*horiz_fields, vert_layers - 4), dtype=np.float32)
+        cells = np.arange(horiz_fields)
+        for t0 in range(0, time_steps, time_chunk):
+            t1 = min(t0 + time_chunk, time_steps)
+            rows = slice(t0*horiz_fields, t1*horiz_fields)
+            for j, feature in enumerate(features):
+                if feature in narval_data:
+                    # 2D variables
+                    ind = cells
+                else:
+                    key, layer = feature.rsplit('_', 1)
+                    feature, ind = key, (int(layer) - 17)*horiz_fields + cells
+                input_data[rows, j] = np.reshape(_narval_values(narval_data, feature, ind, t0, t1), -1)
+            for i in range(4, vert_layers):
+                output_data[rows, i-4] = np.reshape(narval_data[output_var][t0:t1, i, :], -1)
+    else:
+        # One sample per grid cell. Removing data above 21kms with a precomputed index.
+        keep = np.flatnonzero(np.reshape(narval_data['zg'], -1) < 21000)
+        input_data = np.empty((time_steps*len(keep), len(features)), dtype=np.float32)
+        output_data = np.empty(time_steps*len(keep), dtype=np.float32)
+        for t0 in range(0, time_steps, time_chunk):
+            t1 = min(t0 + time_chunk, time_steps)
+            rows = slice(t0*len(keep), t1*len(keep))
+            for j, feature in enumerate(features):
+                input_data[rows, j] = np.reshape(_narval_values(narval_data, feature, keep, t0, t1), -1)
+            output_data[rows] = np.reshape(_narval_values(narval_data, output_var, keep, t0, t1), -1)
+            
+    return input_data, output_data
 
 # To make predictions
+@profiled('predict', samples=len)
 def predict(model, input_data, mean, std, batch_size=2**20):
+    from tensorflow.keras import backend as K
     # Put mean and std inside the function so that we don't have to load the entire input_data at once
     for i in range(1 + input_data.shape[0]//batch_size):
         if i == 0:
@@ -61,54 +204,133 @@ def predict(model, input_data, mean, std, batch_size=2**20):
     pred_adj = np.minimum(np.maximum(a, 0), 100) 
     return pred_adj
 
-# To compute R2 and mean profiles
-def compute_R2_and_means(pred_output, output_data, vertical_layers):
+# For QUBICC, the input/output data of every model type
+@profiled('build_qubicc_input_and_output', samples=lambda result: len(result[0]))
+def build_qubicc_input_and_output(model_type, output_type='cloud_cover'):
+    '''
+        Reads the preprocessed QUBICC data and adjusts it to the input features of model_type.
+        
+        Returns: input_data, output_data, vertical_layers
+    '''
+    if model_type=='region_based_one_nn_with_rh_R02B05':
+        # We use the region_based_one_nn_R02B05 data path, but need to adjust some input features
+        input_path = get_data_path('region_based_one_nn_R02B05')
+    else:
+        input_path = get_data_path(model_type)
+    input_data = np.load(os.path.join(input_path, 'cloud_cover_input_qubicc.npy'), mmap_mode='r')
+    output_data = np.load(os.path.join(input_path, '%s_output_qubicc.npy'%output_type), mmap_mode='r')
+    # We need to transpose the column-based data. It should have (no_samples, no_features).
+    if input_data.shape[0] < input_data.shape[1]:
+        input_data = np.transpose(input_data)
+        output_data = np.transpose(output_data)
+    # There is no vertical_layers file in the case of the column-based model
+    if model_type=='grid_cell_based_QUBICC_R02B05' or model_type=='region_based_one_nn_R02B05':
+        vertical_layers = np.load(os.path.join(input_path, 'samples_vertical_layers_qubicc.npy'), 
+                                  mmap_mode='r')
+    elif model_type=='grid_column_based_QUBICC_R02B05':
+        vertical_layers = None 
+        # We need to remove some input features for the column-based model
+        remove_fields = [27, 28, 29, 30, 31, 32, 135, 136, 137]
+        input_data = np.delete(input_data, remove_fields, axis=1)
+    elif model_type=='region_based_one_nn_with_rh_R02B05':
+        vertical_layers = np.load(os.path.join(input_path, 'samples_vertical_layers_qubicc.npy'), 
+                                  mmap_mode='r')
+        # Taken from preprocessing_narval
+        input_variables = np.array(['qv', 'qc', 'qi', 'temp', 'pres', 'u', 'v', 'zg', 'coriolis', 'qv_below', 'qv_above',
+                                   'qc_below', 'qc_above', 'qi_below', 'qi_above', 'temp_below', 'temp_above',
+                                   'pres_below', 'pres_above', 'u_below', 'u_above', 'v_below', 'v_above', 
+                                   'zg_below', 'zg_above','temp_sfc'])
+
+        # We only need a subset of these input variables here: qi, qc, T, RH(p,qv,T)
+        indices = [0,1,2,3,4,9,10,11,12,13,14,15,16,17,18]
+
+        input_variables = input_variables[indices]
+        input_data = input_data[:, indices]
+
+        # Specific humidity to Relative humidity
+        T0 = 273.15
+        pres_ind = np.where(input_variables == 'pres')[0][0]
+        temp_ind = np.where(input_variables == 'temp')[0][0]
+        qv_ind = np.where(input_variables == 'qv')[0][0]
+
+        pres_below_ind = np.where(input_variables == 'pres_below')[0][0]
+        pres_above_ind = np.where(input_variables == 'pres_above')[0][0]
+        temp_below_ind = np.where(input_variables == 'temp_below')[0][0]
+        temp_above_ind = np.where(input_variables == 'temp_above')[0][0]
+        qv_below_ind = np.where(input_variables == 'qv_below')[0][0]
+        qv_above_ind = np.where(input_variables == 'qv_above')[0][0]
+
+        r = 0.00263*input_data[:, pres_ind]*input_data[:, qv_ind]*np.exp((17.67*(input_data[:, temp_ind]-T0))/(input_data[:, temp_ind]-29.65))**(-1)
+        r_below = 0.00263*input_data[:, pres_below_ind]*input_data[:, qv_below_ind]*np.exp((17.67*(input_data[:, temp_below_ind]-T0))/(input_data[:, temp_below_ind]-29.65))**(-1)
+        r_above = 0.00263*input_data[:, pres_above_ind]*input_data[:, qv_above_ind]*np.exp((17.67*(input_data[:, temp_above_ind]-T0))/(input_data[:, temp_above_ind]-29.65))**(-1)
+
+        # Now we can remove qv and pres as well
+        input_variables = np.array(['qc', 'qi', 'temp', 'r', 'qc_below', 'qc_above', 'qi_below', 'qi_above', 'temp_below', 'temp_above', 'r_below', 'r_above'])
+        in_and_out_variables = np.array(['qc', 'qi', 'temp', 'r', 'qc_below', 'qc_above', 'qi_below', 'qi_above', 'temp_below', 'temp_above', 'r_below', 'r_above', 'clc'])
+
+        # Remove qv and pres from input_data as well, add relative humidity
+        input_data = np.concatenate((input_data[:, 1:4], np.expand_dims(r, 1), input_data[:, 7:13], np.expand_dims(r_below, 1), np.expand_dims(r_above, 1)), axis=1)
+            
+    return input_data, output_data, vertical_layers
+
+# Either read the model-ready data from the cache or build it
+def get_input_and_output(model_type, data_source, output_type='cloud_cover', narval_data=None, cache=None, 
+                         days='all', resolution='R02B05'):
     '''
-        Returns data_means, pred_means, r2
+        Returns the model-ready input_data, output_data and vertical_layers of model_type for the data_source.
+        
+        narval_data: Dictionary from load_data or a function returning it (then it is only called if we 
+                     actually need to build the data). Only used for NARVAL data.
+        cache:       An input_cache.InputCache. If provided, the data is read from (or written to) the cache.
+                     In case of a cache hit neither load_data nor any preprocessing is necessary.
+        days, resolution: Only relevant for the NARVAL data when the cache is used. They are part of the cache key,
+                     so they have to describe narval_data (the days and resolution it was loaded with).
     '''
-    data_means = []
-    pred_means = []
-    r2 = []
+    # Only the QUBICC column-based and region-based (with RH) data are modified before the evaluation
+    if data_source == 'qubicc' and (cache is None or model_type not in 
+                                    ['grid_column_based_QUBICC_R02B05', 'region_based_one_nn_with_rh_R02B05']):
+        return build_qubicc_input_and_output(model_type, output_type)
+    elif data_source == 'narval' and cache is None:
+        if callable(narval_data):
+            narval_data = narval_data()
+        input_data, output_data = build_narval_input_and_output(model_type, narval_data, output_type)
+        return input_data, output_data, None
     
-    if output_data.shape[-1] == 27:
-        # For the column-based model
-        # Means
-        pred_means = np.mean(pred_output, axis=0, dtype=np.float64)
-        data_means = np.mean(output_data, axis=0, dtype=np.float64)
-        # R2
-        mse = np.mean((pred_output - output_data)**2, axis=0, dtype=np.float64)
-        var = np.var(output_data, axis=0)
-        r2 = 1-mse/var
+    # Identity of the files the cached arrays are based on
+    if data_source == 'narval':
+        file_patterns = list(get_data_files('narval', days, True, resolution, NARVAL_LOAD_VARS).values())
     else:
-        if vertical_layers is None:
-            # For the NARVAL cell-based and region-based models
-            vertical_layers = np.arange(5, 32)
-            vertical_layers = np.repeat(np.expand_dims(vertical_layers, 0), TIME_STEPS, axis=0)
-            vertical_layers = np.repeat(np.expand_dims(vertical_layers, 2), HORIZ_FIELDS, axis=2)
-            vertical_layers = np.reshape(vertical_layers, -1)
-        for i in range(5, 32):
-            indices = np.where(vertical_layers == i)
-            # Means
-            pred_means.append(np.mean(pred_output[indices], dtype=np.float64))
-            data_means.append(np.mean(output_data[indices], dtype=np.float64))
-            # R2
-            mse = np.mean((pred_output[indices] - output_data[indices])**2, dtype=np.float64)
-            var = np.var(output_data[indices])
-            try:
-                r2.append(1-mse/var)
-            except ZeroDivisionError:
-                print('Caught a division by 0 error')
-                r2.append(-10**5)
-    return data_means, pred_means, r2
+        input_path = get_data_path('region_based_one_nn_R02B05' if model_type == 'region_based_one_nn_with_rh_R02B05' 
+                                   else model_type)
+        file_patterns = [os.path.join(input_path, '*_qubicc.npy')]
+        
+    def build():
+        if data_source == 'narval':
+            data = narval_data() if callable(narval_data) else narval_data
+            if data is None:
+                data = load_data(source='narval', days=days, vert_interp=True, resolution=resolution, 
+                                 order_of_vars=NARVAL_LOAD_VARS)
+            input_data, output_data = build_narval_input_and_output(model_type, data, output_type)
+            return {'input_data': input_data, 'output_data': output_data}
+        input_data, output_data, vertical_layers = build_qubicc_input_and_output(model_type, output_type)
+        return {'input_data': input_data, 'output_data': output_data, 'vertical_layers': vertical_layers}
+        
+    arrays = cache.get_or_build(build, source=data_source, resolution=resolution, days=days, model_type=model_type,
+                                output_type=output_type, files=files_fingerprint(file_patterns), 
+                                version=CACHE_VERSION)
+    return arrays['input_data'], arrays['output_data'], arrays.get('vertical_layers')
 
 # Get R2 and means for a given model
 # We also have to provide the mean and std corresponding to the model
 # Basically a wrapper for compute_R2_and_means
 def get_R2_and_means(model_type, model, model_mean, model_std, data_source, 
-                     output_type='cloud_cover', narval_data=None):
+                     output_type='cloud_cover', narval_data=None, cache=None, days='all', resolution='R02B05'):
     '''
         data_source: 'narval' or 'qubicc'
         output_type: 'cloud_cover' or 'cloud_area'
+        narval_data: Dictionary from load_data (for NARVAL data). Is not modified. Not needed if cache is provided.
+        cache: An input_cache.InputCache to reuse the model-ready data of previous evaluations
+        days, resolution: Of narval_data (part of the cache key, see get_input_and_output)
         model_type: 'grid_cell_based_QUBICC_R02B05', 'region_based_one_nn_R02B05', 
                     'grid_column_based_QUBICC_R02B05', 'region_based_one_nn_with_rh_R02B05' (QUBICC models)
                     'grid_cell_based_v3' 'grid_column_based' (NARVAL models)
@@ -123,208 +345,22 @@ def get_R2_and_means(model_type, model, model_mean, model_std, data_source,
     else:
         model_training_source='narval'
     
+    from tensorflow import nn
+    from tensorflow.keras.models import load_model
+
     # To load the model
     custom_objects = {}
     custom_objects['leaky_relu'] = nn.leaky_relu
 
     # Load model
     if model_training_source=='qubicc':
-        clc_model_path = '%s/saved_models/%s_R2B5_QUBICC/%s'%(model_type, output_type, model)
-        clc_model = load_model(os.path.join(path, clc_model_path), custom_objects)
+        clc_model = load_model(get_model_path(model_type, model, output_type), custom_objects)
     else:
-        clc_model_path = '%s/saved_models/%s'%(model_type, model)
-        clc_model = load_model(os.path.join(path, clc_model_path))
-
-    # Load QUBICC data
-    if data_source == 'qubicc':
-        # Yields input_data, output_data and vertical_layers
-        if model_type=='region_based_one_nn_with_rh_R02B05':
-            # We use the region_based_one_nn_R02B05 data path, but need to adjust some input features
-            data_path = get_data_path('region_based_one_nn_R02B05')
-        else:
-            data_path = get_data_path(model_type)
-        input_data = np.load(os.path.join(data_path, 'cloud_cover_input_qubicc.npy'), mmap_mode='r')
-        output_data = np.load(os.path.join(data_path, '%s_output_qubicc.npy'%output_type), mmap_mode='r')
-        # We need to transpose the column-based data. It should have (no_samples, no_features).
-        if input_data.shape[0] < input_data.shape[1]:
-            input_data = np.transpose(input_data)
-            output_data = np.transpose(output_data)
-        # There is no vertical_layers file in the case of the column-based model
-        if model_type=='grid_cell_based_QUBICC_R02B05' or model_type=='region_based_one_nn_R02B05':
-            vertical_layers = np.load(os.path.join(data_path, 'samples_vertical_layers_qubicc.npy'), 
-                                      mmap_mode='r')
-        elif model_type=='grid_column_based_QUBICC_R02B05':
-            vertical_layers = None 
-            # We need to remove some input features for the column-based model
-            remove_fields = [27, 28, 29, 30, 31, 32, 135, 136, 137]
-            input_data = np.delete(input_data, remove_fields, axis=1)
-        elif model_type=='region_based_one_nn_with_rh_R02B05':
-            vertical_layers = np.load(os.path.join(data_path, 'samples_vertical_layers_qubicc.npy'), 
-                                      mmap_mode='r')
-            # Taken from preprocessing_narval
-            input_variables = np.array(['qv', 'qc', 'qi', 'temp', 'pres', 'u', 'v', 'zg', 'coriolis', 'qv_below', 'qv_above',
-                                       'qc_below', 'qc_above', 'qi_below', 'qi_above', 'temp_below', 'temp_above',
-                                       'pres_below', 'pres_above', 'u_below', 'u_above', 'v_below', 'v_above', 
-                                       'zg_below', 'zg_above','temp_sfc'])
-
-            # We only need a subset of these input variables here: qi, qc, T, RH(p,qv,T)
-            indices = [0,1,2,3,4,9,10,11,12,13,14,15,16,17,18]
-
-            input_variables = input_variables[indices]
-            input_data = input_data[:, indices]
-
-            # Specific humidity to Relative humidity
-            T0 = 273.15
-            pres_ind = np.where(input_variables == 'pres')[0][0]
-            temp_ind = np.where(input_variables == 'temp')[0][0]
-            qv_ind = np.where(input_variables == 'qv')[0][0]
-
-            pres_below_ind = np.where(input_variables == 'pres_below')[0][0]
-            pres_above_ind = np.where(input_variables == 'pres_above')[0][0]
-            temp_below_ind = np.where(input_variables == 'temp_below')[0][0]
-            temp_above_ind = np.where(input_variables == 'temp_above')[0][0]
-            qv_below_ind = np.where(input_variables == 'qv_below')[0][0]
-            qv_above_ind = np.where(input_variables == 'qv_above')[0][0]
-
-            r = 0.00263*input_data[:, pres_ind]*input_data[:, qv_ind]*np.exp((17.67*(input_data[:, temp_ind]-T0))/(input_data[:, temp_ind]-29.65))**(-1)
-            r_below = 0.00263*input_data[:, pres_below_ind]*input_data[:, qv_below_ind]*np.exp((17.67*(input_data[:, temp_below_ind]-T0))/(input_data[:, temp_below_ind]-29.65))**(-1)
-            r_above = 0.00263*input_data[:, pres_above_ind]*input_data[:, qv_above_ind]*np.exp((17.67*(input_data[:, temp_above_ind]-T0))/(input_data[:, temp_above_ind]-29.65))**(-1)
-
-            # Now we can remove qv and pres as well
-            input_variables = np.array(['qc', 'qi', 'temp', 'r', 'qc_below', 'qc_above', 'qi_below', 'qi_above', 'temp_below', 'temp_above', 'r_below', 'r_above'])
-            in_and_out_variables = np.array(['qc', 'qi', 'temp', 'r', 'qc_below', 'qc_above', 'qi_below', 'qi_above', 'temp_below', 'temp_above', 'r_below', 'r_above', 'clc'])
-
-            # Remove qv and pres from input_data as well, add relative humidity
-            input_data = np.concatenate((input_data[:, 1:4], np.expand_dims(r, 1), input_data[:, 7:13], np.expand_dims(r_below, 1), np.expand_dims(r_above, 1)), axis=1)
-        
-    # Prepare NARVAL data
-    if data_source == 'narval':
-        vertical_layers = None
-        # Yields input_data and output_data
-        if output_type == 'cloud_cover':
-            narval_data.pop('cl_area')
-        elif output_type == 'cloud_area':
-            narval_data.pop('clc')
-
-        narval_data['zg'] = np.repeat(np.expand_dims(narval_data['zg'], 0), TIME_STEPS, axis=0)
-        narval_data['coriolis'] = np.repeat(np.expand_dims(narval_data['coriolis'], 0), TIME_STEPS, axis=0)
-        narval_data['fr_land'] = np.repeat(np.expand_dims(narval_data['fr_land'], 0), TIME_STEPS, axis=0)
-#         narval_data['fr_lake'] = np.repeat(np.expand_dims(narval_data['fr_lake'], 0), TIME_STEPS, axis=0)
-        
-        if model_type == 'grid_cell_based_QUBICC_R02B05' or model_type == 'grid_cell_based_v3':
-            narval_data.pop('fr_lake')
-            narval_data.pop('rho')
-            narval_data['coriolis'] = np.repeat(np.expand_dims(narval_data['coriolis'], 1), VERT_LAYERS, axis=1)
-            narval_data['fr_land'] = np.repeat(np.expand_dims(narval_data['fr_land'], 1), VERT_LAYERS, axis=1)
-            if model_type == 'grid_cell_based_v3':
-                narval_data.pop('qc')
-                narval_data.pop('u')
-                narval_data.pop('v')
-                narval_data.pop('coriolis')
-            narval_data_reshaped = {}
-            for key in narval_data.keys():
-                narval_data_reshaped[key] = np.reshape(narval_data[key], -1) 
-        elif model_type == 'region_based_one_nn_R02B05':
-            narval_data['coriolis'] = np.repeat(np.expand_dims(narval_data['coriolis'], 1), VERT_LAYERS, axis=1)
-            narval_data.pop('rho')
-            narval_data.pop('fr_lake')
-            narval_data.pop('fr_land')
-            # Add temp_sfc
-            temp_sfc = np.repeat(np.expand_dims(narval_data['temp'][:, -1, :], axis=1), VERT_LAYERS, axis=1)
-            # Add above and below, and temp_sfc
-            above = {}
-            below = {}
-            for key in ORDER_OF_VARS_NARVAL[:-4]:
-                above[key], below[key] = add_above_and_below(narval_data[key], key)
-            # Reshape
-            narval_data_reshaped = {}
-            for key in narval_data.keys():
-                narval_data_reshaped[key] = np.reshape(narval_data[key], -1)
-            for key in ORDER_OF_VARS_NARVAL[:-4]:
-                narval_data_reshaped['%s_below'%key] = np.reshape(below[key], -1)
-                narval_data_reshaped['%s_above'%key] = np.reshape(above[key], -1)
-            narval_data_reshaped['temp_sfc'] = np.reshape(temp_sfc, -1)
-            # The output variable has to be put to the end of the dictionary
-            if output_type == 'cloud_cover':
-                clc = narval_data_reshaped.pop('clc')
-                narval_data_reshaped['clc'] = clc
-            elif output_type == 'cloud_area':
-                cl_area = narval_data_reshaped.pop('cl_area')
-                narval_data_reshaped['cl_area'] = cl_area
-        elif model_type == 'region_based_one_nn_with_rh_R02B05':
-            # Add RH
-            T0 = 273.15
-            r = 0.00263*narval_data['pres']*narval_data['qv']*np.exp((17.67*(narval_data['temp']-T0))/(narval_data['temp']-29.65))**(-1)
-            narval_data['rh'] = r
-            # Add above and below, and temp_sfc
-            above = {}
-            below = {}
-            # We only need zg for later book-keeping
-            for key in ['qc', 'qi', 'temp', 'rh', 'zg']:
-                above[key], below[key] = add_above_and_below(narval_data[key], key)
-            # Reshape
-            narval_data_reshaped = {}
-            for key in ['qc', 'qi', 'temp', 'rh', 'zg', 'clc']: # Not optimal to fix clc here.
-                if output_type == 'cloud_area':
-                    raise Exception("Cloud area. Be careful here.") 
-                narval_data_reshaped[key] = np.reshape(narval_data[key], -1)
-            for key in ['qc', 'qi', 'temp', 'rh', 'zg'] :
-                narval_data_reshaped['%s_below'%key] = np.reshape(below[key], -1)
-                narval_data_reshaped['%s_above'%key] = np.reshape(above[key], -1)
-            # The output variable has to be put to the end of the dictionary
-            if output_type == 'cloud_cover':
-                clc = narval_data_reshaped.pop('clc')
-                narval_data_reshaped['clc'] = clc
-            elif output_type == 'cloud_area':
-                cl_area = narval_data_reshaped.pop('cl_area')
-                narval_data_reshaped['cl_area'] = cl_area
-        
-        elif model_type == 'grid_column_based_QUBICC_R02B05' or model_type == 'grid_column_based':
-            if model_type == 'grid_column_based_QUBICC_R02B05':
-                narval_data.pop('fr_lake')
-                narval_data.pop('rho')
-            elif model_type == 'grid_column_based':
-                narval_data.pop('fr_land')
-            narval_data.pop('coriolis')
-            narval_data.pop('u')
-            narval_data.pop('v')
-            # Reshape
-            narval_data_reshaped = {}
-            for key in narval_data.keys():
-                if narval_data[key].shape[1] == VERT_LAYERS:  
-                    # Removing data above 21kms
-                    for i in range(4, VERT_LAYERS):
-                        new_key = '{}{}{:d}'.format(key,'_',(i+17)) # Should start at 21
-                        narval_data_reshaped[new_key] = np.reshape(narval_data[key][:,i,:], -1)
-                else:
-                    narval_data_reshaped[key] = np.reshape(narval_data[key], -1)
-            # I think the order of the variables is fine here as well         
-            
-        df = pd.DataFrame.from_dict(narval_data_reshaped)
-        if model_type in ['grid_cell_based_QUBICC_R02B05', 'region_based_one_nn_R02B05', 'region_based_one_nn_with_rh_R02B05', 'grid_cell_based_v3']:
-            df = df.loc[df['zg'] < 21000] 
-            if model_type == 'region_based_one_nn_with_rh_R02B05':
-                df.drop(columns=['zg', 'zg_below', 'zg_above'], inplace=True)
-            print(df.columns)
-        
-            # Drop the target (clc or cl_area) from df and put it in output_data
-            output_data = np.float32(pd.DataFrame(df.iloc[:, -1]))
-            df.drop(df.columns[len(df.columns)-1], axis=1, inplace=True)
-        elif model_type in ['grid_column_based_QUBICC_R02B05', 'grid_column_based']:
-            # Drop the target (clc or cl_area) from df and put it in output_data
-            output_data = np.float32(pd.DataFrame(df.iloc[:, -27:]))
-            for i in range(27):
-                df.drop(df.columns[len(df.columns)-1], axis=1, inplace=True)
-            # Remove features that were constant
-            if model_type == 'grid_cell_based_QUBICC_R02B05': 
-                remove_fields = [27, 28, 29, 30, 31, 32, 135, 136, 137]
-            elif model_type == 'grid_column_based':
-                remove_fields = [27, 162, 163, 164]
-            remove_fields = -np.sort(-np.array(remove_fields)) #Careful with the order of removal
-            for i in remove_fields:
-                df.drop(df.columns[i], axis=1, inplace=True)
-        
-        input_data = np.float32(df)
+        clc_model = load_model(get_model_path(model_type, model, output_type))
+
+    # Yields input_data, output_data and vertical_layers
+    input_data, output_data, vertical_layers = get_input_and_output(model_type, data_source, output_type, 
+                                                                    narval_data, cache, days, resolution)
 
     # Evaluate model on QUBICC data -> R2, mean per vertical layer
     # We might need to reduce a redundant dimension with np.squeeze to achieve pred_output.shape = output_data.shape
@@ -332,6 +368,75 @@ def get_R2_and_means(model_type, model, model_mean, model_std, data_source,
     
     return compute_R2_and_means(pred_output, np.squeeze(output_data), vertical_layers)
 
+# For the NARVAL region-based model (one NN per vertical layer, evaluated on the NARVAL R2B5 data)
+def read_layer_means_and_stds(info_file, n_layers=27):
+    '''
+        The means and standard deviations of the n_layers Standard Scalers of the region-based model (in the format
+        of its info-file). nan is read as 1e+30 (as it was replaced manually for narval_r2b4_on_narval_r2b5.ipynb).
+    '''
+    with open(info_file) as file:
+        text = file.read()
+    def values(start):
+        # The array printed after every occurrence of start
+        arrays = []
+        for block in text.split(start)[1:]:
+            numbers = block[block.index('[') + 1:block.index(']')]
+            arrays.append(np.nan_to_num(np.array(numbers.split(), dtype=np.float64), nan=1e+30))
+        return arrays
+    means = values('The mean values')
+    stds = values('The standard deviation values')
+    assert len(means) == len(stds) == n_layers, 'Expected %d Standard Scalers in %s'%(n_layers, info_file)
+    return means, stds
+
+def get_R2_and_means_region_based_narval(days=None, n_layers=27, timesteps_per_day=36, horiz_fields=4450):
+    '''
+        The region-based NARVAL model on the NARVAL R2B5 data (the 'Region-based' row of
+        narval_models_r2_and_mean_values.txt). The models of the layers are model_clc_all_days_final_1_<layer>.h5.
+
+        days: Days (YYYYMMDD) to evaluate on. By default all days with temperature files.
+
+        Returns: data_means, pred_means, r2_profile
+    '''
+    from tensorflow.keras.models import load_model
+    sys.path.insert(0, os.path.join(path, 'region_based', 'source_code'))
+    from for_preprocessing import load_day
+
+    narval_path = data_path('my_work/NARVAL/data_var_vertinterp_R02B05/')
+    if days is None:
+        days = sorted(set([file_name.split(sep='_')[5][:8] for file_name in
+                           os.listdir(os.path.join(narval_path, 'temp'))]))
+
+    # The samples of every layer, day after day (all days but the first cut to timesteps_per_day time steps)
+    input_NN = [[] for i in range(n_layers)]
+    data_clc = [[] for i in range(n_layers)]
+    for k, day in enumerate(days):
+        dfs = load_day(day, n_layers, narval_path, data_source='narval', resolution_narval='R02B05')
+        for i in range(n_layers):
+            # The columns load_day cannot fill for the lowest layers are of dtype object (all nan)
+            values = np.array(dfs[i] if k == 0 else dfs[i][:timesteps_per_day*horiz_fields], dtype=np.float64)
+            input_NN[i].append(values[:, :-1])
+            data_clc[i].append(values[:, -1])
+        del dfs
+
+    # The scaling of the model, without the features of zero (or nan) variance in the training set of a layer
+    means, stds = read_layer_means_and_stds(os.path.join(path, 'region_based', 'saved_models',
+                                                         'model_region_based_final_1.txt'), n_layers)
+    input_train = np.load(os.path.join(get_data_path('region_based'), 'cloud_cover_input_train_1.npy'),
+                          mmap_mode='r')
+    n_train = input_train.shape[0]//n_layers
+
+    pred_clc_mat = []
+    data_clc_mat = []
+    for i in range(n_layers):
+        var = np.var(input_train[n_train*i:n_train*(i+1)], axis=0)
+        keep = np.flatnonzero(~((var == 0) | np.isnan(var)))
+        model = load_model(os.path.join(path, 'region_based', 'saved_models', 'model_clc_all_days_final_1_%d.h5'%i))
+        layer_input = np.concatenate(input_NN[i])[:, keep]
+        pred_clc_mat.append(np.squeeze(predict(model, layer_input, means[i][keep], stds[i][keep])))
+        data_clc_mat.append(np.concatenate(data_clc[i]))
+        input_NN[i] = None
+    return compute_R2_and_means(np.stack(pred_clc_mat, axis=1), np.stack(data_clc_mat, axis=1), None)
+
 # Write to file
 def write_to_file(model_type_short, data_source_capitalized, data_means, pred_means, r2_profile, output_type='cloud_cover', model_training_source='qubicc'):
     '''
@@ -1,8 +1,14 @@
 import os
+import sys
 import numpy as np
 
 from sklearn.preprocessing import StandardScaler
 
+# Add path with concatenated_dataset to sys.path
+sys.path.insert(0, '/pf/b/b309170/workspace_icon-ml/cloud_cover_parameterization/')
+
+from concatenated_dataset import ConcatenatedDataset, fit_scaler
+
 '''
     We collect all means and variances in a text file:
     We first load the preprocessed QUBICC R2B5 data, that has not yet been normalized.
@@ -35,54 +41,45 @@ column_path = 'grid_column_based_QUBICC_R02B05/based_on_var_interpolated_data/cl
 region_path = 'region_based_one_nn_R02B05/based_on_var_interpolated_data/cloud_cover_input_qubicc.npy'
 
 # Cell
-cell_data = np.load(os.path.join(path, cell_path))
-        
-if cell_data.shape[0] < cell_data.shape[1]:
-    cell_data = np.transpose(cell_data)
+# Memory-mapped and transposed lazily if necessary
+cell_data = ConcatenatedDataset([os.path.join(path, cell_path)])
 
 (samples_total, no_of_features) = cell_data.shape
                     
 training_folds, validation_folds = set_training_validation_folds(samples_total, 0)
                     
 for i in range(3):                
-    scaler = StandardScaler(copy=False)
-    scaler.fit(cell_data[training_folds[i]])
+    scaler = fit_scaler(StandardScaler(copy=False), cell_data, training_folds[i])
     with open('qubicc_scalings.txt', 'a') as file:
         file.write('Cell %d: \n'%i)
         file.write(str(scaler.mean_)+'\n')
         file.write(str(scaler.var_)+'\n')
         
 # Region
-region_data = np.load(os.path.join(path, region_path))
-        
-if region_data.shape[0] < region_data.shape[1]:
-    region_data = np.transpose(region_data)
+# Memory-mapped and transposed lazily if necessary
+region_data = ConcatenatedDataset([os.path.join(path, region_path)])
 
 (samples_total, no_of_features) = region_data.shape
                     
 training_folds, validation_folds = set_training_validation_folds(samples_total, 0)
                     
 for i in range(3):                
-    scaler = StandardScaler(copy=False)
-    scaler.fit(region_data[training_folds[i]])
+    scaler = fit_scaler(StandardScaler(copy=False), region_data, training_folds[i])
     with open('qubicc_scalings.txt', 'a') as file:
         file.write('Region %d: \n'%i)
         file.write(str(scaler.mean_)+'\n')
         file.write(str(scaler.var_)+'\n')
         
 # Column
-column_data = np.load(os.path.join(path, column_path))
-        
-if column_data.shape[0] < column_data.shape[1]:
-    column_data = np.transpose(column_data)
+# Memory-mapped and transposed lazily if necessary
+column_data = ConcatenatedDataset([os.path.join(path, column_path)])
 
 (samples_total, no_of_features) = column_data.shape
                     
 training_folds, validation_folds = set_training_validation_folds(samples_total, 0)
                     
 for i in range(3):                
-    scaler = StandardScaler(copy=False)
-    scaler.fit(column_data[training_folds[i]])
+    scaler = fit_scaler(StandardScaler(copy=False), column_data, training_folds[i])
     with open('qubicc_scalings.txt', 'a') as file:
         file.write('Column %d: \n'%i)
         file.write(str(scaler.mean_)+'\n')
@@ -0,0 +1,313 @@
+## Throughput and peak-memory benchmarks of the hot paths on synthetic data ##
+# Runs load_data, the vertical interpolation and cloud area fraction of the coarse-graining scripts, the NARVAL
+# feature building, predict and compute_R2_and_means on the synthetic data tree of synthetic_data.py (generated if
+# it does not exist yet). Small enough for a laptop: ~300MB of data and <2GB of memory with the defaults.
+#
+# - Every benchmark runs in a fresh (spawned) process, so that they cannot influence each other's memory
+# - Only the hot path is timed (the setup, e.g. loading the data for the feature building, is not), we keep the
+#   fastest of --repeats runs. Throughput = samples/s with benchmark-specific samples (values read, columns, ...)
+# - Peak memory: By how much the hot path raises the peak RSS over the RSS after the setup (Linux)
+# - Benchmarks whose dependencies are missing (e.g. tensorflow for predict) are reported as skipped
+# - import/<module>: The time to import the module in a fresh interpreter (samples/s = imports/s)
+#
+# The numbers are only comparable on the same machine and data. Store results of a known good state and compare:
+#   python benchmark.py --save baseline.json
+#   python benchmark.py --compare baseline.json     # Exits with 1 if a benchmark got slower or needs more memory
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import resource
+import traceback
+import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from data_paths import data_path
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+FUNCTIONS_PATH = os.path.join(ROOT, 'additional_content', 'plots_offline_paper', 'auxiliary')
+DEFAULT_DATA_ROOT = '/tmp/iconml_synthetic'
+
+def _rss():
+    # Current RSS in bytes
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1])*os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024
+
+def _reset_peak_rss():
+    # Resets VmHWM (Linux >= 4.0). Otherwise the peak of the setup may hide the one of the hot path.
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+def _peak_rss():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])*1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024
+
+def measure(run, repeats):
+    '''
+        Times run() repeats times. run returns the number of samples it processed.
+
+        Returns: seconds (the fastest run), samples, peak RSS growth over the RSS before the first run (in MB)
+    '''
+    (seconds, peak_growth) = (np.inf, 0)
+    for k in range(repeats):
+        rss = _rss()
+        _reset_peak_rss()
+        t0 = time.perf_counter()
+        samples = run()
+        seconds = min(seconds, time.perf_counter() - t0)
+        peak_growth = max(peak_growth, _peak_rss() - rss)
+    return seconds, samples, peak_growth/2**20
+
+def _import_my_classes():
+    sys.path.insert(0, ROOT)
+    import my_classes
+    return my_classes
+
+def _import_functions():
+    sys.path.insert(0, ROOT)
+    sys.path.insert(0, FUNCTIONS_PATH)
+    import functions
+    return functions
+
+def _narval_data():
+    return _import_my_classes().load_data('narval', 'all', order_of_vars=['qv', 'qc', 'qi', 'temp', 'pres', 'rho', 'zg',
+                                                                           'coriolis', 'fr_land', 'fr_lake', 'clc'])
+
+## The benchmarks ##
+# Every benchmark does its setup and returns the measure() of its hot path. They raise ImportError if they can't run.
+
+def bench_import(repeats, module, path=ROOT):
+    '''
+        Time to import module in a fresh interpreter (what every tool and notebook pays at startup).
+        Peak memory: The peak RSS of that interpreter (not the growth).
+    '''
+    code = 'import sys, resource; sys.path.insert(0, %r); sys.path.insert(0, %r); import %s; ' \
+           'print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)'%(ROOT, path, module)
+    peak_rss = []
+    def run():
+        result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True)
+        if result.returncode != 0:
+            error = result.stderr.strip().split('\n')[-1]
+            raise (ImportError if 'ModuleNotFoundError' in error or 'ImportError' in error else RuntimeError)(error)
+        peak_rss.append(int(result.stdout.strip().split('\n')[-1])*1024)
+        return 1
+    seconds, samples, _ = measure(run, repeats)
+    return seconds, samples, min(peak_rss)/2**20
+
+def bench_load_data(repeats, source='narval', days='all', resolution='R02B04', max_workers=None):
+    load_data = _import_my_classes().load_data
+    def run():
+        data_dict = load_data(source, days, resolution=resolution, max_workers=max_workers)
+        return sum([data_dict[key].size for key in data_dict.keys()])
+    return measure(run, repeats)
+
+def bench_vertical_interpolation(repeats, resolution='R02B04'):
+    import xarray as xr
+    from coarse_graining import vertical_interpolation
+    # All hourly qv files at once
+    var_path = data_path('bd1179_work/narval/hcg_files/qv')
+    var = np.concatenate([xr.open_dataset(os.path.join(var_path, f)).qv.values for f in sorted(os.listdir(var_path))
+                          if '_%s_'%resolution in f])
+    zh_lr = xr.open_dataset(data_path('my_work/NARVAL/grid_extpar/zghalf_icon-a_capped_%s.nc'%resolution)).zghalf.values
+    zh_hr = xr.open_dataset(data_path('my_work/NARVAL/grid_extpar/z_ifc_%s_NARVAL_fg_DOM01_ML_capped.nc'%resolution)).z_ifc.values
+    not_nan = ~np.isnan(var[0,-1,:])
+    (var_n, zh_lr_n, zh_hr_n) = (var[:,:,not_nan], zh_lr[:,not_nan], zh_hr[:,not_nan])
+    def run():
+        var_out = vertical_interpolation(var_n, zh_lr_n, zh_hr_n, 31)
+        return var_out.shape[0]*var_out.shape[2]
+    return measure(run, repeats)
+
+def bench_cloud_area_fraction(repeats):
+    import xarray as xr
+    from coarse_graining import cloud_area_fraction
+    date_path = data_path('scratch/orig_files', sorted(os.listdir(data_path('scratch/orig_files')))[-1])
+    clc = xr.open_dataset(os.path.join(date_path, sorted(os.listdir(date_path))[0])).clc.values
+    weights = np.load(data_path('my_work/NARVAL/grid_extpar/weights_NARVAL_R02B10_cloud_area_fraction.npy'))
+    def run():
+        clc_out = cloud_area_fraction(clc, weights)
+        return clc_out.shape[0]*clc_out.shape[2]
+    return measure(run, repeats)
+
+def bench_build_narval_input_and_output(repeats, model_type='grid_column_based'):
+    functions = _import_functions()
+    narval_data = _narval_data()
+    def run():
+        input_data, output_data = functions.build_narval_input_and_output(model_type, narval_data)
+        return len(input_data)
+    return measure(run, repeats)
+
+def bench_predict(repeats):
+    functions = _import_functions()
+    from tensorflow import keras
+    input_data, output_data = functions.build_narval_input_and_output('grid_column_based', _narval_data())
+    # The architecture of the column-based models
+    model = keras.Sequential([keras.Input(shape=(input_data.shape[1],)), keras.layers.Dense(256, activation='relu'),
+                              keras.layers.Dense(256, activation='relu'), keras.layers.Dense(output_data.shape[1])])
+    (mean, std) = (np.mean(input_data, axis=0), np.std(input_data, axis=0) + 1e-8)
+    def run():
+        return len(functions.predict(model, input_data, mean, std))
+    return measure(run, repeats)
+
+def bench_compute_R2_and_means(repeats, model_type='grid_column_based'):
+    functions = _import_functions()
+    input_data, output_data = functions.build_narval_input_and_output(model_type, _narval_data())
+    pred_output = output_data + np.random.default_rng(0).normal(0, 5, output_data.shape).astype(np.float32)
+    vertical_layers = None
+    if output_data.ndim == 1:
+        # Cell-based: The vertical layer (5, ..., 31) of every sample, like in get_R2_and_means
+        narval_data = _narval_data()
+        keep = np.flatnonzero(np.reshape(narval_data['zg'], -1) < 21000)
+        vertical_layers = np.tile(keep//narval_data['zg'].shape[1] + 1, len(output_data)//len(keep))
+    def run():
+        functions.compute_R2_and_means(pred_output, output_data, vertical_layers)
+        return len(output_data)
+    return measure(run, repeats)
+
+def benchmarks(resolutions):
+    '''
+        name -> (benchmark function, keyword arguments)
+    '''
+    benches = {}
+    for module in ['iconml.io', 'my_classes', 'preprocessing_pipeline']:
+        benches['import/%s'%module] = (bench_import, {'module': module})
+    benches['import/functions'] = (bench_import, {'module': 'functions', 'path': FUNCTIONS_PATH})
+    for resolution in resolutions:
+        days = 'all' if resolution == 'R02B04' else 'dec_1st'
+        benches['load_data/narval_%s_%s'%(resolution, days)] = (bench_load_data, {'days': days, 'resolution': resolution})
+        benches['load_data/narval_%s_%s_workers4'%(resolution, days)] = \
+            (bench_load_data, {'days': days, 'resolution': resolution, 'max_workers': 4})
+        days = 'all' if resolution == 'R02B04' else 'nov_2nd'
+        benches['load_data/qubicc_%s_%s'%(resolution, days)] = \
+            (bench_load_data, {'source': 'qubicc', 'days': days, 'resolution': resolution})
+        benches['vertical_interpolation/%s'%resolution] = (bench_vertical_interpolation, {'resolution': resolution})
+    benches['cloud_area_fraction'] = (bench_cloud_area_fraction, {})
+    for model_type in ['grid_column_based', 'grid_cell_based_v3']:
+        benches['build_narval_input_and_output/%s'%model_type] = (bench_build_narval_input_and_output,
+                                                                  {'model_type': model_type})
+        benches['compute_R2_and_means/%s'%model_type] = (bench_compute_R2_and_means, {'model_type': model_type})
+    benches['predict/grid_column_based'] = (bench_predict, {})
+    return benches
+
+def _run_benchmark(bench, kwargs, repeats, data_root):
+    # Runs in a spawned process
+    os.environ['ICONML_DATA_ROOT'] = data_root
+    # The output of load_data etc. is not of interest here
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        seconds, samples, peak_rss_growth_mb = bench(repeats, **kwargs)
+    except ImportError as e:
+        return {'status': 'skipped', 'reason': 'ImportError: %s'%e}
+    except Exception:
+        return {'status': 'failed', 'reason': traceback.format_exc(limit=3)}
+    return {'status': 'ok', 'seconds': seconds, 'samples': samples, 'throughput': samples/seconds,
+            'peak_rss_growth_mb': peak_rss_growth_mb}
+
+def run_benchmarks(data_root, resolutions=('R02B04',), repeats=3, select=None):
+    '''
+        Runs all benchmarks (or those whose name contains one of the strings in select) one after another,
+        each in a new process.
+    '''
+    results = {}
+    for name, (bench, kwargs) in benchmarks(resolutions).items():
+        if select is not None and not any([s in name for s in select]):
+            continue
+        with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as executor:
+            results[name] = executor.submit(_run_benchmark, bench, kwargs, repeats, data_root).result()
+        print_result(name, results[name])
+    return results
+
+def print_result(name, result, baseline=None, verdict=''):
+    if result['status'] != 'ok':
+        print('%-52s %s (%s)'%(name, result['status'], result['reason'].strip().split('\n')[-1]))
+        return
+    line = '%-52s %8.3fs %12.4g samples/s %8.1f MB'%(name, result['seconds'], result['throughput'],
+                                                      result['peak_rss_growth_mb'])
+    if baseline is not None and baseline.get('status') == 'ok':
+        line += '   (%+.0f%% throughput, %+.1f MB) %s'%(100*(result['throughput']/baseline['throughput'] - 1),
+                                                        result['peak_rss_growth_mb'] - baseline['peak_rss_growth_mb'],
+                                                        verdict)
+    print(line)
+
+def compare(results, baseline, tolerance=0.2, memory_slack_mb=20):
+    '''
+        Flags benchmarks with a throughput more than tolerance below the baseline or a peak RSS growth more than
+        tolerance (and memory_slack_mb, for the small ones) above it. Returns the names of the regressions.
+    '''
+    regressions = []
+    for name in results.keys():
+        (result, base) = (results[name], baseline['results'].get(name))
+        if result['status'] != 'ok' or base is None or base['status'] != 'ok':
+            continue
+        verdict = []
+        if result['throughput'] < (1 - tolerance)*base['throughput']:
+            verdict.append('SLOWER')
+        if result['peak_rss_growth_mb'] > (1 + tolerance)*base['peak_rss_growth_mb'] + memory_slack_mb:
+            verdict.append('MORE MEMORY')
+        if len(verdict) > 0:
+            regressions.append(name)
+        print_result(name, result, base, ', '.join(verdict))
+    return regressions
+
+def save(file_name, results, settings):
+    output = {'settings': settings, 'machine': {'host': platform.node(), 'cpus': os.cpu_count(),
+                                                'python': platform.python_version(), 'numpy': np.__version__},
+              'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'results': results}
+    with open(file_name + '.tmp', 'w') as f:
+        json.dump(output, f, indent=1)
+    os.replace(file_name + '.tmp', file_name)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the hot paths on synthetic data')
+    parser.add_argument('--data_root', default=DEFAULT_DATA_ROOT, help='Synthetic data tree (generated if missing)')
+    parser.add_argument('--resolutions', nargs='+', default=['R02B04'], help='R02B05 takes ~4x the time and data')
+    parser.add_argument('--hours', type=int, default=6, help='Hourly files per day of the synthetic data')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--select', nargs='+', help='Only run the benchmarks whose names contain these strings')
+    parser.add_argument('--save', help='Store the results in this JSON file')
+    parser.add_argument('--compare', help='Compare with the results in this JSON file. Exit code 1 on regressions')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Relative slowdown/memory increase we accept')
+    args = parser.parse_args()
+
+    settings = {'resolutions': args.resolutions, 'hours': args.hours, 'repeats': args.repeats}
+    # One data tree per number of hours (the resolutions have separate files)
+    data_root = os.path.join(args.data_root, '%dh'%args.hours)
+    for resolution in args.resolutions:
+        marker = os.path.join(data_root, '.synthetic_%s'%resolution)
+        if not os.path.exists(marker):
+            import synthetic_data
+            print('Generating the synthetic %s data in %s'%(resolution, data_root))
+            synthetic_data.generate(data_root, resolution=resolution, hours=args.hours)
+            open(marker, 'w').close()
+
+    results = run_benchmarks(data_root, args.resolutions, args.repeats, args.select)
+    if args.save is not None:
+        save(args.save, results, settings)
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if [baseline['settings'][key] for key in ['resolutions', 'hours']] != [args.resolutions, args.hours]:
+            print('Warning: The baseline was run with %s (now: %s)'%(baseline['settings'], settings))
+        print('\nCompared to %s (%s):'%(args.compare, baseline['date']))
+        regressions = compare(results, baseline, args.tolerance)
+        if len(regressions) > 0:
+            print('\n%d regression(s): %s'%(len(regressions), ', '.join(regressions)))
+            sys.exit(1)
+        print('\nNo regressions')
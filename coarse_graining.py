@@ -0,0 +1,54 @@
+## The vertical coarse-graining steps of extract_from_the_data/coarse-graining_scripts as functions ##
+# So that the scripts and benchmark.py run the same code. The scripts still handle the files.
+
+import numpy as np
+
+def vertical_interpolation(var_n, zh_lr_n, zh_hr_n, vert_layers=31):
+    '''
+        Conservative vertical interpolation of var_n (time, high-res layers, cells) from the high-res half levels
+        zh_hr_n onto the vert_layers low-res layers given by the half levels zh_lr_n (only the not-nan cells).
+        Where the low-res layer extends farther than the high-res grid, the output is NaN.
+
+        Returns: var_out (time, vert_layers, cells) in float64
+    '''
+    time_steps = var_n.shape[0]
+    var_out = np.full((time_steps, vert_layers, var_n.shape[2]), np.nan) # var_n.shape[2] = Number of not_nans
+
+    # Pretty fast implementation:
+    for t in range(time_steps):
+        for j in range(vert_layers):
+            z_u = zh_lr_n[j, :]
+            z_l = zh_lr_n[j+1, :]
+            # weights.shape = var_n[0].shape = high-res_layers x len(not_nan)
+            # len(z_u) = len(z_l) = len(not_nan)
+            weights = np.maximum(np.minimum(z_u, zh_hr_n[:-1]) - np.maximum(zh_hr_n[1:], z_l), 0)
+            var_out[t,j,:] = np.einsum('ij,ji->i', weights.T, var_n[t])/(z_u - z_l)
+
+            # If the low-dim grid extends farther than the high-dim grid, we reinsert nans:
+            should_be_nan = np.where(np.abs((z_u - z_l) - np.sum(weights, axis = 0)) >= 0.5)
+            var_out[t,j,should_be_nan] = np.full(len(should_be_nan), np.nan)
+    return var_out
+
+def cloud_area_fraction(clc, weights, dtype=np.float32):
+    '''
+        Cloud area fraction of every low-res layer: The maximum cloud cover of the high-res layers that overlap with it.
+
+        clc:     (time, high-res layers, cells)
+        weights: (low-res layers, high-res layers, cells). Non-zero where the layers overlap.
+
+        Returns: clc_out (time, low-res layers, cells)
+    '''
+    (time_steps, vert_layers_lr) = (clc.shape[0], weights.shape[0])
+    clc_out = np.full((time_steps, vert_layers_lr, clc.shape[2]), np.nan, dtype=dtype)
+    for t in range(time_steps):
+        for j in range(vert_layers_lr):
+            clc_out[t][j] = np.max(weights[j]*clc[t], axis=0) #Element-wise product
+    return clc_out
+
+def overlap_weights(zh_lr, zh_hr):
+    '''
+        Weights for cloud_area_fraction from the low-res (zh_lr) and high-res (zh_hr) half levels (top to bottom):
+        True where a high-res layer overlaps with a low-res layer.
+    '''
+    z_u, z_l = zh_lr[:-1, None, :], zh_lr[1:, None, :]
+    return (np.minimum(z_u, zh_hr[None, :-1, :]) - np.maximum(z_l, zh_hr[None, 1:, :])) > 0
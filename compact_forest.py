@@ -0,0 +1,172 @@
+## Compact, array-backed format for the random forests of additional_content/baselines ##
+# A fitted RandomForestRegressor is flattened into contiguous node arrays (one npy-file each):
+# - feature:   Input feature of the split (int8/int16), -1 for leaves
+# - threshold: Split threshold (float32, rounded down, see below)
+# - left/right: Index of the children within the tree (uint8/uint16/uint32)
+# - value:     Prediction of every node (float32 if that is lossless, else float64)
+# - offsets:   Index of the root of every tree in the node arrays
+# A directory of npy-files can be memory-mapped directly. A joblib-file has to be unpickled entirely.
+#
+# Prediction: All samples descend the tree simultaneously, one level per step (breadth-first), with a few
+# vectorized gathers per level. Samples that reached a leaf are removed from the active set, so that deep
+# branches only cost for the samples that actually go there. The samples are split into blocks that are
+# evaluated by a thread pool.
+#
+# The predictions are identical to sklearn's:
+# - sklearn compares the float32 input x with the float64 threshold t. For float32 x, x <= t is equivalent to
+#   x <= t32, with t32 the largest float32 <= t. So we store t32.
+# - The tree predictions are summed in float64 in the order of the trees and divided by the number of trees.
+#   (With n_jobs > 1, sklearn sums them in the order the threads finish, which can change the last bit.)
+#
+# Usage: python compact_forest.py model.joblib output_dir [--check input.npy]
+
+import os
+import json
+import time
+import argparse
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+ARRAYS = ['feature', 'threshold', 'left', 'right', 'value', 'offsets']
+
+def _smallest_int_dtype(max_value, signed=False):
+    for dtype in ([np.int8, np.int16, np.int32, np.int64] if signed else [np.uint8, np.uint16, np.uint32, np.uint64]):
+        if max_value <= np.iinfo(dtype).max:
+            return dtype
+
+def _round_down_to_float32(threshold):
+    threshold = np.asarray(threshold, dtype=np.float64)
+    threshold_32 = threshold.astype(np.float32)
+    too_large = threshold_32.astype(np.float64) > threshold
+    threshold_32[too_large] = np.nextafter(threshold_32[too_large], np.float32(-np.inf))
+    return threshold_32
+
+def export_forest(rf, output_dir):
+    '''
+        Writes the fitted RandomForestRegressor (or a single DecisionTreeRegressor) rf into output_dir.
+
+        Returns: The size of the compact forest in bytes
+    '''
+    estimators = getattr(rf, 'estimators_', [rf])
+    trees = [estimator.tree_ for estimator in estimators]
+    n_outputs = trees[0].n_outputs
+
+    offsets = np.cumsum([0] + [tree.node_count for tree in trees])
+    max_nodes = max([tree.node_count for tree in trees])
+    feature = np.zeros(offsets[-1], dtype=_smallest_int_dtype(trees[0].n_features, signed=True))
+    threshold = np.zeros(offsets[-1], dtype=np.float64)
+    left = np.zeros(offsets[-1], dtype=_smallest_int_dtype(max_nodes))
+    right = np.zeros(offsets[-1], dtype=left.dtype)
+    value = np.zeros((offsets[-1], n_outputs), dtype=np.float64)
+    max_depth = 0
+    for tree, offset in zip(trees, offsets):
+        nodes = slice(offset, offset + tree.node_count)
+        is_leaf = tree.children_left == -1
+        # Leaves have the feature -1
+        feature[nodes] = np.where(is_leaf, -1, tree.feature)
+        threshold[nodes] = np.where(is_leaf, 0, tree.threshold)
+        left[nodes] = np.where(is_leaf, 0, tree.children_left)
+        right[nodes] = np.where(is_leaf, 0, tree.children_right)
+        value[nodes] = tree.value[:, :, 0]
+        max_depth = max(max_depth, tree.max_depth)
+
+    # Only use float32 for the values if we do not lose anything
+    if np.array_equal(value.astype(np.float32).astype(np.float64), value):
+        value = value.astype(np.float32)
+    arrays = {'feature': feature, 'threshold': _round_down_to_float32(threshold), 'left': left, 'right': right,
+              'value': value, 'offsets': offsets[:-1].astype(np.int64)}
+
+    os.makedirs(output_dir, exist_ok=True)
+    size = 0
+    for name in ARRAYS:
+        np.save(os.path.join(output_dir, name + '.npy'), arrays[name])
+        size += os.path.getsize(os.path.join(output_dir, name + '.npy'))
+    meta = {'no_trees': len(trees), 'no_nodes': int(offsets[-1]), 'max_depth': int(max_depth),
+            'no_features': int(trees[0].n_features), 'no_outputs': int(n_outputs),
+            'dtypes': {name: str(arrays[name].dtype) for name in ARRAYS}, 'bytes': size}
+    with open(os.path.join(output_dir, 'meta.json'), 'w') as file:
+        json.dump(meta, file, indent=1)
+    return size
+
+class CompactForest():
+    '''
+    A random forest in the compact format, memory-mapped from the output_dir of export_forest.
+    '''
+    def __init__(self, path, mmap_mode='r'):
+        with open(os.path.join(path, 'meta.json')) as file:
+            self.meta = json.load(file)
+        for name in ARRAYS:
+            setattr(self, name, np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode))
+
+    def _predict_block(self, X):
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        no_features = X.shape[1]
+        X = X.reshape(-1)
+        no_samples = X.shape[0]//no_features
+        y = np.zeros((no_samples, self.meta['no_outputs']), dtype=np.float64)
+        for offset in self.offsets:
+            leaf = np.zeros(no_samples, dtype=np.int64)
+            # Samples that have not yet reached a leaf (as index of their first feature in X) and their current node
+            active = np.arange(0, no_samples*no_features, no_features)
+            node = np.full(no_samples, offset, dtype=np.int64)
+            while active.size > 0:
+                feature = self.feature[node]
+                is_leaf = feature < 0
+                if np.any(is_leaf):
+                    leaf[active[is_leaf]//no_features] = node[is_leaf]
+                    (active, node, feature) = (active[~is_leaf], node[~is_leaf], feature[~is_leaf])
+                go_left = X[active + feature] <= self.threshold[node]
+                node = offset + np.where(go_left, self.left[node], self.right[node])
+            y += self.value[leaf]
+        return y/len(self.offsets)
+
+    def predict(self, X, block_size=2**16, threads=None):
+        '''
+            Same output as rf.predict(X). X can be memory-mapped, only block_size samples per thread are read at once.
+
+            threads: Number of threads (by default the number of cores)
+        '''
+        if threads is None:
+            threads = os.cpu_count() or 1
+        blocks = [(start, min(start + block_size, X.shape[0])) for start in range(0, X.shape[0], block_size)]
+        y = np.zeros((X.shape[0], self.meta['no_outputs']), dtype=np.float64)
+        def predict_block(block):
+            y[block[0]:block[1]] = self._predict_block(X[block[0]:block[1]])
+        # The gathers release the GIL
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            list(executor.map(predict_block, blocks))
+        if self.meta['no_outputs'] == 1:
+            return y[:, 0]
+        return y
+
+def compare_with_sklearn(rf, forest, X, joblib_file=None):
+    '''
+        Predicts X with both rf and the CompactForest forest. Returns the maximum absolute difference of the
+        predictions, the time it took and the size on disk of both (if the joblib_file is given).
+    '''
+    t0 = time.time()
+    y_rf = rf.predict(X)
+    t1 = time.time()
+    y_forest = forest.predict(X)
+    t2 = time.time()
+    report = {'max_abs_difference': float(np.max(np.abs(y_rf - y_forest))), 'samples': X.shape[0],
+              'sklearn_s': t1 - t0, 'compact_s': t2 - t1, 'compact_bytes': forest.meta['bytes']}
+    if joblib_file is not None:
+        report['joblib_bytes'] = os.path.getsize(joblib_file)
+    return report
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert a joblib random forest into the compact format')
+    parser.add_argument('joblib_file')
+    parser.add_argument('output_dir')
+    parser.add_argument('--check', default=None, help='npy-file with (scaled) inputs to compare the predictions on')
+    args = parser.parse_args()
+
+    import joblib
+    rf = joblib.load(args.joblib_file)
+    size = export_forest(rf, args.output_dir)
+    print('%s: %d bytes, compact: %d bytes'%(args.joblib_file, os.path.getsize(args.joblib_file), size))
+    if args.check is not None:
+        report = compare_with_sklearn(rf, CompactForest(args.output_dir), np.load(args.check, mmap_mode='r'),
+                                      args.joblib_file)
+        print(json.dumps(report, indent=1))
@@ -0,0 +1,121 @@
+## Compressed, float32 NetCDF4 output of the coarse-graining scripts, optionally with only the valid cells ##
+# Two layouts of a variable with dims (..., cell):
+# - full:    All horizontal cells of the grid, NaN where there is no data (e.g. below the surface). As before,
+#            but in float32 and with chunked, zlib-compressed NetCDF4 encoding.
+# - compact: Only the valid cells. The coordinate cell_index holds their index on the full grid and the
+#            attribute horiz_fields the number of cells of the full grid.
+# cell_values reads both layouts (also from open_mfdataset) and returns the values on the full grid or on the
+# cells given by a not_nan-mask, so that load_data does not need to know the layout of a file.
+# All files that are opened together with open_mfdataset need to have the same layout and (if compact) the same
+# cell_index. Full and compact files of one variable can not be mixed.
+
+import numpy as np
+import xarray as xr
+
+def _encoding(da, complevel, chunk_cells):
+    chunksizes = tuple([1 if dim == 'time' else (min(size, chunk_cells) if k == da.ndim - 1 else size)
+                        for k, (dim, size) in enumerate(zip(da.dims, da.shape))])
+    return {da.name: {'dtype': 'float32', 'zlib': True, 'shuffle': True, 'complevel': complevel,
+                      'chunksizes': chunksizes, '_FillValue': np.float32(np.nan)}}
+
+def write_cell_data(values, name, file_name, coords, dims, not_nan=None, compact=False, cell_coords=None,
+                    complevel=4, chunk_cells=2**16):
+    '''
+        Writes a variable with horizontal cells as last dimension into a NetCDF4 file.
+
+        values:      Values on the full grid or, if not_nan is given, only on the not_nan cells (like var_out in
+                     vert_interp_variability.py)
+        name:        Name of the variable
+        coords:      Coordinates of the other dimensions, e.g. {'time': ds.time, 'height': ds.height[:31]}
+        dims:        All dimensions, e.g. ['time', 'height', 'cell']
+        not_nan:     Boolean mask of the valid cells on the full grid. Required for compact.
+        compact:     Only store the valid cells (and cell_index)
+        cell_coords: Coordinates along the cells on the full grid, e.g. {'lon': ds.clon, 'lat': ds.clat}
+    '''
+    cell_dim = dims[-1]
+    coords = dict(coords)
+    cell_coords = {} if cell_coords is None else cell_coords
+
+    if not_nan is None and compact:
+        raise ValueError('The compact layout needs the not_nan mask')
+    if compact:
+        cell_index = np.flatnonzero(not_nan)
+        if values.shape[-1] == len(not_nan) and len(not_nan) != len(cell_index):
+            values = values[..., not_nan]
+        for key in cell_coords.keys():
+            coords[key] = (cell_dim, np.asarray(cell_coords[key])[cell_index])
+        coords['cell_index'] = (cell_dim, cell_index.astype(np.int32))
+        attrs = {'horiz_fields': len(not_nan)}
+    else:
+        if not_nan is not None and values.shape[-1] != len(not_nan):
+            # Put it back in, without going through float64
+            full_values = np.full(values.shape[:-1] + (len(not_nan),), np.nan, dtype=np.float32)
+            full_values[..., not_nan] = values
+            values = full_values
+        for key in cell_coords.keys():
+            coords[key] = (cell_dim, np.asarray(cell_coords[key]))
+        attrs = {}
+
+    da = xr.DataArray(np.asarray(values, dtype=np.float32), coords=coords, dims=dims, name=name, attrs=attrs)
+    da.to_netcdf(file_name, format='NETCDF4', encoding=_encoding(da, complevel, chunk_cells))
+
+def is_compact(DS):
+    return 'cell_index' in DS.variables
+
+def _position(DS, da, not_nan):
+    # Position of every requested cell in the compact file (-1: not in the file)
+    cell_index = np.asarray(DS.cell_index.values)
+    # open_mfdataset concatenates the coordinate along time if it differs between the files
+    if cell_index.ndim > 1:
+        cell_index = cell_index.reshape(-1, cell_index.shape[-1])
+        if np.any(cell_index != cell_index[0]):
+            raise ValueError('The compact files of %s have different cell_index values'%da.name)
+        cell_index = cell_index[0]
+    horiz_fields = int(da.attrs.get('horiz_fields', DS.attrs.get('horiz_fields', cell_index.max() + 1)))
+    position = np.full(horiz_fields, -1, dtype=np.int64)
+    position[cell_index] = np.arange(len(cell_index))
+    if not_nan is not None:
+        position = position[not_nan]
+    return position
+
+def _select_cells(values, not_nan, position, out=None):
+    if position is None:
+        selected = values if not_nan is None else values[..., not_nan]
+        if out is None:
+            return selected
+        out[...] = selected
+        return out
+    if out is None:
+        if np.all(position >= 0):
+            return values[..., position]
+        out = np.empty(values.shape[:-1] + (len(position),), dtype=values.dtype)
+    if np.any(position < 0):
+        out[..., position < 0] = np.nan
+    out[..., position >= 0] = values[..., position[position >= 0]]
+    return out
+
+def cell_values(DS, name, not_nan=None, dtype=None, time_chunk=None):
+    '''
+        The values of the variable name as numpy array (with the cells as last dimension), in either layout.
+
+        not_nan:    Boolean mask of the cells to return (on the full grid). Default: All cells of the full grid.
+                    Cells that are not in a compact file are NaN.
+        dtype:      If given (e.g. np.float32), the values are decoded time_chunk time steps at a time into an array
+                    of this dtype. So there is never a full copy in the dtype xarray decodes to (often float64).
+        time_chunk: Number of time steps decoded at once (if the first dimension is time). Default: All.
+    '''
+    da = getattr(DS, name)
+    position = _position(DS, da, not_nan) if is_compact(DS) else None
+    if dtype is None and time_chunk is None:
+        return _select_cells(da.values, not_nan, position)
+
+    dtype = da.dtype if dtype is None else np.dtype(dtype)
+    no_cells = len(position) if position is not None else (da.shape[-1] if not_nan is None else int(np.sum(not_nan)))
+    out = np.empty(da.shape[:-1] + (no_cells,), dtype=dtype)
+    if da.ndim < 2 or da.dims[0] != 'time':
+        _select_cells(da.values, not_nan, position, out)
+        return out
+    time_chunk = da.shape[0] if time_chunk is None else max(int(time_chunk), 1)
+    for start in range(0, da.shape[0], time_chunk):
+        _select_cells(da[start:start + time_chunk].values, not_nan, position, out[start:start + time_chunk])
+    return out
@@ -0,0 +1,218 @@
+import numpy as np
+
+class ConcatenatedDataset():
+    '''
+    Presents several (memory-mapped) arrays as one logical (samples, features) array without copying them.
+    Replaces np.concatenate((np.load(narval.npy), np.transpose(np.load(qubicc.npy)))), which reads and copies
+    both full datasets even if we only need the QUBICC part afterwards.
+
+    Row-range slicing and column selection are zero-copy, they only return a new ConcatenatedDataset.
+    Data is only read when gathering rows with an index array/mask, when iterating over chunks or when
+    calling np.asarray on the dataset.
+    '''
+    def __init__(self, parts, transpose='auto', columns=None, block_size=2**16):
+        '''
+            parts:      List of arrays or paths to .npy-files. Paths are opened with mmap_mode='r'.
+            transpose:  'auto', bool or list of bools (one per part). Whether the part is stored as (features, samples).
+                        With 'auto' we transpose if the part has less rows than columns (as done in the notebooks).
+            columns:    If provided, only these feature columns are returned (in this order).
+            block_size: Number of sorted indices that are read from a part at once when gathering rows.
+        '''
+        if not isinstance(transpose, (list, tuple)):
+            transpose = [transpose]*len(parts)
+        assert len(transpose) == len(parts)
+
+        self.parts = []
+        for part, trans in zip(parts, transpose):
+            if isinstance(part, str):
+                part = np.load(part, mmap_mode='r')
+            if trans == 'auto':
+                trans = part.ndim == 2 and part.shape[0] < part.shape[1]
+            # np.transpose only swaps the strides. Nothing is read from disk yet.
+            self.parts.append(np.transpose(part) if trans else part)
+
+        no_of_features = [part.shape[1:] for part in self.parts]
+        if len(set(no_of_features)) != 1:
+            raise ValueError('All parts need to have the same number of features: %s'%no_of_features)
+
+        self.columns = None if columns is None else np.asarray(columns)
+        self.block_size = block_size
+        # offsets[i] is the first (logical) row of parts[i]
+        self.offsets = np.cumsum([0] + [part.shape[0] for part in self.parts])
+
+    @property
+    def shape(self):
+        feature_shape = self.parts[0].shape[1:]
+        if self.columns is not None:
+            feature_shape = (len(self.columns),) + feature_shape[1:]
+        return (int(self.offsets[-1]),) + feature_shape
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def dtype(self):
+        return np.result_type(*self.parts)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        out = self._gather_range(0, len(self))
+        return out if dtype is None else out.astype(dtype, copy=False)
+
+    def _with_parts(self, parts, columns=None):
+        # New dataset on (already transposed) views of our parts
+        return ConcatenatedDataset(parts, transpose=False, block_size=self.block_size,
+                                   columns=self.columns if columns is None else columns)
+
+    def _select_columns(self, block):
+        if self.columns is None:
+            return block
+        return block[:, self.columns]
+
+    def delete_columns(self, remove_fields):
+        '''
+            Lazy counterpart of np.delete(data, remove_fields, axis=1)
+        '''
+        return self.select_columns(np.delete(np.arange(self.shape[1]), remove_fields))
+
+    def select_columns(self, columns):
+        '''
+            Lazy counterpart of data[:, columns]. A scalar column is kept as a column (like data[:, [column]]).
+        '''
+        columns = np.atleast_1d(np.arange(self.shape[1])[columns])
+        if self.columns is not None:
+            columns = self.columns[columns]
+        return self._with_parts(self.parts, columns=columns)
+
+    def slice_rows(self, start, stop):
+        '''
+            Zero-copy counterpart of data[start:stop]. Only keeps views of the parts that are involved.
+        '''
+        start, stop, _ = slice(start, stop).indices(len(self))
+        stop = max(start, stop)
+        parts = []
+        for k, part in enumerate(self.parts):
+            lo = max(start - self.offsets[k], 0)
+            hi = min(stop - self.offsets[k], part.shape[0])
+            if hi > lo:
+                parts.append(part[lo:hi])
+        if len(parts) == 0:
+            parts = [self.parts[0][:0]]
+        return self._with_parts(parts)
+
+    def _gather_range(self, start, stop):
+        # Read the contiguous rows start:stop into a new array
+        out = np.empty((stop - start,) + self.shape[1:], dtype=self.dtype)
+        for k, part in enumerate(self.parts):
+            lo = max(start - self.offsets[k], 0)
+            hi = min(stop - self.offsets[k], part.shape[0])
+            if hi > lo:
+                pos = self.offsets[k] + lo - start
+                out[pos:pos + hi - lo] = self._select_columns(part[lo:hi])
+        return out
+
+    def take(self, indices):
+        '''
+            Gathers the rows given by indices (int array or boolean mask) into a new array.
+            The indices are processed in sorted blocks. Contiguous blocks are read as a slice.
+            The rows of the returned array are in the order of indices.
+        '''
+        indices = np.asarray(indices)
+        if indices.dtype == bool:
+            indices = np.flatnonzero(indices)
+        indices = np.where(indices < 0, indices + len(self), indices)
+        if indices.size > 0 and (indices.min() < 0 or indices.max() >= len(self)):
+            raise IndexError('Index out of bounds for a dataset with %d samples'%len(self))
+
+        # Sort only if necessary (the fold splits are already sorted)
+        if np.all(indices[1:] >= indices[:-1]):
+            order = None
+            sorted_ind = indices
+        else:
+            order = np.argsort(indices, kind='stable')
+            sorted_ind = indices[order]
+
+        out = np.empty((len(indices),) + self.shape[1:], dtype=self.dtype)
+        # Split the sorted indices according to the parts they belong to
+        bounds = np.searchsorted(sorted_ind, self.offsets)
+        for k, part in enumerate(self.parts):
+            part_ind = sorted_ind[bounds[k]:bounds[k+1]] - self.offsets[k]
+            for b in range(0, len(part_ind), self.block_size):
+                block = part_ind[b:b + self.block_size]
+                pos = bounds[k] + b
+                # Strictly consecutive (sorted indices may contain duplicates, e.g. [3, 3, 5])
+                if np.all(np.diff(block) == 1):
+                    rows = part[block[0]:block[-1] + 1]
+                else:
+                    rows = part[block]
+                out[pos:pos + len(block)] = self._select_columns(rows)
+
+        if order is None:
+            return out
+        # Undo the sorting
+        unsorted_out = np.empty_like(out)
+        unsorted_out[order] = out
+        return unsorted_out
+
+    def __getitem__(self, key):
+        '''
+            data[a:b]            -> ConcatenatedDataset (zero-copy)
+            data[i]              -> np.ndarray (one sample)
+            data[indices]        -> np.ndarray (gathered in sorted blocks)
+            data[rows, columns]  -> As above, with a column selection
+        '''
+        if isinstance(key, tuple):
+            if len(key) != 2:
+                raise IndexError('Only (rows, columns) indexing is supported')
+            rows, columns = key
+            values = self.select_columns(columns)[rows]
+            if np.isscalar(columns):
+                # Drop the column axis, as numpy does
+                values = np.asarray(values)
+                return np.take(values, 0, axis=0 if isinstance(rows, (int, np.integer)) else 1)
+            return values
+        if isinstance(key, slice):
+            if key.step not in (None, 1):
+                return self.take(np.arange(len(self))[key])
+            return self.slice_rows(key.start, key.stop)
+        if isinstance(key, (int, np.integer)):
+            if key < 0:
+                key += len(self)
+            return self.take([key])[0]
+        return self.take(key)
+
+    def iter_chunks(self, rows=None, chunk_size=2**20):
+        '''
+            Yields the rows (all rows or only those given by rows) in consecutive chunks of chunk_size samples.
+        '''
+        if rows is None:
+            for start in range(0, len(self), chunk_size):
+                yield self._gather_range(start, min(start + chunk_size, len(self)))
+        else:
+            rows = np.asarray(rows)
+            if rows.dtype == bool:
+                rows = np.flatnonzero(rows)
+            for start in range(0, len(rows), chunk_size):
+                yield self.take(rows[start:start + chunk_size])
+
+
+def fit_scaler(scaler, data, rows=None, chunk_size=2**20):
+    '''
+        Fits an sklearn scaler that supports partial_fit (e.g. StandardScaler) chunk-wise.
+        Counterpart of scaler.fit(data[rows]) that never materializes data[rows] at once.
+
+        data: np.ndarray, np.memmap or ConcatenatedDataset
+        rows: Indices of the samples to fit the scaler on (e.g. training_folds[i]). By default all samples.
+    '''
+    if not isinstance(data, ConcatenatedDataset):
+        data = ConcatenatedDataset([data], transpose=False)
+    # Start from scratch like scaler.fit does
+    for attr in ['n_samples_seen_', 'mean_', 'var_', 'scale_']:
+        if hasattr(scaler, attr):
+            delattr(scaler, attr)
+    for chunk in data.iter_chunks(rows, chunk_size):
+        scaler.partial_fit(chunk)
+    return scaler
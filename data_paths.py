@@ -0,0 +1,18 @@
+## Root of the data directories ##
+# All data below /pf/b/b309170 (my_work, bd1179_work, scratch) is addressed with data_path, so that the code can run
+# on another data tree, e.g. the synthetic one of synthetic_data.py:
+#   export ICONML_DATA_ROOT=/tmp/iconml_synthetic
+# The root is looked up on every call, so it can also be changed within a running notebook via os.environ.
+
+import os
+
+DEFAULT_DATA_ROOT = '/pf/b/b309170'
+
+def data_root():
+    return os.environ.get('ICONML_DATA_ROOT', DEFAULT_DATA_ROOT)
+
+def data_path(*parts):
+    '''
+        E.g. data_path('my_work/NARVAL/grid_extpar') -> /pf/b/b309170/my_work/NARVAL/grid_extpar
+    '''
+    return os.path.join(data_root(), *parts)
@@ -0,0 +1,170 @@
+## Declarative validation and filtering of the samples in one chunked pass ##
+# The preprocessing notebooks check and filter the samples with several scans over the entire data, every one with
+# boolean temporaries of the size of the data: np.all(np.isnan(df) == False), np.all(df['ta'] > 150),
+# df[df['ta_above'] == 1000], ~((cl > 0) & (clw == 0) & (cli == 0)), zg < 21000. Here, these are rules:
+#
+#   {'name': 'below_21km', 'action': 'keep', 'where': [['zg', '<', 21000]]}
+#   {'name': 'not_nan', 'action': 'check', 'where': [['*', 'notnan']]}
+#   {'name': 'condensate_free', 'action': 'drop', 'where': [['cl', '>', 0], ['clw', '==', 0], ['cli', '==', 0]],
+#    'of': [['cl', '>', 0]]}
+#
+# - where:  Conditions [column, op, value] that all need to hold. column '*' stands for every column (e.g. for the
+#           NaN check), a list of columns means that the condition holds for every one of them.
+# - action: 'keep' keeps the samples matching where, 'drop' removes them, 'check' counts the samples that do not
+#           match as violations (e.g. unphysical values) without removing them
+# - of:     Optional reference population of the share in the report (the condensate-free share is w.r.t. clouds)
+# - optional: The rule is skipped if one of its columns does not exist (e.g. ta_above without neighborhood)
+#
+# The rules apply in their order: Every rule only sees the samples that the previous ones kept (as in the notebooks,
+# where the checks run after the 21km cut). All rules are evaluated on one chunk of the (memory-mapped) columns after
+# the other, in a thread pool. The result is one keep-mask and a data-quality report with the counts per rule.
+#
+#   python data_validation.py --data path/cache_entry --rules rules.json --report report.json
+
+import os
+import glob
+import json
+import time
+import argparse
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+OPS = {'<': np.less, '<=': np.less_equal, '>': np.greater, '>=': np.greater_equal, '==': np.equal,
+       '!=': np.not_equal, 'notnan': lambda x, value: ~np.isnan(x)}
+
+def _rule_columns(rule, columns):
+    # The columns of every condition of the rule
+    result = []
+    for condition in rule['where']:
+        if condition[0] == '*':
+            result.append(list(columns))
+        elif isinstance(condition[0], (list, tuple)):
+            result.append(list(condition[0]))
+        else:
+            result.append([condition[0]])
+    return result
+
+def _matches(data, conditions, condition_columns, start, stop):
+    # Whether all conditions hold for the samples start:stop
+    match = None
+    for condition, names in zip(conditions, condition_columns):
+        op = OPS[condition[1]]
+        value = condition[2] if len(condition) > 2 else None
+        for name in names:
+            result = op(np.asarray(data[name][start:stop]), value)
+            match = result if match is None else np.logical_and(match, result, out=match)
+    return match
+
+def _active_rules(rules, columns):
+    active = []
+    for rule in rules:
+        needed = [name for names in _rule_columns(rule, columns) for name in names]
+        if 'of' in rule:
+            needed += [name for names in _rule_columns({'where': rule['of']}, columns) for name in names]
+        missing = [name for name in needed if name not in columns]
+        if len(missing) > 0:
+            if rule.get('optional'):
+                continue
+            raise KeyError('Rule %s needs the missing columns %s'%(rule['name'], missing))
+        active.append(rule)
+    return active
+
+def _validate_chunk(data, rules, columns, start, stop, mask):
+    keep = np.ones(stop - start, dtype=bool)
+    counts = []
+    for rule in rules:
+        match = _matches(data, rule['where'], _rule_columns(rule, columns), start, stop)
+        considered = int(np.count_nonzero(keep))
+        if 'of' in rule:
+            population = keep & _matches(data, rule['of'], _rule_columns({'where': rule['of']}, columns), start, stop)
+            reference = int(np.count_nonzero(population))
+        else:
+            reference = considered
+        if rule['action'] == 'keep':
+            affected = int(np.count_nonzero(keep & ~match))
+            keep &= match
+        elif rule['action'] == 'drop':
+            affected = int(np.count_nonzero(keep & match))
+            keep &= ~match
+        elif rule['action'] == 'check':
+            affected = int(np.count_nonzero(keep & ~match))
+        else:
+            raise ValueError('Unknown action %s of rule %s'%(rule['action'], rule['name']))
+        counts.append((considered, reference, affected))
+    mask[start:stop] = keep
+    return counts
+
+def validate(data, rules, chunk_size=2**22, workers=4):
+    '''
+        Evaluates the rules in one chunked pass over the data.
+
+        data:    Dictionary of 1D arrays of equal length (e.g. the memory-mapped samples of an InputCache entry).
+                 Arrays whose name starts with an underscore are no columns (e.g. _vert_layers).
+        rules:   List of rules (see above)
+        workers: Number of threads (numpy releases the GIL in the comparisons)
+
+        Returns: keep-mask, report
+    '''
+    t0 = time.time()
+    columns = [name for name in data.keys() if not name.startswith('_')]
+    length = len(data[columns[0]])
+    rules = _active_rules(rules, columns)
+    mask = np.empty(length, dtype=bool)
+    chunks = [(start, min(start + chunk_size, length)) for start in range(0, length, chunk_size)]
+    totals = np.zeros((len(rules), 3), dtype=np.int64)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for counts in executor.map(lambda chunk: _validate_chunk(data, rules, columns, chunk[0], chunk[1], mask),
+                                   chunks):
+            totals += np.array(counts, dtype=np.int64).reshape(len(rules), 3)
+
+    report = OrderedDict([('samples', length), ('kept', int(np.count_nonzero(mask))), ('rules', [])])
+    for rule, (considered, reference, affected) in zip(rules, totals):
+        key = {'keep': 'removed', 'drop': 'removed', 'check': 'violations'}[rule['action']]
+        report['rules'].append(OrderedDict([('name', rule['name']), ('action', rule['action']),
+                                            ('considered', int(considered)), (key, int(affected)),
+                                            ('share', float(affected/reference) if reference > 0 else 0.)]))
+    report['elapsed_time'] = time.time() - t0
+    return mask, report
+
+def violations(report):
+    '''
+        The names of the check-rules with violations
+    '''
+    return [rule['name'] for rule in report['rules'] if rule.get('violations', 0) > 0]
+
+def print_report(report):
+    print('%d samples, %d kept (%.2f%%)'%(report['samples'], report['kept'],
+          100*report['kept']/max(report['samples'], 1)))
+    for rule in report['rules']:
+        affected = rule.get('removed', rule.get('violations'))
+        print('  %-20s %-6s %12d of %12d %s (%.2f%%)'%(rule['name'], rule['action'], affected, rule['considered'],
+              'removed' if 'removed' in rule else 'violations', 100*rule['share']))
+
+def write_report(file_name, report):
+    with open(file_name, 'w') as file:
+        json.dump(report, file, indent=1)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Validate and filter samples with declarative rules')
+    parser.add_argument('--data', required=True, help='Directory of npy-files (one per column) or npz-file')
+    parser.add_argument('--rules', required=True, help='json-file with the list of rules')
+    parser.add_argument('--report', default=None, help='json-file for the data-quality report')
+    parser.add_argument('--mask', default=None, help='npy-file for the keep-mask')
+    parser.add_argument('--workers', type=int, default=4)
+    args = parser.parse_args()
+
+    if os.path.isdir(args.data):
+        data = OrderedDict((os.path.basename(f)[:-4], np.load(f, mmap_mode='r'))
+                           for f in sorted(glob.glob(os.path.join(args.data, '*.npy'))))
+    else:
+        data = OrderedDict(np.load(args.data))
+    with open(args.rules) as file:
+        rules = json.load(file)
+    mask, report = validate(data, rules, workers=args.workers)
+    print_report(report)
+    if args.report is not None:
+        write_report(args.report, report)
+    if args.mask is not None:
+        np.save(args.mask, mask)
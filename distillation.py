@@ -0,0 +1,375 @@
+## Smaller students of a saved cloud cover network: neuron pruning and distillation, with a speed/skill table ##
+# Online, the network runs in every grid column at every time step, so its cost matters as much as its skill. From
+# a saved teacher (e.g. the QUBICC column-based 154->256->256->27 network) and its training/validation data, we build
+#
+# - Pruned students (NumPy, no TensorFlow): Whole hidden neurons with the smallest importance
+#   std(activation)*||outgoing weights|| are removed from every hidden layer (keeping --keep of them). Then layer by
+#   layer, the weights into the remaining neurons are corrected by (ridge) least squares on calibration samples, such
+#   that the pre-activations of the pruned network match those of the teacher (streaming_regression.NormalEquations).
+#   The intercept absorbs the mean contribution of the removed neurons, the rest compensates most of the error.
+# - Distilled students (Keras): Networks with the teacher's depth and activations but --widths units per hidden
+#   layer, trained on the targets alpha*truth + (1 - alpha)*teacher. With --finetune_epochs, the pruned students
+#   are trained the same way afterwards.
+#
+# Every network is saved as h5-file (DenseNetwork.from_h5 layout, BatchNormalization of the teacher is folded) and
+# evaluated in NumPy as in inference_server.py on the validation data. The table (table.csv) contains the hidden
+# widths, the parameters, FLOPs per sample (multiply-add = 2 FLOPs, bias and activation 1 each), the measured
+# samples/s (best of --repeats forward passes of --batch samples in float32, single process) and the R2 w.r.t. the
+# truth and the teacher. profiles.csv contains the means and R2 per vertical layer (per output of the column-based
+# model or per vertical layer given by --vertical_layers_valid) as in compute_R2_and_means.
+#
+# Unscaled inputs are standardized with --infofile (the txt-file of the cell- and neighborhood-based models) or, as
+# the txt-files of the column-based models only refer to qubicc_scalings.txt, with --qubicc_scalings column <fold>.
+# For the column-based model, the COLUMN_REMOVE_FIELDS of inference_server.py are then removed from the inputs.
+#
+#   python distillation.py --teacher saved_models/cross_validation_column_based_fold_3.h5
+#       --qubicc_scalings column 3 --input_train path/input_train.npy
+#       --output_train path/output_train.npy --input_valid path/input_valid.npy --output_valid path/output_valid.npy
+#       --keep 0.75 0.5 0.25 --widths 64 128 --epochs 10 --out distilled
+
+import os
+import time
+import argparse
+import numpy as np
+import pandas as pd
+
+from numpy_attributions import DenseNetwork, ACTIVATIONS
+from streaming_regression import NormalEquations
+from telemetry import stage
+
+def _samples_first(array):
+    # We need to transpose the column-based data. It should have (no_samples, no_features).
+    if array.ndim == 2 and array.shape[0] < array.shape[1]:
+        return array.T
+    return array
+
+def _standardization(infofile=None, qubicc_scalings=None):
+    '''
+        infofile:        txt-file of the model with the means and standard deviations
+        qubicc_scalings: (model_type, fold) of a QUBICC model, whose scalings are read from qubicc_scalings.txt
+    '''
+    remove_fields = None
+    if qubicc_scalings is not None:
+        from inference_server import read_qubicc_scalings, COLUMN_REMOVE_FIELDS
+        (model_type, fold) = qubicc_scalings
+        mean, std = read_qubicc_scalings(model_type, int(fold))
+        if model_type == 'column':
+            remove_fields = COLUMN_REMOVE_FIELDS
+    elif infofile is not None:
+        from my_classes import read_mean_and_std
+        mean, std = read_mean_and_std(infofile)
+    else:
+        return None
+
+    def transform(X):
+        X = np.asarray(X, dtype=np.float64)
+        # Only if the fields have not been removed from the npy-files yet
+        if remove_fields is not None and X.shape[1] == len(mean) + len(remove_fields):
+            X = np.delete(X, remove_fields, axis=1)
+        return ((X - mean)/std).astype(np.float32)
+    return transform
+
+def _chunks(X, transform=None, chunk_size=2**16):
+    for start in range(0, X.shape[0], chunk_size):
+        chunk = np.asarray(X[start:start+chunk_size])
+        yield start, (chunk if transform is None else transform(chunk))
+
+def predict(network, X, transform=None, chunk_size=2**16):
+    out = np.empty((X.shape[0], network.no_outputs), dtype=np.float32)
+    for start, chunk in _chunks(X, transform, chunk_size):
+        out[start:start+len(chunk)] = network.predict(chunk)
+    return out
+
+## Cost ##
+
+def hidden_widths(network):
+    return [W.shape[1] for (W, b, activation) in network.layers[:-1]]
+
+def parameters(network):
+    return int(sum(W.size + b.size for (W, b, activation) in network.layers))
+
+def flops(network):
+    '''
+        FLOPs per sample: A multiply-add counts 2, the bias and the activation 1 each
+    '''
+    return int(sum(2*W.size + W.shape[1] + (activation != 'linear')*W.shape[1] for (W, b, activation) in network.layers))
+
+def samples_per_second(network, batch=4096, repeats=10, seed=0):
+    '''
+        Best throughput of repeats forward passes (float32) of a batch of random standardized samples
+    '''
+    X = np.random.default_rng(seed).normal(size=(batch, network.no_inputs)).astype(np.float32)
+    network.predict(X)
+    best = np.inf
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        network.predict(X)
+        best = min(best, time.perf_counter() - t0)
+    return batch/best
+
+## Skill ##
+
+def r2_profile(pred, reference, vertical_layers=None):
+    '''
+        Means and R2 of pred w.r.t. reference per vertical layer (compute_R2_and_means): For every output of the
+        column-based model, or for every layer in vertical_layers (cell- and neighborhood-based models).
+
+        Returns a DataFrame with the columns layer, reference_mean, pred_mean, r2 and the overall R2
+    '''
+    pred = pred.reshape(len(pred), -1).astype(np.float64)
+    reference = np.asarray(reference, dtype=np.float64).reshape(len(reference), -1)
+    overall = 1 - np.mean((pred - reference)**2)/np.var(reference)
+    rows = []
+    if reference.shape[1] > 1:
+        for k in range(reference.shape[1]):
+            var = np.var(reference[:, k])
+            mse = np.mean((pred[:, k] - reference[:, k])**2)
+            rows.append((k, np.mean(reference[:, k]), np.mean(pred[:, k]), 1 - mse/var if var > 0 else np.nan))
+    elif vertical_layers is not None:
+        for layer in np.unique(vertical_layers):
+            indices = np.where(vertical_layers == layer)[0]
+            var = np.var(reference[indices])
+            mse = np.mean((pred[indices] - reference[indices])**2)
+            rows.append((layer, np.mean(reference[indices]), np.mean(pred[indices]), 1 - mse/var if var > 0 else np.nan))
+    return pd.DataFrame(rows, columns=['layer', 'reference_mean', 'pred_mean', 'r2']), overall
+
+## Pruning ##
+
+def _forward_hidden(layers, X):
+    # Activations of all layers (the input first)
+    activations = [np.asarray(X, dtype=np.float64)]
+    for (W, b, activation) in layers:
+        activations.append(ACTIVATIONS[activation][0](activations[-1] @ W + b))
+    return activations
+
+def neuron_importance(network, X):
+    '''
+        Importance std(activation)*||outgoing weights|| of every hidden neuron on the calibration samples X
+        Returns a list with the importances of every hidden layer
+    '''
+    activations = _forward_hidden(network.layers, X)
+    result = []
+    for l in range(len(network.layers) - 1):
+        a = activations[l+1]
+        W_next = network.layers[l+1][0]
+        result.append(np.std(a, axis=0)*np.linalg.norm(W_next, axis=1))
+    return result
+
+def prune(network, X, keep=0.5, ridge=1e-6, chunk_size=2**14):
+    '''
+        Removes the least important neurons of every hidden layer and refits the weights into the remaining ones (and
+        into the outputs) by least squares on the calibration samples X (standardized, e.g. 10^5 training samples).
+
+        keep:  Fraction of the neurons of every hidden layer that is kept
+        ridge: L2-penalty of the refit (on the standardized activations, see NormalEquations.solve)
+    '''
+    X = np.asarray(X, dtype=np.float64)
+    kept = []
+    for importance in neuron_importance(network, X):
+        k = max(1, int(round(keep*len(importance))))
+        kept.append(np.sort(np.argsort(importance)[::-1][:k]))
+    kept.append(np.arange(network.no_outputs))
+
+    layers = []
+    # Student activations of the previous layer, teacher activations of the current layer
+    (student_a, teacher_a) = (X, X)
+    for l, (W, b, activation) in enumerate(network.layers):
+        teacher_z = teacher_a @ W + b
+        if l == 0:
+            # Same inputs as the teacher: Keep the weights of the remaining neurons
+            (W_new, b_new) = (W[:, kept[0]], b[kept[0]])
+        else:
+            # Fit the correction of the teacher's weights between the remaining neurons. Neurons that are inactive
+            # on all calibration samples keep the teacher's weights, the ridge-penalty shrinks towards them.
+            (W_old, b_old) = (W[np.ix_(kept[l-1], kept[l])], b[kept[l]])
+            residual = teacher_z[:, kept[l]] - (student_a @ W_old + b_old)
+            stats = NormalEquations(student_a.shape[1], len(kept[l]))
+            for start in range(0, len(X), chunk_size):
+                stats.update(student_a[start:start+chunk_size], residual[start:start+chunk_size])
+            coef, intercept = stats.solve(ridge=ridge)
+            (W_new, b_new) = (W_old + coef.T, b_old + intercept)
+        layers.append((W_new.astype(W.dtype), b_new.astype(b.dtype), activation))
+        student_a = ACTIVATIONS[activation][0](student_a @ W_new + b_new)
+        teacher_a = ACTIVATIONS[activation][0](teacher_z)
+    return DenseNetwork(layers)
+
+def save_h5(network, file_name):
+    '''
+        Writes the network in the layout of keras h5-files (Dense layers only) that DenseNetwork.from_h5 reads
+    '''
+    import json
+    import h5py
+    config = {'class_name': 'Sequential', 'config': {'name': 'sequential', 'layers': []}}
+    with h5py.File(file_name, 'w') as file:
+        weights = file.create_group('model_weights')
+        for k, (W, b, activation) in enumerate(network.layers):
+            name = 'dense_%d'%k
+            layer_config = {'name': name, 'units': int(W.shape[1]), 'activation': activation, 'use_bias': True}
+            if k == 0:
+                layer_config['batch_input_shape'] = [None, int(W.shape[0])]
+            config['config']['layers'].append({'class_name': 'Dense', 'config': layer_config})
+            group = weights.create_group(name)
+            group.attrs['weight_names'] = [('%s/kernel:0'%name).encode(), ('%s/bias:0'%name).encode()]
+            group.create_dataset('%s/kernel:0'%name, data=W)
+            group.create_dataset('%s/bias:0'%name, data=b)
+        weights.attrs['layer_names'] = [('dense_%d'%k).encode() for k in range(len(network.layers))]
+        file.attrs['model_config'] = json.dumps(config)
+        file.attrs['backend'] = 'tensorflow'
+
+## Distillation (Keras) ##
+
+def _keras_model(network=None, widths=None, template=None):
+    # Dense network with the weights of network, or a new one with the widths and activations of template
+    import tensorflow as tf
+    from tensorflow.keras import Sequential
+    from tensorflow.keras.layers import Dense
+    activation = lambda name: tf.nn.leaky_relu if name == 'leaky_relu' else name
+    source = network if network is not None else template
+    units = hidden_widths(network) if network is not None else list(widths)
+    model = Sequential()
+    for k, (W, b, name) in enumerate(source.layers):
+        kwargs = {'input_dim': source.no_inputs} if k == 0 else {}
+        model.add(Dense(units[k] if k < len(units) else source.no_outputs, activation=activation(name), **kwargs))
+    if network is not None:
+        model.set_weights([w for (W, b, name) in network.layers for w in (W, b)])
+    return model
+
+def write_targets(teacher, X, y, file_name, alpha=0, transform=None):
+    '''
+        Stores the distillation targets alpha*y + (1 - alpha)*teacher(X) in a npy-file (memory-mapped)
+    '''
+    targets = np.lib.format.open_memmap(file_name, mode='w+', dtype=np.float32, shape=(X.shape[0], teacher.no_outputs))
+    for start, chunk in _chunks(X, transform):
+        targets[start:start+len(chunk)] = teacher.predict(chunk)
+        if alpha > 0:
+            targets[start:start+len(chunk)] *= (1 - alpha)
+            targets[start:start+len(chunk)] += alpha*np.asarray(y[start:start+len(chunk)]).reshape(len(chunk), -1)
+    targets.flush()
+    return np.load(file_name, mmap_mode='r')
+
+def distill(model, X, targets, file_name, epochs=10, batch_size=1024, lr=1e-3, transform=None, seed=10):
+    '''
+        Trains the keras model on the targets, saves it and returns the DenseNetwork
+    '''
+    import tensorflow as tf
+    from hyperparameter_search import memmap_batches
+    tf.random.set_seed(seed)
+    model.compile(loss='mse', optimizer=tf.keras.optimizers.Adam(learning_rate=lr))
+    model.fit(memmap_batches(X, targets, batch_size, np.random.default_rng(seed), transform), epochs=epochs, verbose=2)
+    model.save(file_name)
+    return DenseNetwork.from_h5(file_name)
+
+## The tool ##
+
+def evaluate(name, network, X, y, teacher_pred, transform=None, vertical_layers=None, batch=4096, repeats=10):
+    pred = predict(network, X, transform)
+    row = {'network': name, 'hidden_widths': '-'.join(str(w) for w in hidden_widths(network)),
+           'parameters': parameters(network), 'flops_per_sample': flops(network),
+           'samples_per_second': samples_per_second(network, batch, repeats)}
+    profiles = []
+    for reference_name, reference in [('truth', y), ('teacher', teacher_pred)]:
+        if reference is None:
+            continue
+        profile, overall = r2_profile(pred, reference, vertical_layers)
+        row['r2_%s'%reference_name] = overall
+        profile.insert(0, 'reference', reference_name)
+        profile.insert(0, 'network', name)
+        profiles.append(profile)
+    return row, profiles
+
+def run(teacher_file, input_train, input_valid, output_train=None, output_valid=None, infofile=None,
+        vertical_layers_valid=None, keep=(0.75, 0.5, 0.25), widths=(), epochs=10, finetune_epochs=0, alpha=0,
+        calibration_samples=10**5, ridge=1e-6, out='distilled', batch=4096, repeats=10, max_r2_loss=0.01, seed=10,
+        qubicc_scalings=None):
+    '''
+        Builds the pruned and distilled students, writes table.csv and profiles.csv to out and returns the table
+    '''
+    os.makedirs(out, exist_ok=True)
+    teacher = DenseNetwork.from_h5(teacher_file)
+    transform = _standardization(infofile, qubicc_scalings)
+    X_train = _samples_first(np.load(input_train, mmap_mode='r'))
+    X_valid = _samples_first(np.load(input_valid, mmap_mode='r'))
+    y_train = None if output_train is None else _samples_first(np.load(output_train, mmap_mode='r'))
+    y_valid = None if output_valid is None else _samples_first(np.load(output_valid, mmap_mode='r'))
+    vertical_layers = None if vertical_layers_valid is None else np.load(vertical_layers_valid)
+
+    # Calibration samples: A random subset of the training data
+    rng = np.random.default_rng(seed)
+    indices = np.sort(rng.choice(X_train.shape[0], min(calibration_samples, X_train.shape[0]), replace=False))
+    X_cal = np.asarray(X_train[indices])
+    if transform is not None:
+        X_cal = transform(X_cal)
+
+    students = [('teacher', teacher)]
+    for fraction in keep:
+        with stage('prune', keep=fraction):
+            student = prune(teacher, X_cal, fraction, ridge)
+        file_name = os.path.join(out, 'pruned_%g.h5'%fraction)
+        save_h5(student, file_name)
+        students.append(('pruned_%g'%fraction, student))
+
+    if len(widths) > 0 or finetune_epochs > 0:
+        targets = write_targets(teacher, X_train, y_train, os.path.join(out, 'targets_train.npy'), alpha, transform)
+        if finetune_epochs > 0:
+            for name, student in list(students[1:]):
+                with stage('finetune', network=name):
+                    students.append((name + '_finetuned', distill(_keras_model(student), X_train, targets,
+                                     os.path.join(out, name + '_finetuned.h5'), finetune_epochs,
+                                     transform=transform, seed=seed)))
+        for width in widths:
+            with stage('distill', width=width):
+                model = _keras_model(widths=[width]*len(hidden_widths(teacher)), template=teacher)
+                students.append(('distilled_%d'%width, distill(model, X_train, targets,
+                                 os.path.join(out, 'distilled_%d.h5'%width), epochs, transform=transform, seed=seed)))
+
+    teacher_pred = predict(teacher, X_valid, transform)
+    rows, profiles = [], []
+    for name, network in students:
+        with stage('evaluate', network=name):
+            row, profile = evaluate(name, network, X_valid, y_valid, teacher_pred, transform, vertical_layers,
+                                    batch, repeats)
+        rows.append(row)
+        profiles.extend(profile)
+    table = pd.DataFrame(rows)
+    table['speedup'] = table['samples_per_second']/table['samples_per_second'].iloc[0]
+    table.to_csv(os.path.join(out, 'table.csv'), index=False)
+    pd.concat(profiles).to_csv(os.path.join(out, 'profiles.csv'), index=False)
+
+    print(table.to_string(index=False))
+    # The cheapest network whose R2 is at most max_r2_loss below the teacher's
+    r2 = 'r2_truth' if y_valid is not None else 'r2_teacher'
+    good = table[table[r2] >= table[r2].iloc[0] - max_r2_loss]
+    best = good.sort_values('flops_per_sample').iloc[0]
+    print('Cheapest network with %s >= %.4f: %s (%d FLOPs per sample, %.1fx faster)'%(r2, table[r2].iloc[0] -
+          max_r2_loss, best['network'], best['flops_per_sample'], best['speedup']))
+    return table
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pruned and distilled students of a saved network with a speed/skill table')
+    parser.add_argument('--teacher', required=True, help='h5-file of the teacher')
+    parser.add_argument('--infofile', default=None, help='To standardize the inputs (if the npy-files are unscaled)')
+    parser.add_argument('--qubicc_scalings', nargs=2, default=None, metavar=('MODEL_TYPE', 'FOLD'),
+                        help='Standardize with qubicc_scalings.txt instead, e.g. column 3 for the column-based model')
+    parser.add_argument('--input_train', required=True)
+    parser.add_argument('--output_train', default=None)
+    parser.add_argument('--input_valid', required=True)
+    parser.add_argument('--output_valid', default=None)
+    parser.add_argument('--vertical_layers_valid', default=None, help='For the profiles of the cell-based models')
+    parser.add_argument('--keep', type=float, nargs='*', default=[0.75, 0.5, 0.25],
+                        help='Fractions of the hidden neurons kept by the pruned students')
+    parser.add_argument('--widths', type=int, nargs='*', default=[], help='Hidden widths of the distilled students')
+    parser.add_argument('--epochs', type=int, default=10)
+    parser.add_argument('--finetune_epochs', type=int, default=0)
+    parser.add_argument('--alpha', type=float, default=0, help='Weight of the truth in the distillation targets')
+    parser.add_argument('--calibration_samples', type=int, default=10**5)
+    parser.add_argument('--ridge', type=float, default=1e-6)
+    parser.add_argument('--batch', type=int, default=4096, help='Batch size of the throughput measurement')
+    parser.add_argument('--repeats', type=int, default=10)
+    parser.add_argument('--max_r2_loss', type=float, default=0.01)
+    parser.add_argument('--out', default='distilled')
+    args = parser.parse_args()
+
+    run(args.teacher, args.input_train, args.input_valid, args.output_train, args.output_valid, args.infofile,
+        args.vertical_layers_valid, args.keep, args.widths, args.epochs, args.finetune_epochs, args.alpha,
+        args.calibration_samples, args.ridge, args.out, args.batch, args.repeats, args.max_r2_loss,
+        qubicc_scalings=args.qubicc_scalings)
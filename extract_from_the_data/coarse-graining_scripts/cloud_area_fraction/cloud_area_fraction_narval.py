@@ -3,15 +3,26 @@
 # Reserve 180GB, need ~102 seconds per file
 
 import os
+import sys
 import xarray as xr
 import numpy as np
 
+# Add path with compact_netcdf to sys.path
+sys.path.insert(0, '/pf/b/b309170/workspace_icon-ml/cloud_cover_parameterization/')
+from compact_netcdf import write_cell_data
+from coarse_graining import cloud_area_fraction
+from data_paths import data_path
+# Time, memory and I/O per file: export ICONML_TRACE=<dir>, then python telemetry.py <dir>/trace_*.json
+from telemetry import stage
+
 # Reserve 180GB for NARVAL, 500GB on QUBICC
 SOURCE = 'NARVAL'        # Can be 'NARVAL', 'QUBICC'. To set paths, input grids and variable names.
+COMPRESS = True          # Write float32 with chunked, compressed NetCDF4 encoding (False: uncompressed float64)
+COMPACT_CELLS = False    # Only store the not-nan cells and their cell_index (load_data reads both layouts, but not mixed)
 
 # Define all paths
-path = '/pf/b/b309170/scratch/orig_files'
-base_path = '/pf/b/b309170/my_work/NARVAL'
+path = data_path('scratch/orig_files')
+base_path = data_path('my_work/NARVAL')
 output_path = os.path.join(base_path, 'data_R02B05', 'cl_area_frac')
 dates = os.listdir(path)[1:]
 
@@ -27,7 +38,7 @@ VERT_LAYERS_LR = zh_lr.shape[0] - 1
 VERT_LAYERS_HR = zh_hr.shape[0] - 1
 
 # Requires 90GB, actually 160GB
-weights = np.load(os.path.join('/pf/b/b309170/my_work/NARVAL/grid_extpar', 'weights_NARVAL_R02B10_cloud_area_fraction.npy'))
+weights = np.load(os.path.join(base_path, 'grid_extpar', 'weights_NARVAL_R02B10_cloud_area_fraction.npy'))
 
 for date in dates:    
     files = os.listdir(os.path.join(path, date))
@@ -39,20 +50,28 @@ for date in dates:
         
         print(input_file)
         
+        file_stage = stage('coarse_graining', file=input_file).start()
+        read_stage = stage('read').start()
         DS = xr.open_dataset(os.path.join(path, date, input_file))
         clc = DS.clc.values
         TIME_STEPS = len(DS.time)
+        read_stage.stop()
         
-        # Modify the ndarray. Desired output shape: (1, 31, 4887488). (clc_out = clc, vertically interpolated)
-        clc_out = np.full((TIME_STEPS, VERT_LAYERS_LR, HORIZ_FIELDS), np.nan)
-        
-        for t in range(TIME_STEPS):
-            for j in range(VERT_LAYERS_LR):    
-                clc_out[t][j] = np.max(weights[j]*clc[t], axis=0) #Element-wise product
-
-        clc_new_da = xr.DataArray(clc_out, coords={'time':DS.time, 'height':DS.height[:VERT_LAYERS_LR]}, 
-                                  dims=['time', 'height', 'cells'], name='clc') 
+        # Desired output shape: (1, 31, 4887488). (clc_out = clc, vertically interpolated)
+        interpolate_stage = stage('interpolate').start()
+        clc_out = cloud_area_fraction(clc, weights, dtype=np.float32 if COMPRESS else np.float64)
+        interpolate_stage.stop(samples=TIME_STEPS*HORIZ_FIELDS)
 
         # Save it in a new file
+        write_stage = stage('write').start()
         output_file = 'int_var_' + input_file
-        clc_new_da.to_netcdf(os.path.join(output_path, output_file))
\ No newline at end of file
+        if COMPRESS or COMPACT_CELLS:
+            write_cell_data(clc_out, 'clc', os.path.join(output_path, output_file), 
+                            coords={'time':DS.time, 'height':DS.height[:VERT_LAYERS_LR]}, dims=['time', 'height', 'cells'], 
+                            not_nan=~np.isnan(clc_out[0,-1,:]), compact=COMPACT_CELLS)
+        else:
+            clc_new_da = xr.DataArray(clc_out, coords={'time':DS.time, 'height':DS.height[:VERT_LAYERS_LR]}, 
+                                      dims=['time', 'height', 'cells'], name='clc') 
+            clc_new_da.to_netcdf(os.path.join(output_path, output_file))
+        write_stage.stop()
+        file_stage.stop(samples=TIME_STEPS*HORIZ_FIELDS)
@@ -1,21 +1,32 @@
 # For more documentation see vert_int_method_variability.ipynb
 
 import os
+import sys
 import xarray as xr
 import numpy as np
 
+# Add path with compact_netcdf to sys.path
+sys.path.insert(0, '/pf/b/b309170/workspace_icon-ml/cloud_cover_parameterization/')
+from compact_netcdf import write_cell_data
+from coarse_graining import vertical_interpolation
+from data_paths import data_path
+# Time, memory and I/O per file: export ICONML_TRACE=<dir>, then python telemetry.py <dir>/trace_*.json
+from telemetry import stage
+
 ## Set by the user ##
 GRID_RES = 'R02B05'      # Can be 'R02B05', 'R02B04'. Relevant for both the input and the output grid.
 SOURCE = 'NARVAL'        # Can be 'NARVAL', 'QUBICC', 'HDCP2'. To set paths, input grids and variable names.
                          # For NARVAL additionally check var_path and output_path in lines 70-80s
 VAR_TYPES = 'state_vars' # Can be 'state_vars', 'cloud_vars'. To focus on specific variables.
+COMPRESS = True          # Write float32 with chunked, compressed NetCDF4 encoding (False: uncompressed float64)
+COMPACT_CELLS = False    # Only store the not-nan cells and their cell_index (load_data reads both layouts, but not mixed)
 #####################
 
 # Setting the paths, grids and variables
 # -> ds_zh_lr: Low resolution vertical half levels
 # -> ds_zh_hr: High resolution vertical half levels
 if SOURCE == 'NARVAL':
-    base_path = '/pf/b/b309170/my_work/NARVAL'
+    base_path = data_path('my_work/NARVAL')
     # Variable name of half levels
     height_var = 'z_ifc'
     # Setting var_names (which variables to vertically interpolate)
@@ -51,7 +62,7 @@ elif SOURCE == 'QUBICC':
         ds_zh_lr = xr.open_dataset(os.path.join(base_path, 'grids/zghalf_icon-a_capped.nc'))
         ds_zh_hr = xr.open_dataset(os.path.join(base_path, 'grids/qubicc_l91_zghalf_ml_0015_R02B04_G.nc'))
 elif SOURCE == 'HDCP2': # Actually I'm not working with HDCP2 data at the moment
-    base_path = '/pf/b/b309170/bd1179_work/hdcp2' 
+    base_path = data_path('bd1179_work/hdcp2')
     # Variable name of half levels
     height_var = 'z_ifc'
     # Setting var_names (which variables to vertically interpolate)
@@ -62,7 +73,7 @@ elif SOURCE == 'HDCP2': # Actually I'm not working with HDCP2 data at the moment
     # Setting ds_zh_lr and ds_zh_hr
     assert GRID_RES == 'R02B04' # Not implemented for R02B05
     zghalf_highres_path = os.path.join(base_path, 'grids') # Need 151 vertical layers here, not 76 like in NARVAL.
-    zghalf_lowres_path = os.path.join('/pf/b/b309170/my_work/NARVAL', 'data_var_vertinterp/zg') 
+    zghalf_lowres_path = data_path('my_work/NARVAL', 'data_var_vertinterp/zg') 
     ds_zh_hr = xr.open_dataset(os.path.join(zghalf_highres_path, 'z_ifc_vert_remapcon_3d_coarse_ll_DOM03_ML.nc'))
     ds_zh_lr = xr.open_dataset(os.path.join(zghalf_lowres_path, 'zghalf_icon-a_capped.nc'))
         
@@ -74,8 +85,8 @@ for var_name in var_names:
     
     # Input and output folders
     if SOURCE == 'NARVAL':
-        var_path = os.path.join('/pf/b/b309170/bd1179_work/narval/hcg_files', var_name)
-        output_path = os.path.join('/pf/b/b309170/bd1179_work/narval/hvcg_files', var_name)
+        var_path = data_path('bd1179_work/narval/hcg_files', var_name)
+        output_path = data_path('bd1179_work/narval/hvcg_files', var_name)
 #         var_path = os.path.join(base_path, 'data', var_name) # Usually yes
 #         output_path = os.path.join(base_path, 'data_var_vertinterp', var_name) # Usually yes
     elif SOURCE == 'QUBICC':
@@ -100,6 +111,8 @@ for var_name in var_names:
         if 'int_var_' + input_file in os.listdir(output_path):
             continue
 
+        file_stage = stage('vertical_interpolation', variable=var_name, file=input_file).start()
+        read_stage = stage('read').start()
         # Load files (ds_zh_lr = ds_zhalf_lowres)
         ds = xr.open_dataset(os.path.join(var_path, input_file))
         time_steps = len(ds.time)
@@ -114,30 +127,26 @@ for var_name in var_names:
         var_n = var[:,:,not_nan]
         zh_lr_n = zh_lr[:,not_nan]
         zh_hr_n = zh_hr[:,not_nan]
+        read_stage.stop()
 
-        # Modify the ndarray. Have 31 vertical full levels in the output. (var_out = var, vertically interpolated)
-        var_out = np.full((time_steps, 31, var_n.shape[2]), np.nan) # var_n.shape[2] = Number of not_nans
-
-        # Pretty fast implementation:
-        for t in range(time_steps):
-            for j in range(31):
-                z_u = zh_lr_n[j, :]
-                z_l = zh_lr_n[j+1, :]
-                # weights.shape = var_n[0].shape = high-res_layers x len(not_nan)
-                # len(z_u) = len(z_l) = len(not_nan)
-                weights = np.maximum(np.minimum(z_u, zh_hr_n[:-1]) - np.maximum(zh_hr_n[1:], z_l), 0)
-                var_out[t,j,:] = np.einsum('ij,ji->i', weights.T, var_n[t])/(z_u - z_l)
-                
-
-                # If the low-dim grid extends farther than the high-dim grid, we reinsert nans:
-                should_be_nan = np.where(np.abs((z_u - z_l) - np.sum(weights, axis = 0)) >= 0.5)
-                var_out[t,j,should_be_nan] = np.full(len(should_be_nan), np.nan)
-
-        # Put it back in. Have 20480/81920 horizontal fields in the output.
-        var_new = np.full((time_steps, 31, HORIZ_FIELDS), np.nan)
-        var_new[:,:,not_nan] = var_out
-        var_new_da = xr.DataArray(var_new, coords={'time':ds.time, 'lon':ds.clon, 'lat':ds.clat, 'height':ds.height[:31]}, dims=['time', 'height', 'cell'], name=var_name) 
+        # Have 31 vertical full levels in the output. (var_out = var, vertically interpolated)
+        interpolate_stage = stage('interpolate').start()
+        var_out = vertical_interpolation(var_n, zh_lr_n, zh_hr_n, 31)
+        interpolate_stage.stop(samples=time_steps*var_n.shape[2])
 
         # Save it in a new file
+        write_stage = stage('write').start()
         output_file = 'int_var_' + input_file
-        var_new_da.to_netcdf(os.path.join(output_path, output_file))
+        if COMPRESS or COMPACT_CELLS:
+            # Has 20480/81920 horizontal fields in the output or only the not_nan ones
+            write_cell_data(var_out, var_name, os.path.join(output_path, output_file), 
+                            coords={'time':ds.time, 'height':ds.height[:31]}, dims=['time', 'height', 'cell'], 
+                            not_nan=not_nan, compact=COMPACT_CELLS, cell_coords={'lon':ds.clon, 'lat':ds.clat})
+        else:
+            # Put it back in. Have 20480/81920 horizontal fields in the output.
+            var_new = np.full((time_steps, 31, HORIZ_FIELDS), np.nan)
+            var_new[:,:,not_nan] = var_out
+            var_new_da = xr.DataArray(var_new, coords={'time':ds.time, 'lon':ds.clon, 'lat':ds.clat, 'height':ds.height[:31]}, dims=['time', 'height', 'cell'], name=var_name) 
+            var_new_da.to_netcdf(os.path.join(output_path, output_file))
+        write_stage.stop()
+        file_stage.stop(samples=time_steps*var_n.shape[2])
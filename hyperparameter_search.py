@@ -0,0 +1,432 @@
+## Parallel hyperparameter search of the Dense networks with asynchronous successive halving (ASHA) ##
+# The hyperparameter_tuning_sherpa notebooks train one trial at a time, every trial on a freshly loaded and
+# standardized copy of the data and for the full number of epochs, even if it is clearly worse than the others.
+# Here, many trials run concurrently in CPU worker processes:
+#
+# - The data of the fold (temporal split into sixths as in cross_validation_testing_networks.ipynb) is standardized
+#   once, stored in the InputCache and memory-mapped read-only by all workers. They share the page cache, so the
+#   memory requirement does not grow with the number of workers. Batches are contiguous slices (in shuffled order).
+# - ASHA: A trial is first trained for min_epochs. Whenever a worker is free, the best 1/eta of the trials of a rung
+#   (min_epochs*eta^k epochs) that have not been promoted yet continue training (from the saved model) until the
+#   next rung. Otherwise a new trial is sampled. Hopeless trials are never promoted and cost only min_epochs.
+# - The search space is the one of the sherpa studies (num_units, model_depth, activation_i incl. leaky_relu,
+#   lrinit, epsilon, dropout, l1_reg, l2_reg, bn_i, optimizer) plus the batch_size of the n1 studies.
+# - The trials are written to <output_path>/<YYYY-MM>_<optimizer>_<random>/results.csv after every finished job,
+#   in the format of sherpa's study.save: Trial-ID, Status, Iteration, parameters (sorted), Objective = val_loss.
+#   Every epoch gives an INTERMEDIATE row. The final row of a trial is COMPLETED (reached max_epochs), STOPPED
+#   (not promoted) or FAILED. Unused activation_j (j >= model_depth) are empty as in save_model.
+#
+# Every worker uses --threads TensorFlow threads, so use workers*threads = number of cores. With q3 data:
+#   python hyperparameter_search.py --input_files path/cloud_cover_input_narval.npy path/cloud_cover_input_qubicc.npy
+#       --output_files path/cloud_cover_output_narval.npy path/cloud_cover_output_qubicc.npy --fold 1
+#       --workers 16 --max_trials 200 --min_epochs 1 --max_epochs 9 --eta 3 --timeout 2120
+
+import os
+import json
+import time
+import argparse
+import datetime
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import numpy as np
+import pandas as pd
+from sklearn.preprocessing import StandardScaler
+
+from telemetry import stage
+from input_cache import InputCache, files_fingerprint
+from concatenated_dataset import ConcatenatedDataset, fit_scaler
+from splits import fold_indices
+
+# Up to which model_depth the activation_j/bn_j are sampled (the sherpa studies used [2, 5])
+MAX_DEPTH = 5
+ACTIVATIONS = ['relu', 'elu', 'tanh', 'leaky_relu', 'lrelu']
+OPTIMIZERS = ['adam', 'RMSprop', 'SGD', 'adadelta', 'nadam']
+
+# (name, kind, values or range, scale) as in the sherpa studies
+SEARCH_SPACE = [('num_units', 'ordinal', [16, 32, 64, 128, 256, 512], None),
+                ('model_depth', 'discrete', [2, MAX_DEPTH], None),
+                ('activation_last', 'choice', ['linear', 'my_act_fct'], None),
+                ('lrinit', 'continuous', [1e-4, 1e-0], 'log'),
+                ('epsilon', 'ordinal', [1e-8, 1e-7, 0.1, 1], None),     # Momentum parameter in SGD
+                ('dropout', 'continuous', [0., 0.5], None),
+                ('l1_reg', 'continuous', [0, 0.01], None),
+                ('l2_reg', 'continuous', [0, 0.01], None),
+                ('batch_size', 'ordinal', [128, 256, 512, 1024, 2048], None),
+                ('optimizer', 'choice', OPTIMIZERS, None)] + \
+               [('activation_%d'%j, 'choice', ACTIVATIONS, None) for j in range(1, MAX_DEPTH)] + \
+               [('bn_%d'%j, 'ordinal', [0, 1], None) for j in range(1, MAX_DEPTH)]
+
+def sample_parameters(rng, space=SEARCH_SPACE, fixed=None):
+    '''
+        Draws one random configuration from the search space.
+
+        fixed: Dictionary of parameters that are not varied (e.g. {'optimizer': 'adam'})
+    '''
+    par = {}
+    for (name, kind, values, scale) in space:
+        if kind in ['ordinal', 'choice']:
+            par[name] = values[rng.integers(len(values))]
+        elif kind == 'discrete':
+            par[name] = int(rng.integers(values[0], values[1] + 1))
+        elif scale == 'log':
+            par[name] = float(np.exp(rng.uniform(np.log(values[0]), np.log(values[1]))))
+        else:
+            par[name] = float(rng.uniform(values[0], values[1]))
+    if fixed is not None:
+        par.update(fixed)
+    # Remove those hyperparameters that actually do not appear in the model (as in save_model)
+    for j in range(par['model_depth'], MAX_DEPTH):
+        par['activation_%d'%j] = None
+    return par
+
+## Data ##
+
+def _standardized(input_data, indices, mean, std, dtype, chunk_size):
+    out = np.empty((len(indices), input_data.shape[1]), dtype=dtype)
+    pos = 0
+    for chunk in input_data.iter_chunks(indices, chunk_size):
+        out[pos:pos+len(chunk)] = (chunk - mean)/std
+        pos += len(chunk)
+    return out
+
+def prepare_dataset(cache, input_files, output_files, fold=1, dtype=np.float32, chunk_size=2**20):
+    '''
+        Standardizes the fold according to its training data (as the StandardScaler in the notebooks) and stores
+        input_train, output_train, input_valid, output_valid, mean, std in the cache.
+        Returns the dictionary of (read-only memory-mapped) arrays and the cache key.
+
+        input_files, output_files: Lists of npy-files that are concatenated along the first axis
+    '''
+    params = dict(kind='hyperparameter_search', files=files_fingerprint(list(input_files) + list(output_files)),
+                  input_files=[os.path.abspath(f) for f in input_files],
+                  output_files=[os.path.abspath(f) for f in output_files], fold=fold, dtype=np.dtype(dtype).name)
+    key = cache.get_key(**params)
+
+    def build():
+        input_data = ConcatenatedDataset(input_files, transpose=False)
+        output_data = ConcatenatedDataset(output_files, transpose=False)
+        assert input_data.shape[0] == output_data.shape[0]
+        training, validation = fold_indices(input_data.shape[0], fold)
+        # The StandardScaler of the training data, fitted chunk by chunk
+        scaler = fit_scaler(StandardScaler(), input_data, training, chunk_size)
+        (mean, std) = (scaler.mean_, scaler.scale_)
+        return {'input_train': _standardized(input_data, training, mean, std, dtype, chunk_size),
+                'output_train': output_data.take(training).astype(dtype, copy=False),
+                'input_valid': _standardized(input_data, validation, mean, std, dtype, chunk_size),
+                'output_valid': output_data.take(validation).astype(dtype, copy=False),
+                'mean': mean, 'std': std}
+
+    with stage('prepare_dataset', fold=fold):
+        arrays = cache.get(key)
+        if arrays is None:
+            cache.put(key, build(), params)
+            arrays = cache.get(key)
+    return arrays, key
+
+## Training (in the workers) ##
+
+def my_act_fct(x):
+    # Activation function for the last layer
+    from tensorflow.keras import backend as K
+    return K.minimum(K.maximum(x, 0), 100)
+
+def lrelu(x):
+    from tensorflow import nn
+    return nn.leaky_relu(x, alpha=0.01)
+
+def _init_worker(threads):
+    # Runs once per worker process, before TensorFlow is initialized
+    os.environ['CUDA_VISIBLE_DEVICES'] = ''
+    os.environ['OMP_NUM_THREADS'] = str(threads)
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+
+def _activation(name):
+    from tensorflow import nn
+    return {'leaky_relu': nn.leaky_relu, 'lrelu': lrelu, 'my_act_fct': my_act_fct}.get(name, name)
+
+def build_model(par, no_of_features, no_of_outputs):
+    '''
+        The Dense network of the sherpa notebooks for the parameters par
+    '''
+    import tensorflow as tf
+    from tensorflow.keras import Sequential
+    from tensorflow.keras.layers import Dense, Dropout, BatchNormalization
+    from tensorflow.keras.regularizers import l1_l2
+
+    model = Sequential()
+    # Input layer
+    model.add(Dense(units=par['num_units'], activation=_activation(par['activation_1']), input_dim=no_of_features,
+                    kernel_regularizer=l1_l2(l1=par['l1_reg'], l2=par['l2_reg'])))
+    if par['bn_1'] == 1:
+        model.add(BatchNormalization())
+    # Hidden layers
+    for j in range(2, par['model_depth']):
+        model.add(Dense(units=par['num_units'], activation=_activation(par['activation_%d'%j]),
+                        kernel_regularizer=l1_l2(l1=par['l1_reg'], l2=par['l2_reg'])))
+        model.add(Dropout(par['dropout']))
+        if par['bn_%d'%j] == 1:
+            model.add(BatchNormalization())
+    # Output layer
+    model.add(Dense(no_of_outputs, activation=_activation(par['activation_last']),
+                    kernel_regularizer=l1_l2(l1=par['l1_reg'], l2=par['l2_reg'])))
+    if par['optimizer'] == 'adam':
+        optimizer = tf.keras.optimizers.Adam(learning_rate=par['lrinit'], epsilon=par['epsilon'])
+    elif par['optimizer'] == 'RMSprop':
+        optimizer = tf.keras.optimizers.RMSprop(learning_rate=par['lrinit'], epsilon=par['epsilon'])
+    elif par['optimizer'] == 'SGD':
+        optimizer = tf.keras.optimizers.SGD(learning_rate=par['lrinit'], momentum=par['epsilon'])
+    elif par['optimizer'] == 'adadelta':
+        optimizer = tf.keras.optimizers.Adadelta(learning_rate=par['lrinit'], epsilon=par['epsilon'])
+    elif par['optimizer'] == 'nadam':
+        optimizer = tf.keras.optimizers.Nadam(learning_rate=par['lrinit'], epsilon=par['epsilon'])
+    model.compile(loss='mse', optimizer=optimizer)
+    return model
+
+def memmap_batches(X, y, batch_size, rng=None, transform=None):
+    '''
+        keras Sequence of contiguous slices of the memory-mapped arrays. The order of the batches is shuffled
+        every epoch if rng is given (no shuffling within a batch, which would turn slices into random gathers).
+
+        transform: Optional function applied to the input of every batch (e.g. the standardization)
+    '''
+    from tensorflow.keras.utils import Sequence
+
+    class Batches(Sequence):
+        def __init__(self):
+            super().__init__()
+            self.order = np.arange(int(np.ceil(X.shape[0]/batch_size)))
+            self.on_epoch_end()
+
+        def __len__(self):
+            return len(self.order)
+
+        def __getitem__(self, i):
+            start = self.order[i]*batch_size
+            X_batch = np.asarray(X[start:start+batch_size])
+            if transform is not None:
+                X_batch = transform(X_batch)
+            return X_batch, np.asarray(y[start:start+batch_size])
+
+        def on_epoch_end(self):
+            if rng is not None:
+                rng.shuffle(self.order)
+
+    return Batches()
+
+def train_trial(cache_path, key, trial_id, par, initial_epoch, epochs, work_dir, seed):
+    '''
+        Trains the trial from initial_epoch (reading its saved model) up to epochs. Runs in a worker.
+        Returns the list of (loss, val_loss) of the epochs.
+    '''
+    import gc
+    import tensorflow as tf
+    from tensorflow.keras import backend as K
+    from tensorflow.keras.models import load_model
+
+    arrays = InputCache(cache_path).get(key)
+    tf.random.set_seed(seed + trial_id)
+    rng = np.random.default_rng([seed, trial_id, initial_epoch])
+    model_file = os.path.join(work_dir, 'trial_%d.h5'%trial_id)
+    no_of_outputs = 1 if arrays['output_train'].ndim == 1 else arrays['output_train'].shape[1]
+    if initial_epoch == 0:
+        model = build_model(par, arrays['input_train'].shape[1], no_of_outputs)
+    else:
+        model = load_model(model_file, custom_objects={'my_act_fct': my_act_fct, 'lrelu': lrelu,
+                                                       'leaky_relu': tf.nn.leaky_relu})
+    with stage('trial', trial_id=trial_id, initial_epoch=initial_epoch, epochs=epochs):
+        history = model.fit(memmap_batches(arrays['input_train'], arrays['output_train'], par['batch_size'], rng),
+                            validation_data=memmap_batches(arrays['input_valid'], arrays['output_valid'], 10**5),
+                            initial_epoch=initial_epoch, epochs=epochs, verbose=0)
+    model.save(model_file)
+    # Clear memory after every trial
+    K.clear_session()
+    gc.collect()
+    return list(zip(history.history['loss'], history.history['val_loss']))
+
+## Scheduling ##
+
+class ASHA():
+    '''
+    Asynchronous successive halving (Li et al., 2020) with the rungs min_epochs*eta^k < max_epochs and max_epochs.
+    '''
+    def __init__(self, min_epochs=1, max_epochs=9, eta=3):
+        self.eta = eta
+        self.rungs = []
+        epochs = min_epochs
+        while epochs < max_epochs:
+            self.rungs.append(epochs)
+            epochs *= eta
+        self.rungs.append(max_epochs)
+        # Per rung: trial_id -> val_loss at the end of the rung and the set of promoted trials
+        self.results = [{} for _ in self.rungs]
+        self.promoted = [set() for _ in self.rungs]
+
+    def report(self, trial_id, rung, val_loss):
+        self.results[rung][trial_id] = val_loss
+
+    def next_promotion(self):
+        '''
+            Returns (trial_id, rung) of a trial that is among the best 1/eta of its rung and not promoted yet,
+            starting with the highest rung. None if there is no such trial.
+        '''
+        for rung in range(len(self.rungs) - 2, -1, -1):
+            ranked = sorted(self.results[rung], key=lambda t: self.results[rung][t])
+            for trial_id in ranked[:len(ranked)//self.eta]:
+                if trial_id not in self.promoted[rung]:
+                    self.promoted[rung].add(trial_id)
+                    return trial_id, rung + 1
+        return None
+
+def results_frame(trials):
+    '''
+        sherpa's study.results of the trials: INTERMEDIATE rows for every epoch and the final row of each trial
+    '''
+    rows = []
+    for trial_id, trial in trials.items():
+        objectives = [val_loss for (loss, val_loss) in trial['history']]
+        for epoch, val_loss in enumerate(objectives):
+            rows.append(dict({'Trial-ID': trial_id, 'Status': 'INTERMEDIATE', 'Iteration': epoch + 1},
+                             **trial['parameters'], Objective=val_loss))
+        if trial['status'] is not None:
+            finite = [o for o in objectives if np.isfinite(o)]
+            rows.append(dict({'Trial-ID': trial_id, 'Status': trial['status'], 'Iteration': len(objectives)},
+                             **trial['parameters'], Objective=min(finite) if len(finite) > 0 else np.nan))
+    columns = ['Trial-ID', 'Status', 'Iteration'] + sorted(name for (name, _, _, _) in SEARCH_SPACE) + ['Objective']
+    return pd.DataFrame(rows, columns=columns)
+
+def save_results(out_path, trials):
+    results = results_frame(trials)
+    results.to_csv(os.path.join(out_path, 'results.csv'), index=False)
+    return results
+
+def search(input_files, output_files, fold=1, workers=4, threads=1, max_trials=100, min_epochs=1, max_epochs=9,
+           eta=3, timeout=None, fixed=None, seed=10, cache_path=None, max_bytes=500*1024**3, output_path='.',
+           train=train_trial):
+    '''
+        Runs the ASHA search and returns the directory of the results.
+
+        fixed:   Dictionary of parameters that are not varied (e.g. {'optimizer': 'adam'})
+        timeout: In minutes. No new jobs are started afterwards, the running ones are finished.
+        train:   Function training one job in a worker, see train_trial
+    '''
+    if fold not in [0, 1, 2]:
+        raise ValueError('fold is 0, 1 or 2, not %s'%fold)
+    t0 = time.time()
+    rng = np.random.default_rng(seed)
+    today = str(datetime.date.today())[:7] # YYYY-MM
+    optimizer = 'all' if fixed is None or 'optimizer' not in fixed else fixed['optimizer']
+    # The suffix does not come from rng, so that a second run with the same seed gets its own directory
+    suffix = os.getpid()
+    while True:
+        out_path = os.path.join(output_path, '%s_%s_%d'%(today, optimizer, suffix))
+        try:
+            os.makedirs(out_path)
+            break
+        except FileExistsError:
+            suffix += 1
+    work_dir = os.path.join(out_path, 'models')
+    os.makedirs(work_dir)
+    if cache_path is None:
+        cache_path = os.path.join(output_path, 'cache')
+
+    cache = InputCache(cache_path, max_bytes)
+    arrays, key = prepare_dataset(cache, input_files, output_files, fold)
+    print('Training samples: %d, validation samples: %d, features: %d'%(arrays['input_train'].shape[0],
+          arrays['input_valid'].shape[0], arrays['input_train'].shape[1]))
+    del arrays
+
+    asha = ASHA(min_epochs, max_epochs, eta)
+    settings = dict(input_files=list(input_files), output_files=list(output_files), fold=fold, workers=workers,
+                    threads=threads, max_trials=max_trials, rungs=asha.rungs, eta=eta, timeout=timeout,
+                    fixed=fixed, seed=seed, search_space=SEARCH_SPACE)
+    with open(os.path.join(out_path, 'config.json'), 'w') as file:
+        json.dump(settings, file, indent=1)
+
+    trials = {}
+    running = {}
+    with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'), initializer=_init_worker,
+                             initargs=(threads,)) as executor:
+        while True:
+            timed_out = timeout is not None and time.time() - t0 > 60*timeout
+            while len(running) < workers and not timed_out:
+                job = asha.next_promotion()
+                if job is None:
+                    if len(trials) >= max_trials:
+                        break
+                    trial_id = len(trials) + 1
+                    trials[trial_id] = {'parameters': sample_parameters(rng, fixed=fixed), 'history': [],
+                                        'status': None}
+                    job = (trial_id, 0)
+                (trial_id, rung) = job
+                initial_epoch = 0 if rung == 0 else asha.rungs[rung - 1]
+                future = executor.submit(train, cache_path, key, trial_id, trials[trial_id]['parameters'],
+                                         initial_epoch, asha.rungs[rung], work_dir, seed)
+                running[future] = job
+            if len(running) == 0:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                (trial_id, rung) = running.pop(future)
+                trial = trials[trial_id]
+                try:
+                    trial['history'].extend(future.result())
+                except Exception as e:
+                    print('Trial %d failed: %s'%(trial_id, e))
+                    trial['status'] = 'FAILED'
+                    continue
+                val_loss = trial['history'][-1][1]
+                if not np.isfinite(val_loss):
+                    trial['status'] = 'FAILED'
+                    continue
+                asha.report(trial_id, rung, val_loss)
+                if rung == len(asha.rungs) - 1:
+                    trial['status'] = 'COMPLETED'
+                print('Trial %d, rung %d (%d epochs): val_loss = %.4f'%(trial_id, rung, asha.rungs[rung], val_loss))
+            save_results(out_path, trials)
+
+    # Trials that have not been promoted
+    for trial in trials.values():
+        if trial['status'] is None:
+            trial['status'] = 'STOPPED'
+    results = save_results(out_path, trials)
+    final = results[results['Status'] != 'INTERMEDIATE']
+    with open(os.path.join(out_path, 'README'), 'w') as file:
+        file.write('ASHA search with rungs %s (epochs), eta = %d on fold %d of\n%s\n\n'%(asha.rungs, eta, fold,
+                   '\n'.join(input_files)))
+        file.write('Trials: %s\n'%(final['Status'].value_counts().to_dict()))
+        file.write('Epochs trained: %d (%d without early stopping)\n'%(sum(len(t['history']) for t in trials.values()),
+                   len(trials)*max_epochs))
+        file.write('Runtime: %.1f minutes\n'%((time.time() - t0)/60))
+    if (final['Status'] == 'COMPLETED').any():
+        best = final[final['Status'] == 'COMPLETED'].sort_values('Objective').iloc[0]
+        print('Best trial: %d with val_loss = %.4f (model: %s)'%(best['Trial-ID'], best['Objective'],
+              os.path.join(work_dir, 'trial_%d.h5'%best['Trial-ID'])))
+    print('Results in %s'%out_path)
+    return out_path
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Parallel hyperparameter search (ASHA) of the Dense networks')
+    parser.add_argument('--input_files', nargs='+', required=True)
+    parser.add_argument('--output_files', nargs='+', required=True)
+    parser.add_argument('--fold', type=int, choices=[0, 1, 2], default=1,
+                        help='Validate on the sixths fold and fold+3. 0-based: The default 1 is fold 2 of the notebooks')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=1, help='TensorFlow threads per worker')
+    parser.add_argument('--max_trials', type=int, default=100)
+    parser.add_argument('--min_epochs', type=int, default=1)
+    parser.add_argument('--max_epochs', type=int, default=9)
+    parser.add_argument('--eta', type=int, default=3, help='Only the best 1/eta of a rung are promoted')
+    parser.add_argument('--timeout', type=float, default=None, help='In minutes')
+    parser.add_argument('--optimizer', choices=OPTIMIZERS, default=None, help='Fix the optimizer')
+    parser.add_argument('--seed', type=int, default=10)
+    parser.add_argument('--cache', default=None)
+    parser.add_argument('--output_path', default='sherpa_results')
+    args = parser.parse_args()
+
+    search(args.input_files, args.output_files, args.fold, args.workers, args.threads, args.max_trials,
+           args.min_epochs, args.max_epochs, args.eta, args.timeout,
+           None if args.optimizer is None else {'optimizer': args.optimizer}, args.seed, args.cache,
+           output_path=args.output_path)
@@ -0,0 +1,33 @@
+## iconml: The code the notebooks and tools share ##
+# The submodules only import what they need, heavy dependencies (xarray, TensorFlow) when they are used:
+#
+#   iconml.io:        Reading the data (load_data, get_data_files) and the files that come with the models
+#   iconml.features:  Building the input features (above_and_below, surface_field)
+#   iconml.metrics:   Evaluating the models (compute_R2_and_means)
+#   iconml.baselines: The Sundqvist scheme
+#   iconml.training:  Training utilities that need TensorFlow (TimeOut)
+#
+# The submodules and their functions are loaded when they are accessed first (import iconml; iconml.load_data(...)).
+
+import importlib
+
+_SUBMODULES = ['io', 'features', 'metrics', 'baselines', 'training']
+
+_ATTRIBUTES = {'write_infofile': 'io', 'read_mean_and_std': 'io', 'get_data_files': 'io', 'plan_memory': 'io',
+               'load_variables_concurrently': 'io', 'load_data': 'io', 'load_all_data': 'io',
+               'above_and_below': 'features', 'surface_field': 'features',
+               'compute_R2_and_means': 'metrics',
+               'simple_sundqvist_scheme_rh': 'baselines', 'simple_sundqvist_scheme': 'baselines',
+               'TimeOut': 'training'}
+
+def __getattr__(name):
+    if name in _SUBMODULES:
+        return importlib.import_module('%s.%s'%(__name__, name))
+    if name in _ATTRIBUTES:
+        value = getattr(importlib.import_module('%s.%s'%(__name__, _ATTRIBUTES[name])), name)
+        globals()[name] = value
+        return value
+    raise AttributeError('module %r has no attribute %r'%(__name__, name))
+
+def __dir__():
+    return sorted(list(globals().keys()) + _SUBMODULES + list(_ATTRIBUTES.keys()))
@@ -0,0 +1,35 @@
+## Cloud cover schemes the networks are compared with ##
+# The Sundqvist scheme (formerly in my_classes.py) as a function of relative humidity or of qv, T and p.
+
+import numpy as np
+
+def simple_sundqvist_scheme_rh(r, p, ps=101325):
+    '''
+        As a function of relative humidity [0, 1] and pressure [Pa]
+        Furthermore ps is surface pressure (on average 101325 Pa)
+        Output is cloud cover in [0, 1]
+    '''
+    rsat = 1
+    r0_top = 0.8
+    r0_surf = 0.968
+    n = 2
+    r0 = r0_top + (r0_surf - r0_top)*np.exp(1-(ps/p)**n)
+    
+    c = 0
+    if r > r0:
+        # r can actually slightly exceed 1 
+        c = 1 - np.sqrt((np.minimum(r, 1) - rsat)/(r0 - rsat))
+    return c
+
+def simple_sundqvist_scheme(qv, T, p, ps=101325):
+    '''
+        As a function of specific humidity [kg/kg], temperature [K] and pressure [Pa]
+        Furthermore ps is surface pressure (on average 101325 Pa)
+        Output is cloud cover in [0, 1]
+    '''
+    # Computing relative humidity r 
+    # (https://earthscience.stackexchange.com/questions/2360/how-do-i-convert-specific-humidity-to-relative-humidity)
+    T0 = 273.15
+    r = 0.00263*p*qv*np.exp((17.67*(T-T0))/(T-29.65))**(-1)
+    
+    return simple_sundqvist_scheme_rh(r, p, ps)
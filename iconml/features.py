@@ -0,0 +1,28 @@
+## Building the input features of the cell-, column- and neighborhood-based models ##
+# Operations on fields of shape (time steps, vertical layers, cells) that the preprocessing and the evaluation share.
+
+import numpy as np
+
+def above_and_below(var_array, factor=1):
+    '''
+        The values of the grid cells above and below (for the neighborhood-based models).
+
+        var_array: 3D tensor
+        factor:    A nan above is replaced by factor times the value of the grid cell (3/4 for the NARVAL pressure)
+    '''
+    (TIME_STEPS, _, HORIZ_FIELDS) = var_array.shape
+    # 1000 is a value that cannot be attained physically and serves as our way of checking whether the grid cell is
+    # at the model top
+    above = (np.insert(var_array, obj=0, values=1000*np.ones((TIME_STEPS, HORIZ_FIELDS)), axis=1))[:, :-1, :]
+    # Replace by the entry from the same cell if the one above is nan.
+    nan_indices = np.where(np.isnan(above))
+    above[nan_indices] = factor*above[nan_indices[0], nan_indices[1]+1, nan_indices[2]]
+    # Below is the same value as the grid cell for surface-closest layer
+    below = (np.append(var_array, values=var_array[:, -1:, :], axis=1))[:, 1:, :]
+    return above, below
+
+def surface_field(var_array):
+    '''
+        The values of the surface-closest layer, repeated in the vertical (e.g. the surface temperature)
+    '''
+    return np.repeat(np.expand_dims(var_array[:, -1, :], axis=1), var_array.shape[1], axis=1)
@@ -0,0 +1,652 @@
+## Reading the data and the files that come with the models ##
+# load_data/load_all_data (NARVAL, QUBICC), get_data_files, write_infofile and read_mean_and_std (formerly in
+# my_classes.py). xarray (and the NetCDF backends) are only imported once data is actually read, so that e.g. reading
+# the scaling of a model does not pay for them.
+
+import os
+import glob
+import time
+import numpy as np
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from data_paths import data_path
+from telemetry import stage, profiled
+
+def write_infofile(file, input_and_output_vars, input_vars, model_path, output_path, NUM, data_files=None):
+    '''
+    Writes a bunch of information concerning the model and data into file
+    It even copies the scaler parameters from a previously written file model_path/scaler.txt
+    data_files: The preprocessed files if they are not the six split files (e.g. a split manifest, see splits.py)
+    '''
+    # How to use the model
+    file.write('How to use the model:\n')
+    file.write('model = tensorflow.keras.models.load_model(filename+\'.h5\')\n')
+    file.write('model.predict(scaled input data)\n\n')
+    # What kind of input/output variables are expected
+    file.write('Input/Output\n')
+    file.write('------------\n')
+    file.write('Input and output variables:\n')
+    file.write(input_and_output_vars)
+    file.write('\nThe (order of) input variables:\n')
+    file.write(input_vars)
+    # Scaling
+    file.write('\n\nScaling\n')
+    file.write('-------\n')
+    with open(os.path.join(model_path, 'scaler_%d.txt'%NUM), 'r') as scaler_file:
+        [file.write(line) for line in scaler_file.readlines()]
+    file.write('\n=> Apply this standard scaling to (only) the input data before processing.\n\n')
+    # Preprocessed data
+    file.write('Preprocessed data\n')
+    file.write('-----------------\n')
+    if data_files is not None:
+        [file.write(file_name + '\n') for file_name in data_files]
+        file.write('\n')
+    else:
+        file.write(output_path + '/cloud_cover_input_train_%d.npy\n'%NUM)
+        file.write(output_path + '/cloud_cover_input_valid_%d.npy\n'%NUM)
+        file.write(output_path + '/cloud_cover_output_train_%d.npy\n'%NUM)
+        file.write(output_path + '/cloud_cover_output_valid_%d.npy\n'%NUM)
+        file.write(output_path + '/cloud_cover_input_test_%d.npy\n'%NUM)
+        file.write(output_path + '/cloud_cover_output_test_%d.npy\n\n'%NUM)
+    # Model performance
+    file.write('Model\n')
+    file.write('-----\n')
+    
+def read_mean_and_std(file_path):
+    '''
+    Reads the text-file provided by file_path. From it, we extract the means and the standard deviations of the features.
+    Those were saved during the preprocessing step, when the training data was standardized.
+    '''
+    mean = []
+    std = []
+    with open(file_path) as file:
+        lines = file.readlines()
+        for i in range(len(lines)):
+            if lines[i].startswith('Standard Scaler mean values') or lines[i].startswith('The mean values'):
+                start_mean = i+1
+            if lines[i].startswith('Standard Scaler standard deviation') or lines[i].startswith('The standard deviation'):
+                end_mean = i-1
+                start_std = i+1
+            if lines[i].startswith('=> Apply this standard'):
+                end_std = i-1    
+                
+        # Extract the mean as an array
+        for k in range(start_mean, end_mean+1):
+            # Remove the brackets first. Lines can also start with '[ ' or contain multiple spaces.
+            b = np.array(lines[k].translate({ord(i): None for i in '[]'}).split(), dtype=float)
+            mean = np.concatenate((mean, b))
+
+        # Extract the standard deviation as an array
+        for k in range(start_std, end_std+1):
+            b = np.array(lines[k].translate({ord(i): None for i in '[]'}).split(), dtype=float)
+            std = np.concatenate((std, b))
+    return mean, std
+    
+def get_data_files(source, days, vert_interp=True, resolution='R02B04', order_of_vars=None):
+    '''
+        Returns the files (or glob patterns of files) that load_data reads for the given arguments.
+        
+        source, days, vert_interp, resolution: See load_data
+        order_of_vars: If provided, only the hourly 3D input variables in order_of_vars are included.
+        
+        returns: An OrderedDict with the variables as keys and the file path/glob pattern as values.
+                 The key 'not_nan' refers to the file from which we infer the cells to keep.
+    '''
+    files = OrderedDict()
+    
+    ############
+    ## NARVAL ##
+    ############
+    if source == 'narval':
+        if vert_interp == True and resolution == 'R02B04':
+            path = data_path('my_work/NARVAL/data_var_vertinterp/')
+#             surface_nearest_layer = 30
+            file_name_prefix = 'int_var_'
+            height_variable_name = 'zg'
+            height_file_location = 'zg/zg_icon-a_capped.nc'
+        elif vert_interp == False and resolution == 'R02B04':
+            path = data_path('my_work/NARVAL/data/')
+#             surface_nearest_layer = 74
+            file_name_prefix = ''
+            height_variable_name = 'zf'
+            height_file_location = 'z_ifc/zf_R02B04_NARVALI_fg_DOM01.nc'
+        elif resolution == 'R02B05':
+            path = data_path('my_work/NARVAL/data_var_vertinterp_R02B05/')
+            file_name_prefix = 'int_var_'
+            height_variable_name = 'zg'
+            height_file_location = 'zg/zg_icon-a_capped.nc'
+            
+        # Grid path and name for the Coriolis Parameter
+        grid_path = data_path('my_work/NARVAL/grid_extpar')
+        if resolution == 'R02B04':
+            grid_name = 'icon_grid_0005_R02B04_G.nc'
+        elif resolution == 'R02B05':
+            grid_name = 'icon_grid_0019_R02B05_G.nc'
+            
+        # Which days should we load
+        if days=='all':
+            load_days = '_'+resolution+'_*'
+        elif days=='august':
+            load_days = '_'+resolution+'_NARVALII_201608*'
+        elif days=='dec_1st':
+            load_days = '_'+resolution+'_NARVALI_2013120100'
+        else:
+            raise ValueError('The entered days are invalid.')
+            
+        files['not_nan'] = path+'clc/'+file_name_prefix+'clc_'+resolution+'_NARVALI_2013123100_cloud_DOM01_0034.nc'
+        
+        ## Hourly data
+        #3D input
+        if resolution=='R02B04':
+            vars = ['qv', 'qc', 'qi', 'temp', 'pres', 'rho']
+        elif resolution=='R02B05':
+            vars = ['qv', 'qc', 'qi', 'temp', 'pres', 'rho', 'u', 'v']
+        for i in range(len(vars)):
+            if order_of_vars is None or vars[i] in order_of_vars:
+                files[vars[i]] = path+vars[i]+'/'+file_name_prefix+vars[i]+load_days+'_fg_DOM01_00*.nc'
+                
+        ## Time-invariant input
+        files[height_variable_name] = path+height_file_location
+        files['coriolis'] = os.path.join(grid_path, grid_name)
+        files['fr_lake'] = path+'../grid_extpar/fr_lake_'+resolution+'_NARVAL_fg_DOM01.nc'
+        files['fr_land'] = path+'../grid_extpar/fr_land_'+resolution+'_NARVAL_fg_DOM01.nc'
+        if vert_interp == False:
+            files['fr_seaice'] = path+'fr_seaice/fr_seaice'+load_days+'_fg_DOM01_00*.nc'
+            
+        ## Output
+        for var in ['clc', 'cl_area']:
+            files[var] = path+var+'/'+file_name_prefix+var+load_days+'_cloud_DOM01_00*.nc'
+    
+    ############
+    ## QUBICC ##
+    ############
+    if source == 'qubicc':
+        if resolution == 'R02B04':
+            path = data_path('my_work/QUBICC/data_var_vertinterp/')
+#             surface_nearest_layer = 74
+#             file_name_prefix = ''
+            height_filename = 'zg_icon-a_capped.nc'
+        elif resolution == 'R02B05':
+            path = data_path('my_work/QUBICC/data_var_vertinterp_R02B05/')
+#             file_name_prefix = 'int_var_'
+            height_filename = 'zg_icon-a_capped_R02B05.nc'
+    
+        # Grid path and name for the Coriolis Parameter
+        grid_path = data_path('my_work/QUBICC/grids')
+        if resolution == 'R02B04':
+            grid_name = 'icon_grid_0013_R02B04_G.nc'
+        elif resolution == 'R02B05':
+            grid_name = 'icon_grid_0019_R02B05_G.nc'        
+            
+        # Which days should we load
+        if days=='all':
+            load_days = '20041*.nc'
+        elif days=='nov_20s':
+            load_days = '2004112*.nc'
+        elif days=='nov_2nd':
+            load_days = '20041102*.nc'
+        elif days=='all_hcs':
+            load_days = '*.nc'
+        else:
+            raise ValueError('The entered days are invalid.')
+        
+        files['not_nan'] = path+'cl/int_var_hc2_02_p1m_cl_ml_20041107T100000Z_'+resolution+'.nc'
+        
+        ## Time-invariant input
+        files['zg'] = data_path('my_work/QUBICC/grids/')+height_filename
+        files['coriolis'] = os.path.join(grid_path, grid_name)
+        files['fr_lake'] = path+'fr_lake/fr_lake_'+resolution+'.nc'
+        if resolution == 'R02B04':
+            files['fr_seaice'] = path+'fr_seaice/fr_seaice_'+resolution+'.nc'
+        files['fr_land'] = path+'fr_land/fr_land_'+resolution+'.nc'
+        
+        ## Hourly data
+        #3D data: All possible input variables
+        vars = ['hus', 'clw', 'cli', 'ta', 'pfull', 'rho', 'ua', 'va', 'cl', 'cl_area']
+        for i in range(len(vars)):
+            if order_of_vars is None or vars[i] in order_of_vars:
+                files[vars[i]] = path+vars[i]+'/int_var_*_02_p1m_'+vars[i]+'_ml_'+load_days
+                
+    return files
+
+def _file_times(file_name):
+    import xarray as xr
+    with xr.open_dataset(file_name) as DS:
+        return DS.time.values
+
+def _read_file_into(out, file_name, nc_name, not_nan, rows, file_rows, time_chunk=None):
+    # Reads one file of a variable into its rows of the preallocated array out
+    import xarray as xr
+    from compact_netcdf import cell_values
+    t0 = time.time()
+    with xr.open_dataset(file_name) as DS:
+        values = cell_values(DS, nc_name, not_nan, out.dtype, time_chunk)
+    out[rows] = values[file_rows]
+    return values.nbytes, time.time() - t0
+
+def _without_time_step(DS, skip_time_index):
+    # Leaves a time step out before anything is decoded. Unlike np.delete on the loaded array, this needs no copy.
+    if skip_time_index is None:
+        return DS
+    return DS.isel(time=np.delete(np.arange(DS.sizes['time']), skip_time_index))
+
+def plan_memory(variables, not_nan, memory_budget, dtype=None, readers=1):
+    '''
+        Checks whether the variables fit into the memory budget before anything is read and plans how many time
+        steps are decoded at once (the time_chunk of cell_values). Only reads the headers of the files.
+        
+        variables:     List of (glob pattern, name of the variable in the NetCDF files)
+        not_nan:       Boolean mask of the horizontal cells to keep
+        memory_budget: In GB
+        dtype:         The dtype of the returned arrays (default: the dtype xarray decodes to)
+        readers:       Number of files that are decoded at the same time (max_workers)
+        
+        returns: time_chunk. Raises a MemoryError if the variables do not fit.
+    '''
+    import xarray as xr
+    no_cells = int(np.sum(not_nan))
+    (needed, per_step) = (0, 0)
+    for (pattern, nc_name) in variables:
+        DS = xr.open_mfdataset(pattern, combine='by_coords')
+        da = getattr(DS, nc_name)
+        out_dtype = da.dtype if dtype is None else np.dtype(dtype)
+        needed += int(np.prod(da.shape[:-1]))*no_cells*out_dtype.itemsize
+        # One decoded time step (of all cells in the file) and its selected cells
+        per_step = max(per_step, int(np.prod(da.shape[1:]))*da.dtype.itemsize + 
+                                 int(np.prod(da.shape[1:-1]))*no_cells*out_dtype.itemsize)
+    budget = memory_budget*1e9
+    if needed + readers*per_step > budget:
+        raise MemoryError('The requested variables need %.1f GB (plus %.2f GB per decoded time step), but the memory '
+                          'budget is %.1f GB. Load fewer variables/days or use dtype=np.float32.'%(needed/1e9, 
+                          per_step/1e9, memory_budget))
+    time_chunk = int((budget - needed)//(readers*per_step))
+    print('Memory plan: %.1f GB of data, %d time steps decoded at once'%(needed/1e9, time_chunk))
+    return time_chunk
+
+def load_variables_concurrently(variables, not_nan, max_workers, skip_time_index=None, dtype=np.float32, 
+                                time_chunk=None):
+    '''
+        Reads the hourly variables, and the files within every variable, concurrently in a thread pool.
+        Every file is written directly into a preallocated array (ordered by time, like
+        xr.open_mfdataset(..., combine='by_coords')), so that the peak memory does not double.
+        
+        variables:       OrderedDict name -> (glob pattern, name of the variable in the NetCDF files)
+        not_nan:         Boolean mask of the horizontal cells to keep
+        skip_time_index: Index of a time step (of the sorted time steps) to leave out, see load_data
+        time_chunk:      Number of time steps of a file that are decoded at once (see plan_memory)
+        
+        returns: An OrderedDict name -> array of shape (time steps, vertical layers, cells)
+    '''
+    import xarray as xr
+    from compact_netcdf import cell_values
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # 1) The time steps of all files (only reads the headers)
+        file_names = OrderedDict((name, sorted(glob.glob(variables[name][0]))) for name in variables.keys())
+        for name in file_names.keys():
+            if len(file_names[name]) == 0:
+                raise FileNotFoundError('No files match %s'%variables[name][0])
+        times = OrderedDict((name, list(executor.map(_file_times, file_names[name]))) for name in file_names.keys())
+        
+        # 2) Preallocate and read all files of all variables
+        data = OrderedDict()
+        futures = OrderedDict()
+        t0 = time.time()
+        for name in variables.keys():
+            all_times = np.sort(np.concatenate(times[name]))
+            keep = np.ones(len(all_times), dtype=bool)
+            if skip_time_index is not None:
+                keep[skip_time_index] = False
+            # Position of every time step in the output (-1: left out)
+            position = np.where(keep, np.cumsum(keep) - 1, -1)
+            with xr.open_dataset(file_names[name][0]) as DS:
+                shape = cell_values(DS, variables[name][1], not_nan).shape[1:]
+            data[name] = np.empty((np.sum(keep),) + shape, dtype=dtype)
+            futures[name] = []
+            for file_name, file_times in zip(file_names[name], times[name]):
+                rows = position[np.searchsorted(all_times, file_times)]
+                futures[name].append(executor.submit(_read_file_into, data[name], file_name, variables[name][1],
+                                                     not_nan, rows[rows >= 0], np.flatnonzero(rows >= 0), time_chunk))
+        
+        # 3) Log the bytes read and the timings per variable (read time summed over the files and wall time until
+        # all files of the variable were read)
+        for name in futures.keys():
+            results = [future.result() for future in futures[name]]
+            print('%s: %d files, %.1f MB read in %.1fs, done after %.1fs'%(name, len(results), 
+                  sum([r[0] for r in results])/1e6, sum([r[1] for r in results]), time.time() - t0))
+    return data
+
+@profiled('load_data')
+def load_data(source, days, vert_interp=True, resolution='R02B04', order_of_vars=None, max_workers=None, dtype=None, 
+              memory_budget=None, return_not_nan=False):
+    '''
+        Loads data from the NARVAL or QUBICC experiment and stores it in a dictionary.
+        
+        source:        narval, qubicc
+        days:          all, august, dec_1st, nov_2nd, nov_20s, all_hcs
+        vert_interp:   Whether the data is vertically interpolated. Only needs to be specified for NARVAL with 'R02B04'
+        resolution:    'R02B04' or 'R02B05'
+        order_of_vars: If provided, the returned dictionary will have the variables in the specified order.
+                       The cheaper variables (zg, coriolis, fr_lake, fr_land) are always loaded and discarded later.
+                       For QUBICC 'clw' is also always initially loaded.
+                       The more expensive variables (temp, pres, ...) are only loaded if they are included in order_of_vars
+        max_workers:   If provided, the hourly 3D variables (and their files) are read concurrently by max_workers
+                       threads into preallocated float32 arrays (see load_variables_concurrently). 
+                       Otherwise they are read one after another.
+        dtype:         If provided (e.g. np.float32), all variables are returned in this dtype. The hourly variables are
+                       decoded directly into it, without a full float64 copy. With max_workers the default is float32.
+        memory_budget: If provided (in GB), we first check whether the requested variables fit (and raise a 
+                       MemoryError otherwise) and decode as many time steps at once as the rest of the budget allows 
+                       (see plan_memory).
+        return_not_nan: Also return the not_nan mask. The data only contains these horizontal cells of the grid, 
+                       np.flatnonzero(not_nan) are their indices on the ICON grid.
+        
+        returns: A dictionary containing the data with the features as keys (and the not_nan mask).
+    '''
+    import xarray as xr
+    from compact_netcdf import cell_values
+    data_dict = OrderedDict()
+    time_chunk = None
+    files = get_data_files(source, days, vert_interp, resolution, order_of_vars)
+    
+    ############
+    ## NARVAL ##
+    ############
+    # R02B04 yields default (order of) variables: 
+    # ['qv', 'qc', 'qi', 'temp', 'pres', 'rho', 'zg'/'zf', 'Coriolis', 'fr_lake', 'fr_land', ('fr_seaice', ) 'clc', 'cl_area']
+    # R02B05 yields default (order of) variables:
+    # ['qv', 'qc', 'qi', 'temp', 'pres', 'rho', 'u', 'v', 'zg', 'coriolis', 'fr_lake', 'fr_land', 'clc', 'cl_area']
+    if source == 'narval':
+        if vert_interp == False and resolution == 'R02B04':
+            height_variable_name = 'zf'
+        else:
+            height_variable_name = 'zg'
+            
+        # Get not_nan quickly 
+        DS = xr.open_dataset(files['not_nan'])
+        da = cell_values(DS, 'clc')
+        not_nan = ~np.isnan(da[0,-1,:]) #The surface-nearest layer shall not contain NAN-values
+            
+        ## Hourly data
+        #3D input
+        if resolution=='R02B04':
+            vars = ['qv', 'qc', 'qi', 'temp', 'pres', 'rho']
+        elif resolution=='R02B05':
+            vars = ['qv', 'qc', 'qi', 'temp', 'pres', 'rho', 'u', 'v']
+        hourly = OrderedDict((var, (files[var], 'clc' if var == 'cl_area' else var)) 
+                             for var in vars + ['clc', 'cl_area'] if var in files)
+        if memory_budget is not None:
+            time_chunk = plan_memory(hourly.values(), not_nan, memory_budget, 
+                                     np.float32 if (dtype is None and max_workers is not None) else dtype,
+                                     1 if max_workers is None else max_workers)
+        #There's a problem with int_var_*_R02B05_NARVALII_2016082900_fg_DOM01_0016.nc.
+        skip_time_index = 1651 if (resolution=='R02B05' and days=='all') else None
+        if max_workers is not None:
+            # Read all hourly 3D variables (input and output) concurrently
+            if resolution=='R02B05' and days=='august':
+                raise ValueError('Please implement the exclusion of int_var_*_R02B05_NARVALII_2016082900_fg_DOM01_0016.nc first!')
+            with stage('concurrent_read', workers=max_workers) as s:
+                hourly_data = load_variables_concurrently(hourly, not_nan, max_workers, skip_time_index,
+                                                          np.float32 if dtype is None else dtype, time_chunk)
+                s.samples = sum([hourly_data[var].size for var in hourly_data.keys()])
+        for i in range(len(vars)):
+            if vars[i] in files and max_workers is not None:
+                data_dict[vars[i]] = hourly_data[vars[i]]
+            elif vars[i] in files:
+                print(vars[i])
+                with stage(vars[i]) as s:
+                    DS = _without_time_step(xr.open_mfdataset(files[vars[i]], combine='by_coords'), skip_time_index)
+                    # Reads the full and the compact layout of compact_netcdf
+                    da = cell_values(DS, vars[i], not_nan, dtype, time_chunk)
+                    s.samples = da.size
+                if resolution=='R02B05' and days=='august':
+                    raise ValueError('Please implement the exclusion of int_var_*_R02B05_NARVALII_2016082900_fg_DOM01_0016.nc first!')
+                data_dict[vars[i]] = da
+                
+
+        ## Time-invariant input
+        #zg/zf
+        DS = xr.open_dataset(files[height_variable_name])
+        data_dict[height_variable_name] = cell_values(DS, height_variable_name, not_nan)
+        
+        #Coriolis Parameter
+        DS = xr.open_dataset(files['coriolis'])
+        lat_cell_center = DS.lat_cell_centre.values
+        # Rotation rate of the earth
+        Omega = 7.2921*10**(-5) # in 1/s
+        # Varies between -0.0001458 and 0.0001458
+        data_dict['coriolis'] = (2*Omega*np.sin(lat_cell_center))[not_nan]
+        
+        #fr_lake
+        DS = xr.open_dataset(files['fr_lake'])
+        da = DS.FR_LAKE.values
+        data_dict['fr_lake'] = da[not_nan]
+        
+        #fr_land
+        DS = xr.open_dataset(files['fr_land'])
+        da = DS.fr_land.values
+        data_dict['fr_land'] = da[not_nan] 
+        
+        if vert_interp == False:
+            #fr_seaice
+            DS = xr.open_mfdataset(files['fr_seaice'], combine='by_coords')
+            da = DS.fr_seaice.values
+            data_dict['fr_seaice'] = da[:, not_nan]
+           
+        ## Output
+        #clc, cl_area
+        vars = ['clc', 'cl_area']
+        for i in range(len(vars)):
+            if max_workers is not None:
+                data_dict[vars[i]] = hourly_data[vars[i]]
+                continue
+            with stage(vars[i]) as s:
+                DS = _without_time_step(xr.open_mfdataset(files[vars[i]], combine='by_coords'), skip_time_index)
+                if vars[i] == 'cl_area':
+                    da = cell_values(DS, 'clc', not_nan, dtype, time_chunk)
+                else:
+                    da = cell_values(DS, vars[i], not_nan, dtype, time_chunk)
+                s.samples = da.size
+            if resolution=='R02B05' and days=='august':
+                raise ValueError('Please implement the exclusion of int_var_*_R02B05_NARVALII_2016082900_fg_DOM01_0016.nc first!')
+            data_dict[vars[i]] = da
+    
+    ############
+    ## QUBICC ##
+    ############
+    # Yields default (order of) variables: 
+    # R2B4: ['zg', 'coriolis', 'fr_lake', 'fr_seaice', 'fr_land', 'hus', 'qclw_phy', 'cli', 'ta', 'pfull', 'rho', 'cl', 'cl_area']
+    # R2B5: ['zg', 'coriolis', 'fr_lake', 'fr_land', 'hus', 'qclw_phy', 'cli', 'ta', 'pfull', 'rho', 'ua', 'va', 'cl', 'cl_area']
+    if source == 'qubicc':
+        
+        # Get not_nan quickly
+        DS = xr.open_mfdataset(files['not_nan'], combine='by_coords')
+        da = cell_values(DS, 'cl')
+        not_nan = ~np.isnan(da[0,30,:]) #The surface-nearest layer 30 shall not contain NAN-values
+
+        ## Time-invariant input
+        #zg
+        DS = xr.open_dataset(files['zg'])
+        #not_nan = ~np.isnan(da[0,:])
+        data_dict['zg'] = cell_values(DS, 'zg', not_nan)
+        
+        #Coriolis Parameter
+        DS = xr.open_dataset(files['coriolis'])
+        lat_cell_center = DS.lat_cell_centre.values
+        # Rotation rate of the earth
+        Omega = 7.2921*10**(-5) # in 1/s
+        # Varies between -0.0001458 and 0.0001458
+        data_dict['coriolis'] = (2*Omega*np.sin(lat_cell_center))[not_nan]
+
+        #fr_lake
+        DS = xr.open_dataset(files['fr_lake'])
+        da = DS.lake.values
+        data_dict['fr_lake'] = da[not_nan]
+        
+        if resolution == 'R02B04':
+            #fr_seaice
+            DS = xr.open_dataset(files['fr_seaice'])
+            da = DS.siconcbcs.values
+            data_dict['fr_seaice'] = da[0, not_nan]
+
+        #fr_land
+        DS = xr.open_dataset(files['fr_land'])
+        da = DS.land.values
+        data_dict['fr_land'] = da[not_nan] 
+        
+        ## Hourly data
+        #3D data: All possible input variables
+        vars = ['hus', 'clw', 'cli', 'ta', 'pfull', 'rho', 'ua', 'va', 'cl', 'cl_area']
+        nc_names = {'clw': 'qclw_phy', 'cl_area': 'cl'}
+        hourly = OrderedDict((var, (files[var], nc_names.get(var, var))) for var in vars if var in files)
+        if memory_budget is not None:
+            time_chunk = plan_memory(hourly.values(), not_nan, memory_budget, 
+                                     np.float32 if (dtype is None and max_workers is not None) else dtype,
+                                     1 if max_workers is None else max_workers)
+        #There's a problem with int_var_hc2_02_p1m_ta_ml_20041119T020000Z_R02B05.nc.
+        skip_time_index = 434 if (resolution=='R02B05' and days=='all_hcs') else None
+        if max_workers is not None:
+            # Read all hourly 3D variables concurrently
+            with stage('concurrent_read', workers=max_workers) as s:
+                hourly_data = load_variables_concurrently(hourly, not_nan, max_workers, skip_time_index,
+                                                          np.float32 if dtype is None else dtype, time_chunk)
+                s.samples = sum([hourly_data[var].size for var in hourly_data.keys()])
+            data_dict.update(hourly_data)
+        for i in range(len(vars)):
+            if vars[i] in files and max_workers is None:
+                print(vars[i])
+                with stage(vars[i]) as s:
+                    DS = _without_time_step(xr.open_mfdataset(files[vars[i]], combine='by_coords'), skip_time_index)
+                    # There may be a difference between the filename and the actual variable name
+                    # Reads the full and the compact layout of compact_netcdf
+                    if vars[i] == 'clw':
+                        da = cell_values(DS, 'qclw_phy', not_nan, dtype, time_chunk)
+                    elif vars[i] == 'cl_area':
+                        da = cell_values(DS, 'cl', not_nan, dtype, time_chunk)
+                    else:
+                        da = cell_values(DS, vars[i], not_nan, dtype, time_chunk)
+                    s.samples = da.size
+                data_dict[vars[i]] = da
+    
+    # The (small) time-invariant variables
+    if dtype is not None:
+        for key in data_dict.keys():
+            data_dict[key] = data_dict[key].astype(dtype, copy=False)
+    
+    # Correct the order (possibly also removing one or two 2D features)
+    if order_of_vars != None:
+        for key in order_of_vars:
+            data_dict = OrderedDict((k, data_dict[k]) for k in order_of_vars)
+    
+    if return_not_nan:
+        return data_dict, not_nan
+    return data_dict
+
+
+@profiled('load_all_data')
+def load_all_data(days, order_of_vars=None, dtype=None, memory_budget=None):
+    '''
+        Loads more data from NARVAL and stores it in a dictionary.
+        Actually I'm not sure whether I actually use load_all_data anywhere.
+        
+        days:          all, august, dec_1st
+        order_of_vars: If provided, the returned dictionary will have the variables in the specified order.
+        dtype:         See load_data
+        memory_budget: See load_data
+        
+        returns: A dictionary containing the data with the features as keys.
+    '''
+    import xarray as xr
+    from compact_netcdf import cell_values
+    data_dict = OrderedDict()
+    
+    # Yields default (order of) variables: 
+    # ['qv', 'qc', 'qi', 'temp', 'pres', 'rho', 'u', 'v', 'zf', 'fr_lake', 'fr_land', 'clc']
+    
+    path = data_path('my_work/NARVAL/data/')
+#     surface_nearest_layer = 74
+    file_name_prefix = ''
+    height_variable_name = 'zf'
+    height_file_location = 'z_ifc/zf_R02B04_NARVALI_fg_DOM01.nc'
+
+    # Get not_nan quickly
+    DS = xr.open_dataset(path+'clc/'+file_name_prefix+'clc_R02B04_NARVALI_2013123100_cloud_DOM01_0034.nc')
+    da = DS.clc.values
+    not_nan = ~np.isnan(da[0,-1,:]) #The surface-nearest layer shall not contain NAN-values
+
+    # Which days should we load
+    if days=='all':
+        load_days = '_R02B04_*'
+    elif days=='august':
+        load_days = '_R02B04_NARVALII_201608*'
+    elif days=='dec_1st':
+        load_days = '_R02B04_NARVALI_2013120100'
+    else:
+        raise ValueError('The entered days are invalid.')
+
+    ## Hourly data
+    hourly = OrderedDict((var, path+var+'/'+file_name_prefix+var+load_days+'_fg_DOM01_00*.nc') 
+                         for var in ['qv', 'qc', 'qi', 'temp', 'pres', 'rho', 'u', 'v'])
+    hourly['clc'] = path+'clc/'+file_name_prefix+'clc'+load_days+'_cloud_DOM01_00*.nc'
+    time_chunk = None
+    if memory_budget is not None:
+        time_chunk = plan_memory([(hourly[var], var) for var in hourly.keys()], not_nan, memory_budget, dtype)
+    
+    #3D input
+    vars = ['qv', 'qc', 'qi', 'temp', 'pres', 'rho', 'u', 'v']
+    for i in range(len(vars)):
+        DS = xr.open_mfdataset(hourly[vars[i]], combine='by_coords')
+        data_dict[vars[i]] = cell_values(DS, vars[i], not_nan, dtype, time_chunk)
+
+    ## Time-invariant input
+    #zf
+    DS = xr.open_dataset(path+height_file_location)
+    da = getattr(DS, height_variable_name).values
+    data_dict[height_variable_name] = da[:,not_nan]
+
+    #fr_lake
+    DS = xr.open_dataset(path+'../grid_extpar/fr_lake_R02B04_NARVAL_fg_DOM01.nc')
+    da = DS.FR_LAKE.values
+    data_dict['fr_lake'] = da[not_nan]
+
+    #fr_land
+    DS = xr.open_dataset(path+'../grid_extpar/fr_land_R02B04_NARVAL_fg_DOM01.nc')
+    da = DS.fr_land.values
+    data_dict['fr_land'] = da[not_nan] 
+
+    ## Output
+    #clc
+    vars = ['clc']
+    for i in range(len(vars)):
+        DS = xr.open_mfdataset(hourly[vars[i]], combine='by_coords')
+        data_dict[vars[i]] = cell_values(DS, vars[i], not_nan, dtype, time_chunk)
+        
+    # The (small) time-invariant variables
+    if dtype is not None:
+        for key in data_dict.keys():
+            data_dict[key] = data_dict[key].astype(dtype, copy=False)
+
+    # Correct the order (possibly also removing one or two features)
+    if order_of_vars != None:
+        for key in order_of_vars:
+            data_dict = OrderedDict((k, data_dict[k]) for k in order_of_vars)
+    
+    return data_dict
+
+    
+    
+    
+    
+    
+    
+    
+    
+    
+    
+    
+    
+    
+    
+    
+    
+    
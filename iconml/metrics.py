@@ -0,0 +1,45 @@
+## Skill of the models: Means and R2 per vertical layer ##
+
+import numpy as np
+
+def compute_R2_and_means(pred_output, output_data, vertical_layers, narval_shape=(1721, 4450)):
+    '''
+        Returns data_means, pred_means, r2
+
+        vertical_layers: Vertical layer of every sample. None for the NARVAL cell-based and region-based models,
+                         whose samples are all grid cells of layers 5, ..., 31 of narval_shape (time steps, cells).
+    '''
+    data_means = []
+    pred_means = []
+    r2 = []
+    
+    if output_data.shape[-1] == 27:
+        # For the column-based model
+        # Means
+        pred_means = np.mean(pred_output, axis=0, dtype=np.float64)
+        data_means = np.mean(output_data, axis=0, dtype=np.float64)
+        # R2
+        mse = np.mean((pred_output - output_data)**2, axis=0, dtype=np.float64)
+        var = np.var(output_data, axis=0)
+        r2 = 1-mse/var
+    else:
+        if vertical_layers is None:
+            # For the NARVAL cell-based and region-based models
+            vertical_layers = np.arange(5, 32)
+            vertical_layers = np.repeat(np.expand_dims(vertical_layers, 0), narval_shape[0], axis=0)
+            vertical_layers = np.repeat(np.expand_dims(vertical_layers, 2), narval_shape[1], axis=2)
+            vertical_layers = np.reshape(vertical_layers, -1)
+        for i in range(5, 32):
+            indices = np.where(vertical_layers == i)
+            # Means
+            pred_means.append(np.mean(pred_output[indices], dtype=np.float64))
+            data_means.append(np.mean(output_data[indices], dtype=np.float64))
+            # R2
+            mse = np.mean((pred_output[indices] - output_data[indices])**2, dtype=np.float64)
+            var = np.var(output_data[indices])
+            try:
+                r2.append(1-mse/var)
+            except ZeroDivisionError:
+                print('Caught a division by 0 error')
+                r2.append(-10**5)
+    return data_means, pred_means, r2
@@ -0,0 +1,64 @@
+## Training utilities that need TensorFlow ##
+# TensorFlow is only imported when TimeOut is accessed for the first time (from iconml.training import TimeOut),
+# not when the module is imported.
+
+import time
+import numpy as np
+
+from telemetry import stage
+
+def _time_out_class():
+    from tensorflow import keras
+
+    class TimeOut(keras.callbacks.Callback):
+        '''
+        Stop training after a batch when a certain time-limit (in minutes) is reached.
+        Restoring the weights from the best concluded epoch.
+        With telemetry enabled, the training and every epoch are recorded as stages (training/epoch).
+        '''
+        def __init__(self, t0, timeout):
+            super().__init__()
+            self.t0 = t0
+            self.timeout = timeout  # time in minutes
+        
+        def on_train_begin(self, logs=None):
+            self.best = np.Inf
+            self.best_weights = self.model.get_weights()
+            self.training_stage = stage('training', timeout=self.timeout).start()
+            print("Starting training")
+    
+        def on_train_end(self, logs=None):
+            print('Restore model weights from the end of the best epoch')
+            self.model.set_weights(self.best_weights)
+            self.training_stage.stop(best_val_loss=float(self.best))
+        
+        def on_epoch_begin(self, epoch, logs=None):
+            self.batches = 0
+            self.epoch_stage = stage('epoch', epoch=epoch).start()
+    
+        # Note that training ends after a batch (not after a completed epoch)
+        def on_train_batch_end(self, batch, logs=None):
+            self.batches += 1
+            if time.time() - self.t0 > self.timeout * 60:  
+                print(f"\nReached {(time.time() - self.t0) / 60:.3f} minutes of training, stopping")
+                self.model.stop_training = True
+            
+        def on_epoch_end(self, epoch, logs=None):
+            current = logs.get("val_loss")
+            self.epoch_stage.stop(batches=self.batches, loss=logs.get('loss'), val_loss=current)
+            try:
+                # Save the best weights if the validation loss has improved
+                if np.less(current, self.best):
+                    self.best = current
+                    self.best_weights = self.model.get_weights()
+            except:
+                print('\nTraining is finished or no validation set was provided.')
+
+    TimeOut.__qualname__ = 'TimeOut'
+    return TimeOut
+
+def __getattr__(name):
+    if name == 'TimeOut':
+        globals()['TimeOut'] = _time_out_class()
+        return globals()['TimeOut']
+    raise AttributeError('module %r has no attribute %r'%(__name__, name))
@@ -0,0 +1,395 @@
+## Batched column inference over a Unix socket, to test the coupling to ICON-A without ICON-A ##
+# A long-lived process keeps the QUBICC R2B5 networks (cell-, column- and neighborhood-based, saved_models/*.h5) and
+# their scalings loaded and answers requests of the (Fortran) model side: A batch of grid columns in, the cloud cover
+# (or cloud area) of the 27 layers below 21km out, clipped to [0, 100].
+#
+# - The networks are evaluated in NumPy (numpy_attributions.DenseNetwork), no TensorFlow session per request
+# - Requests for the same model that arrive within the latency budget (--max_wait_ms, counted from the arrival of the
+#   first request of a batch) are coalesced into one forward pass of at most --max_batch columns
+# - Every connection is served by its own thread, the batches of every model by one worker thread
+#
+# Protocol (little-endian, one request at a time per connection):
+#   Request:  uint32 model (index in MODEL_TYPES), uint32 columns, uint32 fields, then columns x fields float32.
+#             Every column: The 31 layers (top to bottom) of qv, qc, qi, temp, pres, u, v, zg (see COLUMN_VARS),
+#             then coriolis and fr_land, i.e. fields = 8*31 + 2 = 250.
+#   Response: int32 status, uint32 columns, uint32 outputs, then columns x outputs float32 (outputs = 27: layers
+#             5, ..., 31). If status != 0, outputs bytes with the error message follow instead.
+#
+# Start the server and measure latency and throughput with the load generator:
+#   python inference_server.py serve --socket /tmp/iconml.sock --fold 3
+#   python inference_server.py load --socket /tmp/iconml.sock --clients 8 --columns 64 --seconds 10
+
+import os
+import sys
+import time
+import queue
+import struct
+import signal
+import socket
+import argparse
+import threading
+import socketserver
+import numpy as np
+
+from numpy_attributions import DenseNetwork
+from telemetry import stage
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# Model type -> (folder, file name of the saved model with the fold)
+MODEL_TYPES = ['cell', 'column', 'neighborhood']
+MODEL_FILES = {'cell': ('q1_cell_based_qubicc_r2b5', 'cross_validation_cell_based_fold_%d'),
+               'column': ('q2_column_based_qubicc_r2b5', 'cross_validation_column_based_fold_%d'),
+               'neighborhood': ('q3_neighborhood_based_qubicc_r2b5', 'cross_validation_region_based_fold_%d')}
+SCALINGS_FILE = os.path.join(ROOT, 'additional_content', 'save_qubicc_model_scalings', 'qubicc_scalings.txt')
+
+COLUMN_VARS = ['qv', 'qc', 'qi', 'temp', 'pres', 'u', 'v', 'zg']
+VERT_LAYERS = 31
+COLUMN_FIELDS = len(COLUMN_VARS)*VERT_LAYERS + 2
+# The layers below 21km (5, ..., 31, counted from 1) the models predict
+LAYERS = np.arange(4, VERT_LAYERS)
+# Features that were constant in one of the training folds of the column-based model
+COLUMN_REMOVE_FIELDS = [27, 28, 29, 30, 31, 32, 135, 136, 137]
+
+REQUEST = struct.Struct('<III')
+RESPONSE = struct.Struct('<iII')
+
+## Model inputs ##
+
+def _column_vars(columns):
+    # columns: (n, COLUMN_FIELDS) -> {var: (n, VERT_LAYERS)}, coriolis, fr_land
+    values = columns[:, :len(COLUMN_VARS)*VERT_LAYERS].reshape(len(columns), len(COLUMN_VARS), VERT_LAYERS)
+    return dict(zip(COLUMN_VARS, np.moveaxis(values, 1, 0))), columns[:, -2], columns[:, -1]
+
+def cell_input(columns):
+    '''
+        One sample per column and layer below 21km: qv, qc, qi, temp, pres, u, v, zg, coriolis, fr_land
+    '''
+    (vars_3d, coriolis, fr_land) = _column_vars(columns)
+    (n, layers) = (len(columns), len(LAYERS))
+    features = [vars_3d[var][:, LAYERS] for var in COLUMN_VARS]
+    features += [np.repeat(coriolis[:, None], layers, axis=1), np.repeat(fr_land[:, None], layers, axis=1)]
+    return np.stack(features, axis=-1).reshape(n*layers, len(features))
+
+def neighborhood_input(columns):
+    '''
+        One sample per column and layer below 21km: The cell-based features without fr_land, the values of every 3D
+        variable in the layers below and above and the surface temperature (see get_narval_features)
+    '''
+    (vars_3d, coriolis, fr_land) = _column_vars(columns)
+    (n, layers) = (len(columns), len(LAYERS))
+    features = [vars_3d[var][:, LAYERS] for var in COLUMN_VARS] + [np.repeat(coriolis[:, None], layers, axis=1)]
+    for var in COLUMN_VARS:
+        # Below is the same value as the grid cell for surface-closest layer
+        features.append(vars_3d[var][:, np.minimum(LAYERS + 1, VERT_LAYERS - 1)])
+        above = vars_3d[var][:, LAYERS - 1]
+        # Replace by the entry from the same cell if the one above is nan (for pres decreased by 3/4)
+        factor = 3/4 if var == 'pres' else 1
+        features.append(np.where(np.isnan(above), factor*vars_3d[var][:, LAYERS], above))
+    features.append(np.repeat(vars_3d['temp'][:, -1:], layers, axis=1))
+    return np.stack(features, axis=-1).reshape(n*layers, len(features))
+
+def column_input(columns):
+    '''
+        One sample per column: qv, qc, qi, temp, pres, zg in the layers below 21km and fr_land, without the
+        constant features
+    '''
+    (vars_3d, coriolis, fr_land) = _column_vars(columns)
+    features = np.concatenate([vars_3d[var][:, LAYERS] for var in ['qv', 'qc', 'qi', 'temp', 'pres', 'zg']] +
+                              [fr_land[:, None]], axis=1)
+    return np.delete(features, COLUMN_REMOVE_FIELDS, axis=1)
+
+MODEL_INPUTS = {'cell': cell_input, 'column': column_input, 'neighborhood': neighborhood_input}
+
+def read_qubicc_scalings(model_type, fold, file_name=SCALINGS_FILE):
+    '''
+        Mean and standard deviation of the input features of a QUBICC model (written by save_scalings.py, which
+        stores the variance) for fold in 1, 2, 3
+    '''
+    header = {'cell': 'Cell', 'column': 'Column', 'neighborhood': 'Region'}[model_type] + ' %d (Fold %d)'%(fold-1, fold)
+    with open(file_name) as file:
+        text = file.read()
+    block = text[text.index(header):].split('[')
+    mean = np.array(block[1].split(']')[0].split(), dtype=float)
+    std = np.sqrt(np.array(block[2].split(']')[0].split(), dtype=float))
+    if model_type == 'column':
+        (mean, std) = (np.delete(mean, COLUMN_REMOVE_FIELDS), np.delete(std, COLUMN_REMOVE_FIELDS))
+    return mean, std
+
+class ColumnModel():
+    '''
+        A saved model with its scaling, from grid columns to the cloud cover of the layers below 21km
+    '''
+    def __init__(self, model_type, fold=3, output_type='cloud_cover', dtype=np.float32):
+        folder, file_name = MODEL_FILES[model_type]
+        model_path = os.path.join(ROOT, folder, 'saved_models', '%s_R2B5_QUBICC'%output_type, file_name%fold)
+        self.model_type = model_type
+        self.network = DenseNetwork.from_h5(model_path + '.h5', dtype)
+        self.build_input = MODEL_INPUTS[model_type]
+        if model_type == 'column':
+            # The txt-file of the column-based model refers to the scalings file
+            mean, std = read_qubicc_scalings(model_type, fold)
+        else:
+            from my_classes import read_mean_and_std
+            mean, std = read_mean_and_std(model_path + '.txt')
+        (self.mean, self.std) = (mean.astype(dtype), std.astype(dtype))
+        if len(self.mean) != self.network.no_inputs:
+            raise ValueError('%s: %d scalings for %d inputs'%(model_path, len(self.mean), self.network.no_inputs))
+
+    def predict(self, columns):
+        '''
+            columns: (n, COLUMN_FIELDS). Returns (n, 27) in [0, 100]
+        '''
+        X = self.build_input(np.asarray(columns, dtype=self.mean.dtype))
+        X -= self.mean
+        X /= self.std
+        output = self.network.forward(X)[1].reshape(len(columns), len(LAYERS))
+        return np.clip(output, 0, 100, out=output)
+
+## Server ##
+
+class _Request():
+    def __init__(self, columns):
+        self.columns = columns
+        self.arrival = time.perf_counter()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class InferenceServer():
+    '''
+        Keeps the models loaded and coalesces the requests for every model into batches.
+
+        models:      Dictionary model type -> ColumnModel
+        max_batch:   Maximum number of columns of one forward pass
+        max_wait_ms: Latency budget: How long the first request of a batch may wait for more requests
+    '''
+    def __init__(self, models, max_batch=4096, max_wait_ms=2):
+        self.models = models
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms/1000
+        self.queues = {name: queue.Queue() for name in models.keys()}
+        self.stats = {name: {'batches': 0, 'requests': 0, 'columns': 0} for name in models.keys()}
+        self.workers = [threading.Thread(target=self._batch_loop, args=(name,), daemon=True)
+                        for name in models.keys()]
+        for worker in self.workers:
+            worker.start()
+
+    def submit(self, model_type, columns):
+        '''
+            Blocks until the batch containing columns was processed. Returns the predictions for columns.
+        '''
+        request = _Request(columns)
+        self.queues[model_type].put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def _batch_loop(self, name):
+        requests = self.queues[name]
+        while True:
+            batch = [requests.get()]
+            if batch[0] is None:
+                return
+            columns = len(batch[0].columns)
+            deadline = batch[0].arrival + self.max_wait
+            # Wait for more requests until the latency budget of the first one is used up. Requests that are
+            # already waiting are always included.
+            while columns < self.max_batch:
+                timeout = deadline - time.perf_counter()
+                try:
+                    request = requests.get(timeout=timeout) if timeout > 0 else requests.get_nowait()
+                except queue.Empty:
+                    break
+                if request is None:
+                    requests.put(None)
+                    break
+                batch.append(request)
+                columns += len(request.columns)
+            self._run(name, batch, columns)
+
+    def _run(self, name, batch, columns):
+        try:
+            with stage('inference_batch', samples=columns, model=name, requests=len(batch)):
+                output = self.models[name].predict(np.concatenate([request.columns for request in batch]))
+            start = 0
+            for request in batch:
+                request.result = output[start:start + len(request.columns)]
+                start += len(request.columns)
+        except Exception as e:
+            for request in batch:
+                request.error = e
+        for request in batch:
+            request.done.set()
+        stats = self.stats[name]
+        (stats['batches'], stats['requests'], stats['columns']) = (stats['batches'] + 1,
+                                                                   stats['requests'] + len(batch),
+                                                                   stats['columns'] + columns)
+
+    def close(self):
+        for name in self.queues.keys():
+            self.queues[name].put(None)
+        for worker in self.workers:
+            worker.join()
+
+def _recv_exactly(sock, n):
+    buffer = bytearray(n)
+    view = memoryview(buffer)
+    received = 0
+    while received < n:
+        k = sock.recv_into(view[received:])
+        if k == 0:
+            raise ConnectionError('Connection closed')
+        received += k
+    return buffer
+
+class _Handler(socketserver.BaseRequestHandler):
+    def handle(self):
+        server = self.server.inference_server
+        while True:
+            try:
+                model_index, n, fields = REQUEST.unpack(_recv_exactly(self.request, REQUEST.size))
+                columns = np.frombuffer(_recv_exactly(self.request, 4*n*fields), dtype='<f4').reshape(n, fields)
+            except ConnectionError:
+                return
+            try:
+                if model_index >= len(MODEL_TYPES) or MODEL_TYPES[model_index] not in server.models:
+                    raise ValueError('Model %d is not loaded'%model_index)
+                if fields != COLUMN_FIELDS:
+                    raise ValueError('Expected %d fields per column, got %d'%(COLUMN_FIELDS, fields))
+                output = server.submit(MODEL_TYPES[model_index], columns).astype('<f4', copy=False)
+                self.request.sendall(RESPONSE.pack(0, *output.shape) + output.tobytes())
+            except Exception as e:
+                message = ('%s: %s'%(type(e).__name__, e)).encode()
+                self.request.sendall(RESPONSE.pack(1, 0, len(message)) + message)
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def serve(socket_path, model_types=MODEL_TYPES, fold=3, output_type='cloud_cover', max_batch=4096, max_wait_ms=2):
+    '''
+        Loads the models and serves requests on socket_path until interrupted (Ctrl+C or SIGTERM)
+    '''
+    models = {model_type: ColumnModel(model_type, fold, output_type) for model_type in model_types}
+    inference_server = InferenceServer(models, max_batch, max_wait_ms)
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+    # Also when started in the background (which ignores SIGINT) or stopped with kill
+    for signum in [signal.SIGINT, signal.SIGTERM]:
+        signal.signal(signum, stop)
+    with _UnixServer(socket_path, _Handler) as server:
+        server.inference_server = inference_server
+        print('Serving %s (fold %d, %s) on %s'%(', '.join(model_types), fold, output_type, socket_path))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            inference_server.close()
+            os.remove(socket_path)
+    for name, stats in inference_server.stats.items():
+        print('%s: %d requests, %d columns in %d batches (%.1f columns per batch)'%(
+            name, stats['requests'], stats['columns'], stats['batches'], stats['columns']/max(stats['batches'], 1)))
+
+## Client and load generator ##
+
+class InferenceClient():
+    '''
+        Connection to an inference server. predict(model_type, columns) -> (n, 27) cloud cover in [0, 100]
+    '''
+    def __init__(self, socket_path):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(socket_path)
+
+    def predict(self, model_type, columns):
+        columns = np.ascontiguousarray(columns, dtype='<f4')
+        self.sock.sendall(REQUEST.pack(MODEL_TYPES.index(model_type), *columns.shape) + columns.tobytes())
+        status, n, outputs = RESPONSE.unpack(_recv_exactly(self.sock, RESPONSE.size))
+        if status != 0:
+            raise RuntimeError(_recv_exactly(self.sock, outputs).decode())
+        return np.frombuffer(_recv_exactly(self.sock, 4*n*outputs), dtype='<f4').reshape(n, outputs)
+
+    def close(self):
+        self.sock.close()
+
+def synthetic_columns(n, seed=0):
+    '''
+        n plausible grid columns (see synthetic_data.py) in the layout of the protocol
+    '''
+    from synthetic_data import half_levels, atmosphere
+    rng = np.random.default_rng(seed)
+    lat = np.arcsin(rng.uniform(-1, 1, n))
+    orography = np.where(rng.random(n) < 0.3, rng.uniform(0, 3000, n), 0)
+    zghalf = half_levels(orography, VERT_LAYERS)
+    zg = (zghalf[:-1] + zghalf[1:])/2
+    fields = atmosphere(zg, lat, 0, rng, source='qubicc')
+    fields['zg'] = zg
+    coriolis = 2*7.2921e-5*np.sin(lat)
+    fr_land = (orography > 0).astype(float)
+    return np.concatenate([fields[var].T for var in COLUMN_VARS] + [coriolis[:, None], fr_land[:, None]],
+                          axis=1).astype(np.float32)
+
+def load_test(socket_path, model_type, clients=8, columns=64, seconds=10, seed=0):
+    '''
+        clients threads send requests of columns columns as fast as they get answers for the given time.
+
+        Returns: p50 and p99 latency [ms], requests/s and columns/s
+    '''
+    pool = synthetic_columns(16*columns, seed)
+    latencies = [[] for k in range(clients)]
+    start = threading.Barrier(clients + 1)
+    def client(k):
+        rng = np.random.default_rng([seed, k])
+        connection = InferenceClient(socket_path)
+        # Warm-up request
+        connection.predict(model_type, pool[:columns])
+        start.wait()
+        end = time.perf_counter() + seconds
+        while time.perf_counter() < end:
+            i = rng.integers(0, len(pool) - columns + 1)
+            t0 = time.perf_counter()
+            connection.predict(model_type, pool[i:i+columns])
+            latencies[k].append(time.perf_counter() - t0)
+        connection.close()
+    threads = [threading.Thread(target=client, args=(k,)) for k in range(clients)]
+    for thread in threads:
+        thread.start()
+    start.wait()
+    t0 = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - t0
+    latencies = 1000*np.concatenate(latencies)
+    return {'p50_ms': np.percentile(latencies, 50), 'p99_ms': np.percentile(latencies, 99),
+            'requests_per_s': len(latencies)/elapsed, 'columns_per_s': columns*len(latencies)/elapsed}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Batched column inference server and its load generator')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    serve_parser = subparsers.add_parser('serve', help='Start the server')
+    serve_parser.add_argument('--socket', default='/tmp/iconml_inference.sock')
+    serve_parser.add_argument('--models', nargs='+', default=MODEL_TYPES, choices=MODEL_TYPES)
+    serve_parser.add_argument('--fold', type=int, default=3, help='Fold 3 of the cell-based model runs in ICON-A')
+    serve_parser.add_argument('--output_type', default='cloud_cover', choices=['cloud_cover', 'cloud_area'])
+    serve_parser.add_argument('--max_batch', type=int, default=4096, help='Maximum columns per forward pass')
+    serve_parser.add_argument('--max_wait_ms', type=float, default=2, help='Latency budget for coalescing requests')
+    load_parser = subparsers.add_parser('load', help='Measure latency and throughput of a running server')
+    load_parser.add_argument('--socket', default='/tmp/iconml_inference.sock')
+    load_parser.add_argument('--models', nargs='+', default=MODEL_TYPES, choices=MODEL_TYPES)
+    load_parser.add_argument('--clients', type=int, default=8, help='Concurrent connections')
+    load_parser.add_argument('--columns', type=int, default=64, help='Columns per request')
+    load_parser.add_argument('--seconds', type=float, default=10, help='Duration per model')
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        serve(args.socket, args.models, args.fold, args.output_type, args.max_batch, args.max_wait_ms)
+    else:
+        print('%-14s %10s %10s %12s %12s'%('model', 'p50 [ms]', 'p99 [ms]', 'requests/s', 'columns/s'))
+        for model_type in args.models:
+            result = load_test(args.socket, model_type, args.clients, args.columns, args.seconds)
+            print('%-14s %10.2f %10.2f %12.1f %12.1f'%(model_type, result['p50_ms'], result['p99_ms'],
+                                                         result['requests_per_s'], result['columns_per_s']))
+            sys.stdout.flush()
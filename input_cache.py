@@ -0,0 +1,148 @@
+import os
+import glob
+import json
+import time
+import shutil
+import hashlib
+import numpy as np
+
+def files_fingerprint(file_patterns):
+    '''
+        Hashes the identity (path, size, modification time) of all files matching file_patterns.
+        Changing, adding or removing any of the files yields a different fingerprint.
+
+        file_patterns: List of file paths or glob patterns
+    '''
+    sha = hashlib.sha256()
+    for pattern in file_patterns:
+        file_names = sorted(glob.glob(pattern))
+        if len(file_names) == 0:
+            raise FileNotFoundError('No files match %s'%pattern)
+        for file_name in file_names:
+            stat = os.stat(file_name)
+            sha.update(('%s %d %d\n'%(os.path.abspath(file_name), stat.st_size, stat.st_mtime_ns)).encode())
+    return sha.hexdigest()
+
+class InputCache():
+    '''
+    Content-addressed disk cache for model-ready arrays (e.g. input_data, output_data for the evaluation).
+
+    Every entry is a directory named after the hash of its key. It contains one npy-file per array,
+    so that a cache hit can be memory-mapped instead of being read entirely.
+    The least recently used entries are evicted once the cache exceeds max_bytes.
+    Several processes can share one cache: Entries are written to and removed via temporary directories
+    (<key>.tmp<pid>, <key>.trash<pid>) that are renamed atomically, so that the others never see half an entry.
+    '''
+    def __init__(self, path, max_bytes=500*1024**3):
+        '''
+            path:      Directory of the cache. Is created if necessary.
+            max_bytes: Disk quota of the cache (500GB by default)
+        '''
+        self.path = path
+        self.max_bytes = max_bytes
+        os.makedirs(path, exist_ok=True)
+
+    def get_key(self, **params):
+        '''
+            Hash of params, e.g. source, resolution, days, model_type, output_type and the files_fingerprint.
+        '''
+        return hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+    def get(self, key, mmap_mode='r'):
+        '''
+            Returns the dictionary of cached arrays or None if key is not in the cache.
+        '''
+        entry_path = os.path.join(self.path, key)
+        meta_file = os.path.join(entry_path, 'meta.json')
+        # The entry may be evicted by another process at any time. Once the arrays are open (memory-mapped),
+        # they stay readable even if the entry is removed afterwards.
+        try:
+            with open(meta_file) as file:
+                meta = json.load(file)
+            # Mark as recently used
+            os.utime(meta_file)
+            return {name: np.load(os.path.join(entry_path, name + '.npy'), mmap_mode=mmap_mode)
+                    for name in meta['arrays']}
+        except FileNotFoundError:
+            return None
+
+    def put(self, key, arrays, params=None):
+        '''
+            Stores a dictionary of arrays under key and evicts old entries if necessary.
+            Entries that are None (e.g. vertical_layers of the column-based model) are not stored.
+        '''
+        arrays = {name: array for name, array in arrays.items() if array is not None}
+        entry_path = os.path.join(self.path, key)
+        # Write into a temporary directory first, so that an interrupted write never yields a corrupt entry
+        tmp_path = entry_path + '.tmp%d'%os.getpid()
+        os.makedirs(tmp_path, exist_ok=True)
+        size = 0
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp_path, name + '.npy'), array)
+            size += os.path.getsize(os.path.join(tmp_path, name + '.npy'))
+        with open(os.path.join(tmp_path, 'meta.json'), 'w') as file:
+            json.dump({'arrays': list(arrays.keys()), 'bytes': size, 'params': params,
+                       'created': time.strftime('%Y-%m-%d %H:%M:%S')}, file, indent=1)
+        try:
+            os.rename(tmp_path, entry_path)
+        except OSError:
+            # Another process has stored the same entry in the meantime
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        self.evict(keep=key)
+
+    def get_or_build(self, build, **params):
+        '''
+            Returns the cached arrays for params. Otherwise calls build() which needs to return a dictionary of
+            arrays, stores its output and returns the memory-mapped arrays.
+        '''
+        key = self.get_key(**params)
+        arrays = self.get(key)
+        if arrays is None:
+            built = build()
+            self.put(key, built, params)
+            arrays = self.get(key)
+            # Evicted by another process right away
+            if arrays is None:
+                arrays = built
+        return arrays
+
+    def entries(self):
+        '''
+            Returns a list of (last access time, size in bytes, key) for all entries.
+            Entries that are being written or removed by another process are skipped.
+        '''
+        entries = []
+        for key in os.listdir(self.path):
+            # <key>.tmp<pid> and <key>.trash<pid>
+            if '.' in key:
+                continue
+            meta_file = os.path.join(self.path, key, 'meta.json')
+            try:
+                with open(meta_file) as file:
+                    size = json.load(file)['bytes']
+                entries.append((os.path.getmtime(meta_file), size, key))
+            except (FileNotFoundError, json.JSONDecodeError):
+                continue
+        return entries
+
+    def evict(self, keep=None):
+        '''
+            Removes the least recently used entries until the cache fits into max_bytes.
+            The entry keep is never removed.
+        '''
+        entries = sorted(self.entries())
+        total_bytes = sum([entry[1] for entry in entries])
+        for (_, size, key) in entries:
+            if total_bytes <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            # Rename first: Readers then either find the complete entry or none at all
+            trash_path = os.path.join(self.path, key + '.trash%d'%os.getpid())
+            try:
+                os.rename(os.path.join(self.path, key), trash_path)
+                shutil.rmtree(trash_path, ignore_errors=True)
+            except FileNotFoundError:
+                # Already removed by another process
+                pass
+            total_bytes -= size
@@ -1,8 +1,16 @@
+import os
+import sys
+import glob
 import xarray as xr
 import pandas as pd
 import numpy as np
+from collections import deque
 
-def load_day(day, no_NNs, path, data_source='narval', resolution_narval='R02B04'):
+# Add the root of the repository (with compact_netcdf) to sys.path
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from compact_netcdf import cell_values
+
+def load_day(day, no_NNs, path, data_source='narval', resolution_narval='R02B04', dtype=None, memory_budget=None):
     '''
     We load data from path from a given day. The data is saved in a folder per variable manner.
     This function returns an array of dataframes, where each dataframe corresponds to a specific vertical layer
@@ -13,6 +21,9 @@ def load_day(day, no_NNs, path, data_source='narval', resolution_narval='R02B04'
         path (string): Path to the data
         data_source (string): 'narval' or 'qubicc'
         resolution_narval: 'R02B04' or 'R02B05'. Affects which fr_lake file is loaded.
+        dtype: E.g. np.float32. The variables are decoded directly into this dtype and so are the dataframes.
+        memory_budget (float): In GB. If the dataframes (and one variable) do not fit, we raise a MemoryError.
+                               Otherwise as many time steps are decoded at once as the rest of the budget allows.
         
     Returns:
         dfs: An array of no_NNs many dataframes, each providing training data for clc on a specific vertical layer
@@ -58,13 +69,23 @@ def load_day(day, no_NNs, path, data_source='narval', resolution_narval='R02B04'
             # cl-filename qubicc: int_var_hc2_02_p1m_cl_ml_20041110T110000Z.nc
             clc_filenames = '/int_var_hc2_02_p1m_'+vars[i]+'_ml_'+day+'*.nc'
         DS = xr.open_mfdataset(path+vars[i]+clc_filenames, combine='by_coords')
-        var_array = getattr(DS, vars[i]).values
-        not_nan = ~np.isnan(var_array[0,30,:]) #The surface-nearest layer 30 shall not contain NAN-values
-        timesteps = var_array.shape[0]        
-        var_array_notnan = var_array[:,:,not_nan]  #var_array_notnan.shape=25x31x1131
+        da = getattr(DS, vars[i])
+        # The surface-nearest layer 30 shall not contain NAN-values. Compact files only hold the stored cells.
+        not_nan = ~np.isnan(cell_values(DS.isel(time=slice(0, 1)), vars[i])[0,30,:])
+        (timesteps, vert_layers) = da.shape[:2]
+        time_chunk = None
+        if memory_budget is not None:
+            itemsize = np.dtype(da.dtype if dtype is None else dtype).itemsize
+            # The dataframes, one variable on the not_nan cells and one decoded time step (of all cells)
+            needed = (no_NNs*(timesteps-1)*len(columns) + timesteps*vert_layers)*np.sum(not_nan)*itemsize
+            per_step = np.prod(da.shape[1:])*da.dtype.itemsize
+            if needed + per_step > memory_budget*1e9:
+                raise MemoryError('Day %s needs %.1f GB, but the memory budget is %.1f GB. Train fewer NNs or use '
+                                  'dtype=np.float32.'%(day, (needed + per_step)/1e9, memory_budget))
+            time_chunk = int((memory_budget*1e9 - needed)//per_step)
+        var_array_notnan = cell_values(DS, vars[i], not_nan, dtype, time_chunk)  #var_array_notnan.shape=25x31x1131
         # For every vertical layer we have to fill the output information of this day in the corresponding dataset
         for j in range(no_NNs):
-            vert_layers = var_array.shape[1]
             # We are not interested in the uppermost layers (denoted by small indices)
             ind = vert_layers - no_NNs + j
             # We do not save the initial timestep as there is no preceding information on clc
@@ -74,33 +95,28 @@ def load_day(day, no_NNs, path, data_source='narval', resolution_narval='R02B04'
     ## Time-invariant input
     #zg
     DS = xr.open_dataset(path+'zg/zg_icon-a_capped.nc')
-    var_array = DS.zg.values
-    var_array_notnan = var_array[:,not_nan] #var_array_notnan.shape=31x1131
-    var_array_notnan = np.repeat(np.expand_dims(var_array_notnan, 0), timesteps, axis=0) #var_array_notnan.shape=25x31x1131
+    var_array_notnan = cell_values(DS, 'zg', not_nan, dtype) #var_array_notnan.shape=31x1131
+    # The same for every time step (but the initial one): Tile instead of repeating the entire array
     for j in range(no_NNs):
         ind = vert_layers - no_NNs + j
-        dfs[j]['zg_i-2'] = np.reshape(var_array_notnan[1:,ind-2,:], [-1])
-        dfs[j]['zg_i-1'] = np.reshape(var_array_notnan[1:,ind-1,:], [-1])
-        dfs[j]['zg_i'] = np.reshape(var_array_notnan[1:,ind,:], [-1])
+        dfs[j]['zg_i-2'] = np.tile(var_array_notnan[ind-2,:], timesteps-1)
+        dfs[j]['zg_i-1'] = np.tile(var_array_notnan[ind-1,:], timesteps-1)
+        dfs[j]['zg_i'] = np.tile(var_array_notnan[ind,:], timesteps-1)
         try:
-            dfs[j]['zg_i+1'] = np.reshape(var_array_notnan[1:,ind+1,:], [-1])
-            dfs[j]['zg_i+2'] = np.reshape(var_array_notnan[1:,ind+2,:], [-1])
+            dfs[j]['zg_i+1'] = np.tile(var_array_notnan[ind+1,:], timesteps-1)
+            dfs[j]['zg_i+2'] = np.tile(var_array_notnan[ind+2,:], timesteps-1)
         except IndexError:
             pass
         
     #fr_lake
     if data_source == 'narval':
         DS = xr.open_dataset(path+'../grid_extpar/fr_lake_'+resolution_narval+'_NARVAL_fg_DOM01.nc')
-        var_array = DS.FR_LAKE.values
+        var_array_notnan = cell_values(DS, 'FR_LAKE', not_nan, dtype)
     elif data_source == 'qubicc':
         DS = xr.open_dataset(path+'/fr_lake/fr_lake_'+resolution_narval+'.nc')
-        var_array = DS.lake.values
-    var_array = np.repeat(np.expand_dims(var_array, 0), timesteps, axis=0)
-    var_array = np.repeat(np.expand_dims(var_array, 1), 31, axis=1)
-    var_array_notnan = var_array[:,:,not_nan]
+        var_array_notnan = cell_values(DS, 'lake', not_nan, dtype)
     for j in range(no_NNs):
-        ind = vert_layers - no_NNs + j
-        dfs[j]['fr_lake'] = np.reshape(var_array_notnan[1:,ind,:],[-1])
+        dfs[j]['fr_lake'] = np.tile(var_array_notnan, timesteps-1)
         
 #     ## 2D input
 #     #
@@ -129,10 +145,9 @@ def load_day(day, no_NNs, path, data_source='narval', resolution_narval='R02B04'
             filenames = '/int_var_hc2_02_p1m_'+vars[i]+'_ml_'+day+'*.nc'
         DS = xr.open_mfdataset(path+vars[i]+filenames, combine='by_coords')
         if vars[i] == 'clw':
-            var_array = getattr(DS, 'qclw_phy').values
+            var_array_notnan = cell_values(DS, 'qclw_phy', not_nan, dtype, time_chunk)
         else:
-            var_array = getattr(DS, vars[i]).values
-        var_array_notnan = var_array[:,:,not_nan]
+            var_array_notnan = cell_values(DS, vars[i], not_nan, dtype, time_chunk)
         for j in range(no_NNs):
             ind = vert_layers - no_NNs + j
             dfs[j][vars[i]+'_i-2'] = np.reshape(var_array_notnan[1:,ind-2,:], [-1])
@@ -144,4 +159,148 @@ def load_day(day, no_NNs, path, data_source='narval', resolution_narval='R02B04'
             except IndexError:
                 pass
     
-    return dfs
\ No newline at end of file
+    return dfs
+
+
+def file_pattern(path, var, day, data_source='narval', resolution_narval='R02B04'):
+    '''
+    Glob pattern of the hourly files of var on day (as in load_day). With day='*' the files of all days.
+    '''
+    if data_source == 'narval':
+        # clc-filename narval: int_var_clc_R02B04_NARVALI_2013123100_cloud_DOM01_0036.nc
+        # 3d-filename narval: int_var_qc_R02B04_NARVALII_2016072800_fg_DOM01_0021.nc
+        file_type = 'cloud' if var == 'clc' else 'fg'
+        return path+var+'/int_var_'+var+'_'+resolution_narval+'*'+day+'*_'+file_type+'_DOM01_00*.nc'
+    elif data_source == 'qubicc':
+        # cl-filename qubicc: int_var_hc2_02_p1m_cl_ml_20041110T110000Z.nc
+        return path+var+'/int_var_hc2_02_p1m_'+var+'_ml_'+day+'*.nc'
+
+def _time_steps(file_names):
+    # Sorted list of (time, file_name, index of the time step in the file)
+    steps = []
+    for file_name in file_names:
+        with xr.open_dataset(file_name) as DS:
+            for k, t in enumerate(DS.time.values):
+                steps.append((t, file_name, k))
+    return sorted(steps)
+
+def time_windows(variables, lags, not_nan=None, time_step=np.timedelta64(1, 'h')):
+    '''
+    Walks through the hourly files of all variables in time order and yields, for every time step t, the values at
+    t-k for all k in lags. Only max(lags)+1 time steps (and one open file per variable) are kept in memory, in a ring
+    buffer that is carried over file and day boundaries. If two consecutive time steps are further apart than
+    time_step (e.g. between two separate simulations), the buffer is emptied: The first max(lags) time steps after
+    such a gap are skipped, as they have no complete history.
+    
+    Parameters:
+        variables (dict): Name -> list of files (or glob pattern). The name is also the NetCDF variable name, except
+                          for 'clw' (-> 'qclw_phy')
+        lags (list): E.g. [0, 1] for (clc_prev, clc)
+        not_nan (array): Boolean mask of the horizontal cells to keep
+        
+    Yields:
+        (t, window) with window[name] of shape (len(lags), vertical layers, cells). window[name][m] is at t-lags[m].
+    '''
+    steps = {}
+    for name in variables.keys():
+        file_names = variables[name]
+        if isinstance(file_names, str):
+            file_names = glob.glob(file_names)
+        steps[name] = _time_steps(file_names)
+    # Only the time steps at which all variables are available
+    times = sorted(set.intersection(*[set([s[0] for s in steps[name]]) for name in steps.keys()]))
+    where = {name: {s[0]: (s[1], s[2]) for s in steps[name]} for name in steps.keys()}
+
+    buffer = deque(maxlen=max(lags)+1)
+    open_files = {}
+    for t in times:
+        if len(buffer) > 0 and t - buffer[-1][0] != time_step:
+            buffer.clear()
+        values = {}
+        for name in variables.keys():
+            file_name, k = where[name][t]
+            # Keep the current file of every variable open (files may contain several time steps)
+            if name not in open_files or open_files[name][0] != file_name:
+                if name in open_files:
+                    open_files[name][1].close()
+                open_files[name] = (file_name, xr.open_dataset(file_name))
+            nc_name = 'qclw_phy' if name == 'clw' else name
+            # Reads the full and the compact layout of compact_netcdf
+            values[name] = cell_values(open_files[name][1].isel(time=slice(k, k+1)), nc_name, not_nan)[0]
+        buffer.append((t, values))
+        if len(buffer) == buffer.maxlen:
+            yield t, {name: np.stack([buffer[-1-lag][1][name] for lag in lags]) for name in variables.keys()}
+    for name in open_files.keys():
+        open_files[name][1].close()
+
+def load_period(days, no_NNs, path, data_source='narval', resolution_narval='R02B04'):
+    '''
+    Like load_day, but for several days at once, streaming through the hourly files in time order (see time_windows).
+    clc_prev of the first hour of a day is taken from the last hour of the previous day, if that directly precedes
+    it. So for consecutive days (e.g. a multi-day NARVAL run) only the very first time step is dropped.
+    
+    Parameters:
+        days (list): The days as in load_day or '*' for all days
+        
+    Returns:
+        dfs: An array of no_NNs many dataframes, with the same columns as the ones from load_day
+    '''
+    if data_source == 'narval':
+        vars_3d = ['qv', 'qc', 'qi', 'temp', 'pres', 'rho']
+        output = 'clc'
+    elif data_source == 'qubicc':
+        vars_3d = ['hus', 'clw', 'cli', 'ta', 'pfull', 'rho']
+        output = 'cl'
+    if isinstance(days, str):
+        days = [days]
+    
+    variables = {}
+    for var in vars_3d + [output]:
+        variables[var] = sorted(set(sum([glob.glob(file_pattern(path, var, str(day), data_source, resolution_narval)) 
+                                         for day in days], [])))
+    
+    # The surface-nearest layer 30 shall not contain NAN-values
+    DS = xr.open_dataset(variables[output][0])
+    not_nan = ~np.isnan(cell_values(DS.isel(time=slice(0, 1)), output)[0,30,:])
+    
+    ## Time-invariant input
+    DS = xr.open_dataset(path+'zg/zg_icon-a_capped.nc')
+    zg = cell_values(DS, 'zg', not_nan)
+    if data_source == 'narval':
+        DS = xr.open_dataset(path+'../grid_extpar/fr_lake_'+resolution_narval+'_NARVAL_fg_DOM01.nc')
+        fr_lake = cell_values(DS, 'FR_LAKE', not_nan)
+    elif data_source == 'qubicc':
+        DS = xr.open_dataset(path+'/fr_lake/fr_lake_'+resolution_narval+'.nc')
+        fr_lake = cell_values(DS, 'lake', not_nan)
+    
+    # Column -> list of arrays (one per time step) for every NN
+    columns = [{} for j in range(no_NNs)]
+    def add(j, column, values):
+        columns[j].setdefault(column, []).append(values)
+    
+    vert_layers = zg.shape[0]
+    for t, window in time_windows(variables, [0, 1], not_nan):
+        for j in range(no_NNs):
+            # We are not interested in the uppermost layers (denoted by small indices)
+            ind = vert_layers - no_NNs + j
+            for var in vars_3d + ['zg']:
+                var_array = zg if var == 'zg' else window[var][0]
+                for shift, suffix in [(-2, '_i-2'), (-1, '_i-1'), (0, '_i'), (1, '_i+1'), (2, '_i+2')]:
+                    if ind + shift < vert_layers:
+                        add(j, var+suffix, var_array[ind+shift])
+                    else:
+                        # Like the missing columns of load_day
+                        add(j, var+suffix, np.full(var_array.shape[-1], np.nan))
+            add(j, 'fr_lake', fr_lake)
+            add(j, output+'_prev', window[output][1][ind])
+            add(j, output, window[output][0][ind])
+    
+    # Same order of the columns as in load_day
+    order = []
+    for var in vars_3d + ['zg']:
+        order.extend([var+suffix for suffix in ['_i-2', '_i-1', '_i', '_i+1', '_i+2']])
+    order.extend(['fr_lake', output+'_prev', output])
+    dfs = []
+    for j in range(no_NNs):
+        dfs.append(pd.DataFrame({column: np.concatenate(columns[j][column]) for column in order}))
+    return dfs
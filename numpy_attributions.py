@@ -0,0 +1,299 @@
+## Attributions (DeepLIFT-rescale / SHAP values, integrated gradients) of the saved Dense networks in NumPy ##
+# Our models (saved_models/*.h5) are sequences of Dense layers with elementwise activations (relu, linear, tanh,
+# leaky_relu) and possibly BatchNormalization. For those, the DeepLIFT-rescale attributions that
+# shap.DeepExplainer computes can be computed directly from the pre-activations of one forward pass of the
+# samples and one of the background data, without TensorFlow:
+#
+#   phi_k(x) = sum_j w_j * (x - b_j) * M_k(x, b_j)
+#
+# M_k(x, b) is the product of the weight matrices and of the (diagonal) rescale multipliers
+# (f(z_x) - f(z_b))/(z_x - z_b) of every activation (the derivative f'(z_x) where z_x = z_b, as in shap).
+# The background data b_j with (uniform or custom) weights w_j is the same as in DeepExplainer/WeightedDeepExplainer.
+
+import json
+import time
+import h5py
+import numpy as np
+
+def _leaky_relu(z):
+    # tf.nn.leaky_relu uses alpha=0.2
+    return np.where(z > 0, z, 0.2*z)
+
+# Activation function and its derivative
+ACTIVATIONS = {'linear': (lambda z: z, lambda z: np.ones_like(z)),
+               'relu': (lambda z: np.maximum(z, 0), lambda z: (z > 0).astype(z.dtype)),
+               'leaky_relu': (_leaky_relu, lambda z: np.where(z > 0, 1, 0.2).astype(z.dtype)),
+               'tanh': (np.tanh, lambda z: 1 - np.tanh(z)**2),
+               'sigmoid': (lambda z: 1/(1 + np.exp(-z)), lambda z: np.exp(-z)/(1 + np.exp(-z))**2)}
+# Integrated gradients are computed exactly for these
+PIECEWISE_LINEAR = ['linear', 'relu', 'leaky_relu']
+
+class DenseNetwork():
+    '''
+    A sequence of Dense layers z = a W + b, a = f(z). BatchNormalization layers are folded into the next Dense layer.
+    '''
+    def __init__(self, layers):
+        '''
+            layers: List of (W, b, activation)
+        '''
+        for (W, b, activation) in layers:
+            if activation not in ACTIVATIONS:
+                raise ValueError('Activation %s is not supported'%activation)
+        self.layers = layers
+
+    @classmethod
+    def from_h5(cls, file_name, dtype=np.float32):
+        '''
+            Reads a (Sequential) keras model from an h5-file, without TensorFlow.
+        '''
+        with h5py.File(file_name, 'r') as file:
+            config = json.loads(file.attrs['model_config'])
+            weights = file['model_weights']
+            layers = []
+            # BatchNormalization: a -> scale*a + shift. Folded into the next Dense layer.
+            (scale, shift) = (None, None)
+            for layer in config['config']['layers']:
+                class_name, name = layer['class_name'], layer['config']['name']
+                if class_name in ['InputLayer', 'Dropout']:
+                    continue
+                values = [np.array(weights[name][weight_name], dtype=np.float64)
+                          for weight_name in weights[name].attrs['weight_names']]
+                if class_name == 'Dense':
+                    W = values[0]
+                    b = values[1] if layer['config']['use_bias'] else np.zeros(W.shape[1])
+                    if scale is not None:
+                        b = b + shift @ W
+                        W = scale[:, None]*W
+                        (scale, shift) = (None, None)
+                    layers.append((W, b, layer['config']['activation']))
+                elif class_name == 'BatchNormalization':
+                    values = dict(zip([n.decode().split('/')[-1].split(':')[0] for n in weights[name].attrs['weight_names']],
+                                      values))
+                    gamma = values.get('gamma', 1)
+                    beta = values.get('beta', 0)
+                    bn_scale = gamma/np.sqrt(values['moving_variance'] + layer['config']['epsilon'])
+                    bn_shift = beta - values['moving_mean']*bn_scale
+                    if scale is None:
+                        (scale, shift) = (bn_scale, bn_shift)
+                    else:
+                        (scale, shift) = (scale*bn_scale, shift*bn_scale + bn_shift)
+                else:
+                    raise ValueError('Layer %s (%s) is not supported'%(name, class_name))
+            if scale is not None:
+                # BatchNormalization as last layer
+                layers.append((np.diag(scale), shift, 'linear'))
+        return cls([(W.astype(dtype), b.astype(dtype), activation) for (W, b, activation) in layers])
+
+    def astype(self, dtype):
+        return DenseNetwork([(W.astype(dtype), b.astype(dtype), activation) for (W, b, activation) in self.layers])
+
+    @property
+    def no_inputs(self):
+        return self.layers[0][0].shape[0]
+
+    @property
+    def no_outputs(self):
+        return self.layers[-1][0].shape[1]
+
+    def forward(self, X):
+        '''
+            Returns the list of pre-activations z of every layer and the output
+        '''
+        a = np.asarray(X, dtype=self.layers[0][0].dtype)
+        pre_activations = []
+        for (W, b, activation) in self.layers:
+            z = a @ W + b
+            pre_activations.append(z)
+            a = ACTIVATIONS[activation][0](z)
+        return pre_activations, a
+
+    def predict(self, X, batch_size=2**16):
+        return np.concatenate([self.forward(X[i:i+batch_size])[1] for i in range(0, X.shape[0], batch_size)], axis=0)
+
+    def _backward(self, multipliers):
+        # multipliers[l]: (samples, units of layer l). Returns M: (samples, no_inputs, no_outputs)
+        M = None
+        for l in range(len(self.layers) - 1, -1, -1):
+            W = self.layers[l][0]
+            if M is None:
+                # (samples, units, outputs)
+                M = multipliers[l][:, :, None]*np.eye(W.shape[1], dtype=W.dtype)[None]
+            else:
+                M = multipliers[l][:, :, None]*M
+            M = np.matmul(W, M)
+        return M
+
+    def _rescale_multipliers(self, z_x, z_b, eps=1e-6):
+        multipliers = []
+        for (W, b, activation), zx, zb in zip(self.layers, z_x, z_b):
+            f, df = ACTIVATIONS[activation]
+            if activation == 'linear':
+                multipliers.append(np.ones_like(zx))
+                continue
+            delta_in = zx - zb
+            close = np.abs(delta_in) < eps
+            # Avoid division by zero warnings where we use the derivative anyway
+            multipliers.append(np.where(close, df(zx), (f(zx) - f(zb))/np.where(close, 1, delta_in)))
+        return multipliers
+
+    def deeplift(self, X, background, weights=None):
+        '''
+            DeepLIFT-rescale attributions (= shap.DeepExplainer SHAP values) of the samples X w.r.t. the background.
+
+            weights: Optional weight per background sample (see shap_runner.WeightedDeepExplainer)
+            Returns: (no_outputs, samples, no_inputs)
+        '''
+        X = np.asarray(X, dtype=self.layers[0][0].dtype)
+        background = np.asarray(background, dtype=X.dtype)
+        if weights is None:
+            weights = np.ones(background.shape[0])
+        weights = np.asarray(weights, dtype=np.float64)/np.sum(weights)
+
+        z_x, _ = self.forward(X)
+        z_b, _ = self.forward(background)
+        phi = np.zeros((X.shape[0], self.no_inputs, self.no_outputs), dtype=np.float64)
+        for j in np.flatnonzero(weights):
+            multipliers = self._rescale_multipliers(z_x, [z[j:j+1] for z in z_b])
+            M = self._backward(multipliers)
+            phi += weights[j]*((X - background[j])[:, :, None]*M)
+        return np.transpose(phi, (2, 0, 1))
+
+    def _path_breakpoints(self, x, baseline):
+        # 0, 1 and the points alpha in between on the path baseline + alpha*(x - baseline) where a pre-activation
+        # changes its sign.
+        # Between two consecutive breakpoints of the layers before l, z_l is affine in alpha, so the roots of z_l
+        # follow from its values at the breakpoints.
+        alphas = np.array([0., 1.])
+        for l, (W, b, activation) in enumerate(self.layers[:-1]):
+            if activation == 'linear':
+                continue
+            z = self.forward(baseline + alphas[:, None]*(x - baseline))[0][l]
+            (z0, z1) = (z[:-1], z[1:])
+            segment, unit = np.nonzero(z0*z1 < 0)
+            roots = alphas[segment] + (alphas[segment + 1] - alphas[segment])*z0[segment, unit]/(z0[segment, unit] - z1[segment, unit])
+            alphas = np.unique(np.concatenate([alphas, roots]))
+        return alphas
+
+    def integrated_gradients(self, X, baseline, n_steps=50, chunk_size=1000):
+        '''
+            Integrated gradients of the samples X w.r.t. one baseline (e.g. the mean of the background data).
+
+            If all activations are piecewise linear (linear, relu, leaky_relu) the gradient is constant between the
+            points where a pre-activation changes its sign on the straight path from the baseline to x. The path
+            integral is then computed exactly (in float64) as the sum of gradient*segment length over these segments,
+            so the attributions of a sample sum up to F(x) - F(baseline).
+            Otherwise (tanh, sigmoid) it is approximated with the midpoint rule on n_steps points, see
+            completeness_gap.
+
+            chunk_size: Number of segments whose gradients are held in memory at once
+            Returns: (no_outputs, samples, no_inputs)
+        '''
+        X = np.asarray(X, dtype=self.layers[0][0].dtype)
+        baseline = np.asarray(baseline, dtype=X.dtype).reshape(1, -1)
+        grads = np.zeros((X.shape[0], self.no_inputs, self.no_outputs), dtype=np.float64)
+        if all(activation in PIECEWISE_LINEAR for (W, b, activation) in self.layers):
+            network = self.astype(np.float64)
+            (X64, baseline64) = (X.astype(np.float64), baseline.astype(np.float64))
+            for i in range(X.shape[0]):
+                alphas = network._path_breakpoints(X64[i:i+1], baseline64)
+                (midpoints, lengths) = ((alphas[:-1] + alphas[1:])/2, np.diff(alphas))
+                for start in range(0, len(midpoints), chunk_size):
+                    z, _ = network.forward(baseline64 + midpoints[start:start+chunk_size, None]*(X64[i] - baseline64))
+                    M = network._backward([ACTIVATIONS[activation][1](zl) for (W, b, activation), zl in zip(network.layers, z)])
+                    grads[i] += np.tensordot(lengths[start:start+chunk_size], M, axes=1)
+            return np.transpose((X64 - baseline64)[:, :, None]*grads, (2, 0, 1))
+        for alpha in (np.arange(n_steps) + 0.5)/n_steps:
+            z, _ = self.forward(baseline + alpha*(X - baseline))
+            grads += self._backward([ACTIVATIONS[activation][1](zl) for (W, b, activation), zl in zip(self.layers, z)])
+        return np.transpose((X - baseline)[:, :, None]*grads/n_steps, (2, 0, 1))
+
+def completeness_gap(network, X, baseline, phi):
+    '''
+        Largest deviation of the sum of the integrated gradients phi (no_outputs, samples, no_inputs) from
+        F(x) - F(baseline). Zero up to rounding for the exact integrated gradients of piecewise linear networks.
+    '''
+    # The samples and the baseline in the precision in which integrated_gradients saw them
+    dtype = network.layers[0][0].dtype
+    (X, baseline) = [np.asarray(a, dtype=dtype).astype(np.float64) for a in (X, baseline)]
+    network = network.astype(np.float64)
+    difference = network.predict(X) - network.predict(baseline.reshape(1, -1))
+    return np.max(np.abs(np.sum(phi, axis=2).T - difference))
+
+def expected_value(network, background, weights=None):
+    '''
+        The base value: The (weighted) mean prediction on the background data
+    '''
+    if weights is None:
+        weights = np.ones(background.shape[0])
+    return np.dot(np.asarray(weights, dtype=np.float64)/np.sum(weights), network.predict(background))
+
+def averaged_attributions(network, X, background, weights=None, method='deeplift', chunk_size=1000, n_steps=50):
+    '''
+        Mean, variance and mean absolute attributions over all samples X (as in
+        average_absolute_shap_values_on_narval_r2b5.ipynb), accumulated chunk-wise in float64. Never holds more
+        than the attributions of chunk_size samples in memory, so X can contain millions of (memory-mapped) samples.
+
+        method: 'deeplift' (SHAP values w.r.t. the background) or 'integrated_gradients' (w.r.t. the weighted
+                mean of the background)
+
+        Returns: Dictionary with 'mean', 'var', 'mean_abs' of shape (no_outputs, no_inputs), 'no_samples' and
+                 'elapsed_time'. For integrated gradients also the largest 'completeness_gap' over all samples.
+    '''
+    t0 = time.time()
+    if method == 'integrated_gradients':
+        w = np.ones(background.shape[0]) if weights is None else np.asarray(weights, dtype=np.float64)
+        baseline = np.dot(w/np.sum(w), background)
+
+    (sum_phi, sum_sq, sum_abs) = [np.zeros((network.no_outputs, network.no_inputs)) for _ in range(3)]
+    gap = 0
+    for start in range(0, X.shape[0], chunk_size):
+        chunk = np.asarray(X[start:start+chunk_size])
+        if method == 'deeplift':
+            phi = network.deeplift(chunk, background, weights)
+        else:
+            phi = network.integrated_gradients(chunk, baseline, n_steps)
+            gap = max(gap, completeness_gap(network, chunk, baseline, phi))
+        sum_phi += np.sum(phi, axis=1)
+        sum_sq += np.sum(phi**2, axis=1)
+        sum_abs += np.sum(np.abs(phi), axis=1)
+
+    n = X.shape[0]
+    averages = {'mean': sum_phi/n, 'var': np.maximum(sum_sq/n - (sum_phi/n)**2, 0), 'mean_abs': sum_abs/n,
+                'no_samples': n, 'elapsed_time': time.time() - t0}
+    if method == 'integrated_gradients':
+        averages['completeness_gap'] = gap
+    return averages
+
+def write_averaged_attributions(file_name, averages):
+    '''
+        Appends the averages in the format of the files in additional_content/shap_values/averaged_shap_values
+    '''
+    with open(file_name, 'a') as file:
+        file.write('Number of NARVAL samples: %d\n'%averages['no_samples'])
+        file.write('Elapsed time: %.3f\n'%averages['elapsed_time'])
+        file.write('Mean SHAP values:\n')
+        for i in range(averages['mean'].shape[0]):
+            file.write(str(np.around(averages['mean'][i], 3).tolist()))
+        file.write('\nVariance SHAP values:\n')
+        for i in range(averages['var'].shape[0]):
+            file.write(str(np.around(averages['var'][i], 3).tolist()))
+        file.write('\nMean absolute SHAP values:\n')
+        for i in range(averages['mean_abs'].shape[0]):
+            file.write(str(np.around(averages['mean_abs'][i], 3).tolist()))
+        file.write('\n\n')
+
+def compare_with_deep_explainer(model_file, X, background):
+    '''
+        Computes the SHAP values of shap.DeepExplainer and of DenseNetwork.deeplift for the samples X.
+        Requires TensorFlow and shap. Returns the maximum absolute difference and the maximum absolute SHAP value.
+    '''
+    import shap
+    from tensorflow import nn
+    from tensorflow.keras.models import load_model
+    model = load_model(model_file, {'leaky_relu': nn.leaky_relu})
+    shap_values = shap.DeepExplainer(model=model, data=background).shap_values(X=X, check_additivity=False)
+    if not isinstance(shap_values, list):
+        shap_values = [shap_values]
+    shap_values = np.stack(shap_values)
+    numpy_values = DenseNetwork.from_h5(model_file).deeplift(X, background)
+    return np.max(np.abs(shap_values - numpy_values)), np.max(np.abs(shap_values))
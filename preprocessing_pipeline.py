@@ -0,0 +1,759 @@
+## The preprocessing notebooks of all six models as one pipeline ##
+# n1-n3: preprocessing.ipynb, q1-q3: preprocessing_narval.ipynb and preprocessing_qubicc.ipynb. Every notebook is
+# split into explicit stages:
+#   load     Reads the NetCDF data with load_data (n3: load_day, one stage per day)
+#   samples  Brings the variables to equal shapes, builds the columns (n2, q2) or the neighborhood (q3) and flattens
+#            them into samples
+#   select   Checks the samples and removes data above 21kms and condensate-free clouds in one pass (data_validation),
+#            then downsamples the cloud-free samples
+#   split    Splits into training/validation/test sets (n1-n3)
+#   save     Gathers (and for n1-n3 scales) the samples and writes the npy-files. With --split_manifests, n1 and n2
+#            write the unscaled samples once and the sets as a manifest (splits.py), which standardizes when reading
+# The output of every stage is cached in an InputCache, keyed by the parameters of the stage and the keys of the
+# stages it depends on (the load stages also by the files_fingerprint of the files they read). So if only e.g. the
+# downsampling changes, the data is neither loaded nor reshaped again, and an interrupted run continues after the
+# last stage it finished. Stages that do not depend on each other (different models, the days of n3) run in parallel.
+#
+# The npy-files are byte-identical to the ones of the notebooks: Every stage runs the same numpy/pandas operations
+# on the same data and the state of np.random is carried over from one stage to the next.
+#
+# With --output_type both, q1-q3 are preprocessed once for cloud cover and cloud area fraction: cl and cl_area are
+# loaded together and share the input features, the filters and the downsampling (which depend on cl only, as in
+# the notebooks), so cloud_area_output_<source>.npy is aligned with cloud_cover_input_<source>.npy by construction.
+# This replaces the second run of the notebooks with output_var = 'cl_area'.
+#
+# python preprocessing_pipeline.py                                   # All models, cloud cover
+# python preprocessing_pipeline.py --models q1_narval q1_qubicc --output_type both --workers 2
+#
+# Every worker holds the data of its stage in memory (the QUBICC stages ~900GB on the full data set), so choose
+# --workers according to the memory of the node.
+
+import os
+import sys
+import json
+import time
+import argparse
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import numpy as np
+import pandas as pd
+
+from input_cache import InputCache, files_fingerprint
+from data_paths import data_path
+from telemetry import stage
+from data_validation import validate, violations, print_report
+from provenance import ProvenanceIndex
+from iconml.features import above_and_below, surface_field
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+VERT_LAYERS = 31
+
+# The names of the variables in the two data sets
+NAMES = {'narval': {'cloud_cover': 'clc', 'qc': 'qc', 'qi': 'qi', 'temp': 'temp', 'pres': 'pres'},
+         'qubicc': {'cloud_cover': 'cl', 'qc': 'clw', 'qi': 'cli', 'temp': 'ta', 'pres': 'pfull'}}
+
+# vars: The input variables of the notebook (order_of_vars without the output variable)
+# seed: np.random.seed of the notebook (and NUM of the file names for n1-n3)
+MODELS = OrderedDict([
+    ('n1', {'source': 'narval', 'resolution': 'R02B04', 'days': 'all', 'seed': 1,
+            'vars': ['qv', 'qi', 'temp', 'pres', 'zg', 'fr_land'],
+            'samples': {'type': 'cell'},
+            'select': {'filters': ['below_21km'], 'downsample': 'concat'},
+            'split': {'test_ratio': 0.2, 'valid_ratio': 0.1},
+            'save': {'folder': 'grid_cell_based_v3', 'prefix': 'cloud_cover_all_days_',
+                     'infofile': 'model_grid_cell_based_v3_final_%d.txt'}}),
+    # fr_land is loaded and deleted right away in the notebook
+    ('n2', {'source': 'narval', 'resolution': 'R02B04', 'days': 'all', 'seed': 1,
+            'vars': ['qv', 'qc', 'qi', 'temp', 'pres', 'rho', 'zg', 'fr_lake'],
+            'samples': {'type': 'column', 'layer_offset': 0, 'drop': ['zg_4', 'zg_5', 'zg_6', 'qc_4']},
+            'split': {'test_ratio': 0.2, 'valid_ratio': 0.1},
+            'save': {'folder': 'grid_column_based', 'prefix': 'cloud_cover_',
+                     'infofile': 'model_capped_grid_column_based_final_%d.txt'}}),
+    # The stencils (and clc of the previous time step) are built by load_day of n3/source_code/for_preprocessing.py
+    ('n3', {'source': 'narval', 'resolution': 'R02B04', 'days': 'all', 'seed': 1, 'no_NNs': 27,
+            'split': {'test_ratio': 0.2, 'valid_ratio': 0.1},
+            'save': {'folder': 'region_based', 'prefix': 'cloud_cover_',
+                     'infofile': 'model_region_based_final_%d.txt'}}),
+    ('q1_narval', {'source': 'narval', 'resolution': 'R02B05', 'days': 'all', 'seed': 10,
+                   'vars': ['qv', 'qc', 'qi', 'temp', 'pres', 'u', 'v', 'zg', 'coriolis', 'fr_land'],
+                   'samples': {'type': 'cell'},
+                   'select': {'filters': ['below_21km', 'not_nan', 'physical', 'condensate_free'],
+                              'downsample': 'sorted'},
+                   'save': {'folder': 'grid_cell_based_QUBICC_R02B05'}}),
+    # Converted to float32 after loading, every third time step, only the lowest 27 layers (instead of zg < 21000),
+    # half as many cloud-free as cloudy samples
+    ('q1_qubicc', {'source': 'qubicc', 'resolution': 'R02B05', 'days': 'all_hcs', 'seed': 10,
+                   'vars': ['hus', 'clw', 'cli', 'ta', 'pfull', 'ua', 'va', 'zg', 'coriolis', 'fr_land'],
+                   'samples': {'type': 'cell', 'float32': True, 'subsample': 3, 'drop_upper_layers': 4},
+                   'select': {'filters': ['not_nan', 'condensate_free'], 'downsample': 'sorted_half'},
+                   'save': {'folder': 'grid_cell_based_QUBICC_R02B05'}}),
+    ('q2_narval', {'source': 'narval', 'resolution': 'R02B05', 'days': 'all', 'seed': None,
+                   'vars': ['qv', 'qc', 'qi', 'temp', 'pres', 'zg', 'fr_land'],
+                   'samples': {'type': 'column', 'layer_offset': 17, 'check_temperature': True},
+                   'save': {'folder': 'grid_column_based_QUBICC_R02B05'}}),
+    # The time steps are removed based on cl (not the output variable) and the arrays are saved as (features, samples)
+    ('q2_qubicc', {'source': 'qubicc', 'resolution': 'R02B05', 'days': 'all_hcs', 'seed': None,
+                   'vars': ['hus', 'clw', 'cli', 'ta', 'pfull', 'zg', 'fr_land'],
+                   'samples': {'type': 'column', 'layer_offset': 17, 'check_temperature': True,
+                               'remove_steps_by': 'cl'},
+                   'save': {'folder': 'grid_column_based_QUBICC_R02B05', 'features_first': True}}),
+    # A nan above a grid cell is replaced by the value of the grid cell (3/4 of it for the NARVAL pressure)
+    ('q3_narval', {'source': 'narval', 'resolution': 'R02B05', 'days': 'all', 'seed': 10,
+                   'vars': ['qv', 'qc', 'qi', 'temp', 'pres', 'u', 'v', 'zg', 'coriolis'],
+                   'samples': {'type': 'neighborhood', 'pres_factor': 3/4},
+                   'select': {'filters': ['below_21km', 'not_nan', 'physical', 'condensate_free'],
+                              'downsample': 'sorted'},
+                   'save': {'folder': 'region_based_one_nn_R02B05'}}),
+    ('q3_qubicc', {'source': 'qubicc', 'resolution': 'R02B05', 'days': 'all_hcs', 'seed': 10, 'dtype': 'float32',
+                   'vars': ['hus', 'clw', 'cli', 'ta', 'pfull', 'ua', 'va', 'zg', 'coriolis'],
+                   'samples': {'type': 'neighborhood', 'subsample': 3},
+                   'select': {'filters': ['below_21km', 'not_nan', 'physical', 'condensate_free'],
+                              'downsample': 'sorted'},
+                   'save': {'folder': 'region_based_one_nn_R02B05'}}),
+])
+
+def output_variable(model, output_type='cloud_cover'):
+    '''
+        The output variable of model: clc/cl (cloud_cover), cl_area (cloud_area) or the list [clc/cl, cl_area]
+        (both). n1-n3 only exist for cloud cover.
+    '''
+    config = MODELS[model]
+    if output_type == 'cloud_cover':
+        return NAMES[config['source']]['cloud_cover']
+    if model in ['n1', 'n2', 'n3']:
+        raise ValueError('There is no cloud area fraction version of %s'%model)
+    if output_type == 'both':
+        return [NAMES[config['source']]['cloud_cover'], 'cl_area']
+    return 'cl_area'
+
+def _targets(output_var):
+    # The output variables of a run: [output_var], or [clc/cl, cl_area] for output_type both
+    return [output_var] if isinstance(output_var, str) else list(output_var)
+
+def order_of_vars(config, output_var):
+    # For cl_area the notebooks still need clc/cl (condensate-free clouds, downsampling), so we load it as well.
+    # It is never part of the saved input.
+    cloud_cover = NAMES[config['source']]['cloud_cover']
+    targets = _targets(output_var)
+    return config['vars'] + targets + ([cloud_cover] if cloud_cover not in targets else [])
+
+def _import_for_preprocessing():
+    sys.path.insert(0, os.path.join(ROOT, 'n3_neighborhood_based_narval_r2b4', 'source_code'))
+    import for_preprocessing
+    return for_preprocessing
+
+def _n3_path():
+    return data_path('my_work/NARVAL/data_var_vertinterp/')
+
+def n3_days():
+    # All days with temperature files (temperature as an arbitrary variable). The notebook takes them from a set (in
+    # an order that depends on the hash seed of the kernel), we take them in chronological order.
+    days = set()
+    for file_name in os.listdir(os.path.join(_n3_path(), 'temp')):
+        days.add(file_name.split(sep='_')[5])
+    return sorted(days)
+
+def _output_columns(config, output_var):
+    if config.get('samples', {}).get('type') == 'column':
+        return ['%s_%d'%(output_var, i + config['samples']['layer_offset']) for i in range(4, VERT_LAYERS)]
+    return [output_var]
+
+def _rng_state():
+    # The state of np.random, as arrays that can be cached along with the output of a stage
+    (_, keys, pos, has_gauss, cached_gaussian) = np.random.get_state()
+    return {'_rng_keys': keys, '_rng_state': np.array([pos, has_gauss, cached_gaussian], dtype=np.float64)}
+
+def _set_rng_state(arrays):
+    np.random.set_state(('MT19937', np.array(arrays['_rng_keys']), int(arrays['_rng_state'][0]),
+                         int(arrays['_rng_state'][1]), float(arrays['_rng_state'][2])))
+
+def _split_train_test(length, test_ratio):
+    # split_train_test of the notebooks on positions. Returns the positions of the train and the test set.
+    shuffled_indices = np.random.permutation(length)
+    test_set_size = int(length*test_ratio)
+    return shuffled_indices[test_set_size:], shuffled_indices[:test_set_size]
+
+def _split_input_output(dataset, outputs):
+    # Modifies dataset as well. A Series for one output variable, a DataFrame for the column-based models.
+    if len(outputs) == 1:
+        output_df = dataset[outputs[0]]
+        del dataset[outputs[0]]
+        return output_df
+    output_df = pd.DataFrame()
+    for key in outputs:
+        output_df[key] = dataset[key]
+        del dataset[key]
+    return output_df
+
+def _columns(arrays):
+    # The names of the cached samples (without the arrays that start with an underscore)
+    return [name for name in arrays.keys() if not name.startswith('_')]
+
+def _save(file_name, array):
+    # Written to a temporary file first, so that an interrupted run never leaves a truncated npy-file behind
+    tmp_file = file_name + '.tmp%d'%os.getpid()
+    with open(tmp_file, 'wb') as file:
+        np.save(file, array)
+    os.replace(tmp_file, file_name)
+    return file_name
+
+def _save_provenance(file_name, samples, rows):
+    # samples_provenance_<source>.npz: The place of the samples on the grid (see provenance.py)
+    if '_grid_shape' not in samples:
+        print('No provenance index for %s: The cached samples are from an older version'%file_name)
+        return []
+    index = ProvenanceIndex(rows, samples['_grid_shape'], samples['_time_steps'],
+                            int(samples['_first_layer']) if '_first_layer' in samples else 1,
+                            samples['_layers'] if '_layers' in samples else None,
+                            samples['_cells'] if '_cells' in samples else None,
+                            int(samples['_horiz_fields']) if '_horiz_fields' in samples else None)
+    tmp_file = file_name + '.tmp%d'%os.getpid()
+    index.save(tmp_file)
+    os.replace(tmp_file, file_name)
+    return [file_name]
+
+def _write_scaler(file, scaler, layer=None):
+    if layer is None:
+        file.write('Standard Scaler mean values:\n')
+        file.write(str(scaler.mean_))
+        file.write('\nStandard Scaler standard deviation:\n')
+        file.write(str(np.sqrt(scaler.var_)))
+    else:
+        file.write('The mean values of the %d-th Standard Scaler: \n %s'%(layer, str(scaler.mean_)))
+        file.write('\nThe standard deviation values of the %d-th Standard Scaler: \n %s \n'
+                   %(layer, str(np.sqrt(scaler.var_))))
+
+############
+## Stages ##
+############
+# Every stage gets the cache, the configuration of the model, the output variable, the keys of the stages it depends
+# on and its parameters. It returns a dictionary of arrays, which is then cached. output_var is a list for
+# output_type both (see _targets).
+
+def load_stage(cache, config, output_var, upstream, params):
+    from my_classes import load_data
+    dtype = None if config.get('dtype') is None else np.dtype(config['dtype'])
+    data_dict, not_nan = load_data(source=config['source'], days=params['days'], resolution=config['resolution'],
+                                   order_of_vars=order_of_vars(config, output_var), dtype=dtype, return_not_nan=True)
+    # For the provenance index: The ICON cell of every horizontal field of the data and the size of the grid
+    data_dict.update(_cells=np.flatnonzero(not_nan).astype(np.int32), _horiz_fields=np.array(len(not_nan)))
+    return data_dict
+
+def load_day_stage(cache, config, output_var, upstream, params):
+    '''
+        load_day of n3 for one day. The array '<layer>_<column>' is the column of the dataframe of the layer.
+        Columns that load_day cannot fill (i+1, i+2 of the lowest layers) are all nan and not stored.
+    '''
+    dfs = _import_for_preprocessing().load_day(params['day'], config['no_NNs'], _n3_path())
+    arrays = OrderedDict([('_columns', np.array(list(dfs[0].columns)))])
+    for j in range(len(dfs)):
+        for name in dfs[j].columns:
+            if dfs[j][name].dtype == object:
+                assert dfs[j][name].isnull().all()
+                continue
+            arrays['%d_%s'%(j, name)] = dfs[j][name].values
+    return arrays
+
+def _layer_frame(day, layer):
+    # dfs[layer] of load_day
+    columns = OrderedDict()
+    length = len(day['%d_clc'%layer])
+    for name in day['_columns']:
+        key = '%d_%s'%(layer, name)
+        columns[str(name)] = day[key] if key in day else np.full(length, np.nan, dtype=object)
+    return pd.DataFrame(columns)
+
+def samples_stage(cache, config, output_var, upstream, params):
+    '''
+        Brings all variables to equal shapes and flattens them into samples (in the order of the DataFrame of the
+        notebook). The cell- and neighborhood-based models additionally carry the vertical layer of every sample
+        along (_vert_layers).
+    '''
+    data_dict = OrderedDict(cache.get(upstream['load']))
+    # Not a variable, only passed on to the provenance index
+    provenance = OrderedDict((key, data_dict.pop(key)) for key in ['_cells', '_horiz_fields'] if key in data_dict)
+    samples = config['samples']
+    names = NAMES[config['source']]
+    (TIME_STEPS, VERT_LAYERS, HORIZ_FIELDS) = data_dict[names['cloud_cover']].shape
+    # For the provenance index: The time steps of the loaded data that are kept
+    time_steps = np.arange(TIME_STEPS, dtype=np.int32)
+
+    targets = _targets(output_var)
+    if samples.get('check_temperature') and names['cloud_cover'] in targets:
+        # Are there any bad data points
+        assert not np.any(data_dict[names['temp']] == 0)
+
+    #Reshaping into nd-arrays of equaling shapes (don't reshape in the vertical)
+    for key in data_dict.keys():
+        if data_dict[key].ndim < 3:
+            data_dict[key] = np.repeat(np.expand_dims(data_dict[key], 0), TIME_STEPS, axis=0)
+        if data_dict[key].ndim == 2 and samples['type'] != 'column':
+            data_dict[key] = np.repeat(np.expand_dims(data_dict[key], 1), VERT_LAYERS, axis=1)
+    if samples['type'] == 'neighborhood':
+        # Surface temperature
+        temp_sfc = surface_field(data_dict[names['temp']])
+
+    if config['source'] == 'qubicc':
+        # Remove the first timesteps of the QUBICC simulations since the clc values are 0 across the entire earth there
+        # (both targets: by cl, so that the samples of cl_area are the ones of cl)
+        remove_steps_by = samples.get('remove_steps_by', targets[0])
+        remove_steps = []
+        for i in range(data_dict[remove_steps_by].shape[0]):
+            if np.all(data_dict[remove_steps_by][i,4:,:] == 0):
+                remove_steps.append(i)
+                TIME_STEPS = TIME_STEPS - 1
+        time_steps = np.delete(time_steps, remove_steps)
+        for key in data_dict.keys():
+            data_dict[key] = np.delete(data_dict[key], remove_steps, axis=0)
+            if samples.get('float32'):
+                data_dict[key] = np.float32(data_dict[key])
+        if samples['type'] == 'neighborhood':
+            temp_sfc = np.float32(np.delete(temp_sfc, remove_steps, axis=0))
+        # Our Neural Network has trained with clc in [0, 100]!
+        for target in targets:
+            data_dict[target] = 100*data_dict[target]
+
+    if samples['type'] == 'column':
+        # One sample should contain a column of information
+        data_dict_reshaped = OrderedDict()
+        for key in data_dict.keys():
+            if data_dict[key].shape[1] == VERT_LAYERS:
+                # Removing data above 21kms
+                for i in range(4, VERT_LAYERS):
+                    new_key = '{}{}{:d}'.format(key,'_',(i + samples['layer_offset']))
+                    data_dict_reshaped[new_key] = np.reshape(data_dict[key][:,i,:], -1)
+            else:
+                data_dict_reshaped[key] = np.reshape(data_dict[key], -1)
+        # Remove constant fields
+        for key in samples.get('drop', []):
+            del data_dict_reshaped[key]
+        data_dict_reshaped.update(_grid_shape=np.array([TIME_STEPS, HORIZ_FIELDS]), _time_steps=time_steps,
+                                  _layers=np.arange(5, VERT_LAYERS + 1, dtype=np.int16), **provenance)
+        return data_dict_reshaped
+
+    # Carry along information about the vertical layer of a grid cell. int16 is sufficient for < 1000.
+    vert_layers = np.int16(np.repeat(np.expand_dims(np.arange(1, VERT_LAYERS+1), 0), TIME_STEPS, axis=0))
+    vert_layers = np.repeat(np.expand_dims(vert_layers, 2), HORIZ_FIELDS, axis=2)
+
+    if samples.get('subsample'):
+        # Only every third hour of the QUBICC data (we assume a relatively high temporal correlation)
+        for key in data_dict.keys():
+            data_dict[key] = data_dict[key][0::samples['subsample']]
+        vert_layers = vert_layers[0::samples['subsample']]
+        time_steps = time_steps[0::samples['subsample']]
+        if samples['type'] == 'neighborhood':
+            temp_sfc = temp_sfc[0::samples['subsample']]
+
+    if samples['type'] == 'neighborhood':
+        above = OrderedDict()
+        below = OrderedDict()
+        for key in config['vars']:
+            if key != 'coriolis':
+                factor = samples.get('pres_factor', 1) if key == names['pres'] else 1
+                above[key], below[key] = above_and_below(data_dict[key], factor)
+
+    # Reshaping into 1D-arrays (the following is based on Aurelien Geron)
+    drop = samples.get('drop_upper_layers', 0)
+    for key in data_dict.keys():
+        data_dict[key] = np.reshape(data_dict[key][:, drop:, :], -1)
+    if samples['type'] == 'neighborhood':
+        for key in above.keys():
+            data_dict['%s_below'%key] = np.reshape(below[key], -1)
+            data_dict['%s_above'%key] = np.reshape(above[key], -1)
+        data_dict['temp_sfc'] = np.reshape(temp_sfc, -1)
+    data_dict['_vert_layers'] = np.reshape(vert_layers[:, drop:, :], -1)
+    data_dict.update(_grid_shape=np.array([len(time_steps), VERT_LAYERS - drop, HORIZ_FIELDS]),
+                     _time_steps=time_steps, _first_layer=np.array(drop + 1), **provenance)
+    return data_dict
+
+def select_rules(config, output_var):
+    '''
+        The filters of the select stage as rules of data_validation
+    '''
+    names = NAMES[config['source']]
+    filters = config['select']['filters']
+    rules = []
+    if 'below_21km' in filters:
+        # Remove data above 21kms
+        rules.append({'name': 'below_21km', 'action': 'keep', 'where': [['zg', '<', 21000]]})
+    if 'not_nan' in filters:
+        # There are no nans left
+        rules.append({'name': 'not_nan', 'action': 'check', 'where': [['*', 'notnan']]})
+    if 'physical' in filters and names['cloud_cover'] in _targets(output_var):
+        # Some quick sanity checks regarding the input data
+        rules.append({'name': 'physical', 'action': 'check',
+                      'where': [[names['temp'], '>', 150], [names['pres'], '>', 150]]})
+        # The upper levels have been cut off so there are no wrong values in the data anymore
+        rules.append({'name': 'model_top', 'action': 'check', 'where': [[names['temp'] + '_above', '!=', 1000]],
+                      'optional': True})
+    if 'condensate_free' in filters:
+        # Remove condensate-free clouds (7.3% of clouds)
+        rules.append({'name': 'condensate_free', 'action': 'drop',
+                      'where': [[names['cloud_cover'], '>', 0], [names['qc'], '==', 0], [names['qi'], '==', 0]],
+                      'of': [[names['cloud_cover'], '>', 0]]})
+    return rules
+
+def select_stage(cache, config, output_var, upstream, params):
+    '''
+        Returns the (row) index of the selected samples in the order of the notebook, the state of np.random after
+        the downsampling and the data-quality report of the filters (json).
+    '''
+    samples = cache.get(upstream['samples'])
+    select = config['select']
+    names = NAMES[config['source']]
+    cloud_cover = samples[names['cloud_cover']]
+    np.random.seed(config['seed'])
+
+    mask, report = validate(samples, select_rules(config, output_var))
+    print_report(report)
+    assert len(violations(report)) == 0, 'Invalid samples: %s'%violations(report)
+    index = np.flatnonzero(mask)
+
+    # We ensure that clc != 0 is as large as clc = 0 and keep the original order intact
+    noclc_indices = index[cloud_cover[index] == 0]
+    clc_indices = index[cloud_cover[index] != 0]
+    downsample_ratio = (len(index) - len(noclc_indices))/len(noclc_indices)
+    if select['downsample'] == 'concat':
+        # n1: Cloud-free samples first, in random order
+        shuffled_indices = np.random.permutation(len(noclc_indices))
+        set_size = int(len(noclc_indices)*downsample_ratio)
+        index = np.concatenate((noclc_indices[shuffled_indices[:set_size]], clc_indices))
+    else:
+        shuffled_indices = np.random.permutation(noclc_indices)
+        size_noclc = int(len(noclc_indices)*downsample_ratio)
+        if select['downsample'] == 'sorted_half':
+            size_noclc = size_noclc//2
+        # Sort final_indices so that we can more or less recover the timesteps
+        index = np.sort(np.concatenate((shuffled_indices[:size_noclc], clc_indices)))
+    arrays = {'index': index, 'report': np.array(json.dumps(report))}
+    arrays.update(_rng_state())
+    return arrays
+
+def split_stage(cache, config, output_var, upstream, params):
+    '''
+        Returns the (row) index of the train, valid and test set. For n3 one per layer, e.g. train_0, ..., train_26.
+    '''
+    split = config['split']
+    if 'select' in upstream:
+        selected = cache.get(upstream['select'])
+        _set_rng_state(selected)
+        index = np.asarray(selected['index'])
+    else:
+        np.random.seed(config['seed'])
+    arrays = OrderedDict()
+    if 'no_NNs' in config:
+        # All layers have the same number of samples
+        length = sum([len(cache.get(upstream[name])['0_clc']) for name in upstream.keys() if name.startswith('load_')])
+        learning_indices = []
+        for i in range(config['no_NNs']):
+            learning, arrays['test_%d'%i] = _split_train_test(length, split['test_ratio'])
+            learning_indices.append(learning)
+        for i in range(config['no_NNs']):
+            train, valid = _split_train_test(len(learning_indices[i]), split['valid_ratio'])
+            arrays['train_%d'%i] = learning_indices[i][train]
+            arrays['valid_%d'%i] = learning_indices[i][valid]
+        return arrays
+    if 'select' not in upstream:
+        samples = cache.get(upstream['samples'])
+        index = np.arange(len(samples[_columns(samples)[0]]))
+    learning, test = _split_train_test(len(index), split['test_ratio'])
+    train, valid = _split_train_test(len(learning), split['valid_ratio'])
+    arrays['train'] = index[learning[train]]
+    arrays['valid'] = index[learning[valid]]
+    arrays['test'] = index[test]
+    return arrays
+
+def _save_manifest(samples, index, columns, outputs, scaler, path, prefix, NUM):
+    # <prefix>{input,output}_<NUM>.npy: The unscaled samples of all sets (in the order of the samples), and
+    # <prefix>splits_<NUM>.npz: The rows of the sets in them and the scaler (see splits.py)
+    from splits import SplitManifest
+    rows = np.sort(np.concatenate([index[name] for name in ['train', 'valid', 'test']]))
+    input_columns = [column for column in columns if column not in outputs]
+    files = [_save(os.path.join(path, prefix + 'input_%d.npy'%NUM),
+                   np.column_stack([samples[column][rows] for column in input_columns])),
+             _save(os.path.join(path, prefix + 'output_%d.npy'%NUM),
+                   samples[outputs[0]][rows] if len(outputs) == 1 else
+                   np.column_stack([samples[column][rows] for column in outputs]))]
+    manifest = SplitManifest(files[0], files[1], OrderedDict((name, np.searchsorted(rows, index[name]))
+                                                             for name in ['train', 'valid', 'test']),
+                             scaler.mean_, scaler.scale_)
+    files.append(manifest.save(os.path.join(path, prefix + 'splits_%d.npz'%NUM)))
+    files += _save_provenance(os.path.join(path, prefix + 'provenance_%d.npz'%NUM), samples, rows)
+    return files
+
+def _save_scaled(cache, config, output_var, upstream, params):
+    # n1, n2: Standard scaling based on the training set, which is written into scaler_<NUM>.txt. With
+    # params['manifest'] the sets are a manifest over one file instead of six scaled copies.
+    from sklearn.preprocessing import StandardScaler
+    from my_classes import write_infofile
+    samples = cache.get(upstream['samples'])
+    index = cache.get(upstream['split'])
+    columns = _columns(samples)
+    outputs = _output_columns(config, output_var)
+    NUM = config['seed']
+    path = params['output_path']
+    prefix = config['save']['prefix']
+    input_sets = OrderedDict()
+    output_sets = OrderedDict()
+    for name in (['train'] if params.get('manifest') else ['valid', 'train', 'test']):
+        dataset = pd.DataFrame.from_dict(OrderedDict((column, samples[column][index[name]]) for column in columns))
+        output_sets[name] = _split_input_output(dataset, outputs)
+        input_sets[name] = dataset
+    scaler = StandardScaler()
+    scaler.fit(input_sets['train'])
+    files = []
+    if params.get('manifest'):
+        files = _save_manifest(samples, index, columns, outputs, scaler, path, prefix, NUM)
+    else:
+        for name in ['train', 'valid', 'test']:
+            files.append(_save(os.path.join(path, prefix + 'input_%s_%d.npy'%(name, NUM)),
+                               scaler.transform(input_sets[name])))
+            files.append(_save(os.path.join(path, prefix + 'output_%s_%d.npy'%(name, NUM)), output_sets[name]))
+            files += _save_provenance(os.path.join(path, prefix + 'provenance_%s_%d.npz'%(name, NUM)), samples,
+                                      index[name])
+    with open(os.path.join(params['model_path'], 'scaler_%d.txt'%NUM), 'w') as file:
+        _write_scaler(file, scaler)
+    # Write the accompanying info-file
+    with open(os.path.join(params['model_path'], config['save']['infofile']%NUM), 'w') as file:
+        write_infofile(file, str(pd.Index(columns)), str(np.array([c for c in columns if c not in outputs])),
+                       params['model_path'], path, NUM, files[:3] if params.get('manifest') else None)
+    return files
+
+def _save_layers(cache, config, output_var, upstream, params):
+    # n3: One standard scaler per layer, the sets of all layers are concatenated
+    from sklearn.preprocessing import StandardScaler
+    from my_classes import write_infofile
+    days = [cache.get(upstream[name]) for name in upstream.keys() if name.startswith('load_')]
+    index = cache.get(upstream['split'])
+    NUM = config['seed']
+    sets = OrderedDict([(name, ([], [])) for name in ['train', 'valid', 'test']])
+    with open(os.path.join(params['model_path'], 'scaler_%d.txt'%NUM), 'w') as file:
+        for i in range(config['no_NNs']):
+            df = pd.concat([_layer_frame(day, i) for day in days], ignore_index=True)
+            datasets = OrderedDict()
+            for name in ['valid', 'train', 'test']:
+                datasets[name] = df.iloc[index['%s_%d'%(name, i)]]
+                sets[name][1].append(_split_input_output(datasets[name], [output_var]))
+            del df
+            scaler = StandardScaler()
+            scaler.fit(datasets['train'])
+            for name in ['train', 'valid', 'test']:
+                sets[name][0].append(scaler.transform(datasets[name]))
+            _write_scaler(file, scaler, i)
+    files = []
+    for name in ['train', 'valid', 'test']:
+        # We reduce the number of saved files by concatenating
+        files.append(_save(os.path.join(params['output_path'], config['save']['prefix'] + 'input_%s_%d.npy'%(name, NUM)),
+                           np.concatenate(sets[name][0])))
+        files.append(_save(os.path.join(params['output_path'], config['save']['prefix'] + 'output_%s_%d.npy'%(name, NUM)),
+                           np.concatenate(sets[name][1])))
+    # Write the accompanying info-file
+    columns = pd.Index([str(name) for name in days[0]['_columns']])
+    with open(os.path.join(params['model_path'], config['save']['infofile']%NUM), 'w') as file:
+        write_infofile(file, str(columns), str(columns[:-1]), params['model_path'], params['output_path'], NUM)
+    return files
+
+def _save_unscaled(cache, config, output_var, upstream, params):
+    # q1-q3: Neither scaled nor split (this is done by the cross-validation), cloud_cover_input_<source>.npy etc.
+    # For both targets, the input and the outputs are taken from the same samples and rows.
+    samples = cache.get(upstream['samples'])
+    columns = _columns(samples)
+    targets = _targets(output_var)
+    outputs = OrderedDict((target, _output_columns(config, target)) for target in targets)
+    source = config['source']
+    cloud_cover = NAMES[source]['cloud_cover']
+    path = params['output_path']
+    if config['save'].get('features_first'):
+        # Convert dict into np array
+        output_columns = [column for target in targets for column in outputs[target]]
+        data_reshaped = np.array([samples[column] for column in columns if column not in output_columns])
+        output = OrderedDict((target, np.array([samples[column] for column in outputs[target]])) for target in targets)
+    else:
+        if 'select' in upstream:
+            index = cache.get(upstream['select'])['index']
+            df = pd.DataFrame.from_dict(OrderedDict((column, samples[column][index]) for column in columns))
+        else:
+            df = pd.DataFrame.from_dict(OrderedDict((column, np.asarray(samples[column])) for column in columns))
+        output = OrderedDict((target, _split_input_output(df, outputs[target])) for target in targets)
+        data_reshaped = df
+    files = []
+    if cloud_cover in targets:
+        files.append(_save(os.path.join(path, 'cloud_cover_input_%s.npy'%source), np.float32(data_reshaped)))
+        files.append(_save(os.path.join(path, 'cloud_cover_output_%s.npy'%source), np.float32(output[cloud_cover])))
+        # Save the corresponding vertical layers (int16 is sufficient for layers < 1000)
+        if '_vert_layers' in samples and 'select' in upstream:
+            files.append(_save(os.path.join(path, 'samples_vertical_layers_%s.npy'%source),
+                               samples['_vert_layers'][index]))
+        rows = index if 'select' in upstream else np.arange(len(samples[columns[0]]))
+        files += _save_provenance(os.path.join(path, 'samples_provenance_%s.npz'%source), samples, rows)
+    if 'cl_area' in targets:
+        files.append(_save(os.path.join(path, 'cloud_area_output_%s.npy'%source), np.float32(output['cl_area'])))
+    return files
+
+def save_stage(cache, config, output_var, upstream, params):
+    '''
+        Writes the npy-files into params['output_path'] (and for n1-n3 the scaler and the info-file into
+        params['model_path']). Returns the list of files.
+    '''
+    os.makedirs(params['output_path'], exist_ok=True)
+    os.makedirs(params['model_path'], exist_ok=True)
+    if 'no_NNs' in config:
+        files = _save_layers(cache, config, output_var, upstream, params)
+    elif 'split' in config:
+        files = _save_scaled(cache, config, output_var, upstream, params)
+    else:
+        files = _save_unscaled(cache, config, output_var, upstream, params)
+    return {'files': np.array(files)}
+
+STAGES = {'load': load_stage, 'load_day': load_day_stage, 'samples': samples_stage, 'select': select_stage,
+          'split': split_stage, 'save': save_stage}
+
+##############
+## Planning ##
+##############
+
+def plan(cache, model, output_type='cloud_cover', days=None, output_path=None, model_path=None,
+         split_manifests=False):
+    '''
+        Returns the stages of model as an OrderedDict key -> task (in an order in which they can run). A task is a
+        dictionary with the name of the stage, its parameters and the keys of the stages it depends on (upstream).
+        All keys are known before any stage runs, as they only hash parameters and the keys of earlier stages.
+
+        output_type: cloud_cover, cloud_area or both (q1-q3: both targets from one load, samples and select stage)
+        days:        Days to load instead of the ones of the notebook (load_data, not n3), e.g. 'dec_1st'
+        output_path: Write the npy-files into output_path/<folder> instead of the folder of the notebook
+        model_path:  Directory for scaler_<NUM>.txt and the info-file of n1-n3. By default the one of the npy-files.
+        split_manifests: n1, n2: Write the unscaled samples once and the sets as a manifest (see splits.py) instead
+                     of six scaled npy-files
+    '''
+    config = MODELS[model]
+    output_var = output_variable(model, output_type)
+    tasks = OrderedDict()
+    def add(name, params, upstream):
+        # Only the parameters of the stage itself, so that e.g. a change of the downsampling keeps the samples
+        stage_config = {k: config[k] for k in [name] + (['seed'] if name in ['select', 'split'] else []) if k in config}
+        key = cache.get_key(stage=name, output_var=output_var, params=params, upstream=upstream, config=stage_config)
+        tasks[key] = {'stage': name, 'model': model, 'output_var': output_var, 'params': params, 'upstream': upstream}
+        return key
+
+    upstream = OrderedDict()
+    if 'no_NNs' in config:
+        for_preprocessing = _import_for_preprocessing()
+        path = _n3_path()
+        for day in n3_days():
+            patterns = [for_preprocessing.file_pattern(path, var, day) for var in
+                        ['clc', 'qv', 'qc', 'qi', 'temp', 'pres', 'rho']]
+            patterns += [path + 'zg/zg_icon-a_capped.nc', path + '../grid_extpar/fr_lake_R02B04_NARVAL_fg_DOM01.nc']
+            upstream['load_%s'%day] = add('load_day', {'day': day, 'no_NNs': config['no_NNs'],
+                                                       'fingerprint': files_fingerprint(patterns)}, OrderedDict())
+    else:
+        from my_classes import get_data_files
+        days = config['days'] if days is None else days
+        files = get_data_files(config['source'], days, resolution=config['resolution'],
+                               order_of_vars=order_of_vars(config, output_var))
+        upstream['load'] = add('load', {'days': days, 'source': config['source'], 'resolution': config['resolution'],
+                                        'order_of_vars': order_of_vars(config, output_var), 'dtype': config.get('dtype'),
+                                        'fingerprint': files_fingerprint(list(files.values()))}, OrderedDict())
+        upstream['samples'] = add('samples', {}, OrderedDict([('load', upstream['load'])]))
+    if 'select' in config:
+        upstream['select'] = add('select', {}, OrderedDict([('samples', upstream['samples'])]))
+    if 'split' in config:
+        upstream['split'] = add('split', {}, OrderedDict([(name, key) for name, key in upstream.items()
+                                                          if name != 'load']))
+    if output_path is None:
+        output_path = data_path('my_work/icon-ml_data/cloud_cover_parameterization', config['save']['folder'],
+                                'based_on_var_interpolated_data')
+    else:
+        output_path = os.path.join(output_path, config['save']['folder'])
+    save_params = {'output_path': output_path, 'model_path': output_path if model_path is None else model_path}
+    if split_manifests and 'split' in config and 'no_NNs' not in config:
+        save_params['manifest'] = True
+    add('save', save_params, OrderedDict([(name, key) for name, key in upstream.items() if name != 'load']))
+    return tasks
+
+def _is_done(cache, key, task):
+    arrays = cache.get(key)
+    if arrays is None:
+        return False
+    # The files of the save stage could have been removed in the meantime
+    return task['stage'] != 'save' or all([os.path.exists(file_name) for file_name in arrays['files']])
+
+def run_stage(cache_path, max_bytes, key, task):
+    '''
+        Runs one stage (in a worker process) and caches its output under key.
+    '''
+    cache = InputCache(cache_path, max_bytes)
+    start = time.time()
+    with stage('preprocessing_%s'%task['stage'], model=task['model']):
+        arrays = STAGES[task['stage']](cache, MODELS[task['model']], task['output_var'], task['upstream'],
+                                       task['params'])
+    cache.put(key, arrays, {'stage': task['stage'], 'model': task['model'], 'output_var': task['output_var'],
+                            'params': task['params']})
+    return time.time() - start
+
+def run(models, output_type='cloud_cover', cache_path=None, max_bytes=2000*1024**3, workers=4, days=None,
+        output_path=None, model_path=None, split_manifests=False):
+    '''
+        Runs the pipelines of models (e.g. ['n1', 'q1_narval']). Every stage that is not cached yet runs in one of
+        workers processes as soon as the stages it depends on are done. Returns the list of written files.
+
+        cache_path: Directory of the stage cache. Default: my_work/icon-ml_data/preprocessing_cache
+        max_bytes:  Disk quota of the stage cache
+        days:       Dictionary source -> days to load instead of the ones of the notebooks (see plan)
+    '''
+    if cache_path is None:
+        cache_path = data_path('my_work/icon-ml_data/preprocessing_cache')
+    cache = InputCache(cache_path, max_bytes)
+    tasks = OrderedDict()
+    for model in models:
+        source_days = None if days is None else days.get(MODELS[model]['source'])
+        tasks.update(plan(cache, model, output_type, source_days, output_path, model_path, split_manifests))
+    done = set([key for key, task in tasks.items() if _is_done(cache, key, task)])
+    print('%d of %d stages are cached'%(len(done), len(tasks)))
+
+    running = {}
+    with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        while len(done) < len(tasks):
+            for key, task in tasks.items():
+                if (key not in done and key not in running.values() and
+                    all([dependency in done for dependency in task['upstream'].values()])):
+                    running[executor.submit(run_stage, cache_path, max_bytes, key, task)] = key
+            finished, _ = wait(list(running.keys()), return_when=FIRST_COMPLETED)
+            for future in finished:
+                key = running.pop(future)
+                seconds = future.result()
+                done.add(key)
+                print('%-10s %-8s %s (%.1fs)'%(tasks[key]['model'], tasks[key]['stage'], key[:12], seconds))
+
+    files = []
+    for key, task in tasks.items():
+        if task['stage'] == 'save':
+            files.extend([str(file_name) for file_name in cache.get(key)['files']])
+    return files
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Preprocessing of n1-n3 and q1-q3 with cached stages')
+    parser.add_argument('--models', nargs='+', choices=list(MODELS.keys()),
+                        help='Default: All models (q1-q3 for --output_type cloud_area/both)')
+    parser.add_argument('--output_type', default='cloud_cover', choices=['cloud_cover', 'cloud_area', 'both'],
+                        help='both: Cloud cover and cloud area fraction of q1-q3 in one pass')
+    parser.add_argument('--workers', type=int, default=4, help='Stages that run in parallel')
+    parser.add_argument('--cache', help='Stage cache. Default: my_work/icon-ml_data/preprocessing_cache')
+    parser.add_argument('--cache_gb', type=float, default=2000, help='Disk quota of the stage cache')
+    parser.add_argument('--narval_days', help='E.g. dec_1st. Default: The days of the notebooks (not for n3)')
+    parser.add_argument('--qubicc_days', help='E.g. nov_20s. Default: The days of the notebooks')
+    parser.add_argument('--output_path', help='Write into output_path/<folder> instead of the folders of the notebooks')
+    parser.add_argument('--model_path', help='For the scaler and info-files of n1-n3. Default: Next to the npy-files')
+    parser.add_argument('--split_manifests', action='store_true',
+                        help='n1, n2: One unscaled data set and a manifest of the sets instead of six scaled copies')
+    args = parser.parse_args()
+
+    models = args.models
+    if models is None:
+        models = [model for model in MODELS.keys() if args.output_type == 'cloud_cover' or model[0] == 'q']
+    days = {'narval': args.narval_days, 'qubicc': args.qubicc_days}
+    for file_name in run(models, args.output_type, args.cache, int(args.cache_gb*1024**3), args.workers, days,
+                         args.output_path, args.model_path, args.split_manifests):
+        print(file_name)
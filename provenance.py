@@ -0,0 +1,215 @@
+## Where the samples come from: A compact (time, layer, cell) index with scatter/gather onto the ICON grid ##
+# After the preprocessing, the samples have lost their place on the grid (only the vertical layer survives in
+# samples_vertical_layers_<source>.npy): Data above 21km, NaNs and condensate-free clouds were removed and the
+# cloud-free samples were downsampled. The samples stage of preprocessing_pipeline.py flattens fields of shape
+# (time, layer, cell) (columns: (time, cell)), so every sample is identified by its row in the flattened grid.
+# The save stage writes these rows with the shape of the grid and the time steps that were kept (the QUBICC
+# preprocessing removes the first time steps and may subsample them) into samples_provenance_<source>.npz (q1-q3)
+# and <prefix>provenance_<train/valid/test>_<NUM>.npz (n1, n2; n3 is preprocessed per day and layer and has none):
+#
+# - rows are stored in the smallest unsigned integer type, or run-length encoded if they are sorted and that is
+#   smaller (the sorted downsampling keeps long runs of consecutive samples)
+# - time is the index of the time step in the data of load_data (in the order of the files), layer the vertical
+#   layer (1 is the top layer), cell the horizontal index of the ICON grid cell
+# - load_data only keeps the not_nan cells, so the grid of the preprocessing has one column per not_nan cell.
+#   cells = np.flatnonzero(not_nan) (their indices on the ICON grid) is stored as well, so that the samples can be put
+#   back onto the ICON grid (with horiz_fields cells)
+#
+# With it, predictions can be put back onto the grid (to_grid, e.g. for for_paraview.ipynb or maps) and metrics can
+# be computed per time step, day, layer, cell or region (aggregate, r2) without running the preprocessing again:
+#
+#   index = ProvenanceIndex.load('samples_provenance_qubicc.npz')
+#   grid = index.to_grid(model.predict(input_data))       # (time steps, layers, ICON cells), NaN without a sample
+#   r2_per_day = index.r2(pred, output_data, by=index.time//8)
+
+import numpy as np
+
+def _smallest_uint(maximum):
+    for dtype in [np.uint8, np.uint16, np.uint32]:
+        if maximum <= np.iinfo(dtype).max:
+            return dtype
+    return np.uint64
+
+def encode_rows(rows):
+    '''
+        Returns a dictionary of arrays: Either rows in the smallest unsigned integer type, or the run-length encoding
+        run_starts, run_lengths if rows are strictly increasing and that is smaller.
+    '''
+    rows = np.asarray(rows)
+    dtype = _smallest_uint(rows.max() if len(rows) > 0 else 0)
+    if len(rows) > 1 and np.all(np.diff(rows) > 0):
+        breaks = np.flatnonzero(np.diff(rows) != 1) + 1
+        starts = np.concatenate(([0], breaks))
+        lengths = np.diff(np.concatenate((starts, [len(rows)])))
+        if len(starts)*(np.dtype(dtype).itemsize + np.dtype(_smallest_uint(lengths.max())).itemsize) < \
+                len(rows)*np.dtype(dtype).itemsize:
+            return {'run_starts': rows[starts].astype(dtype), 'run_lengths': lengths.astype(_smallest_uint(lengths.max()))}
+    return {'rows': rows.astype(dtype)}
+
+def decode_rows(arrays):
+    if 'rows' in arrays:
+        return np.asarray(arrays['rows'], dtype=np.int64)
+    starts = np.asarray(arrays['run_starts'], dtype=np.int64)
+    lengths = np.asarray(arrays['run_lengths'], dtype=np.int64)
+    # Every sample: The start of its run plus its position within the run
+    offsets = np.arange(np.sum(lengths)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return np.repeat(starts, lengths) + offsets
+
+class ProvenanceIndex():
+    '''
+    The place of every sample on the (time, layer, cell) grid of the preprocessing.
+    '''
+    def __init__(self, rows, grid_shape, time_steps=None, first_layer=1, layers=None, cells=None, horiz_fields=None):
+        '''
+            rows:         Row of every sample in the flattened grid
+            grid_shape:   (time steps, layers, cells), or (time steps, cells) for the column-based models. The cells
+                          are the not_nan cells of load_data.
+            time_steps:   Time step (in the data of load_data) of every time step of the grid. By default 0, 1, ...
+            first_layer:  The vertical layer of the first layer of the grid (e.g. 5 if the upper four were dropped)
+            layers:       Column-based models: The vertical layers of the outputs of a sample (e.g. 5, ..., 31)
+            cells:        Index on the ICON grid of every cell of the grid (np.flatnonzero(not_nan)).
+                          By default the cells of the grid are the ICON cells.
+            horiz_fields: Number of cells of the ICON grid. By default the number of cells of the grid.
+        '''
+        self.rows = np.asarray(rows, dtype=np.int64)
+        self.grid_shape = tuple(int(n) for n in grid_shape)
+        self.time_steps = np.arange(self.grid_shape[0], dtype=np.int32) if time_steps is None \
+                          else np.asarray(time_steps, dtype=np.int32)
+        self.first_layer = int(first_layer)
+        self.layers = None if layers is None else np.asarray(layers, dtype=np.int16)
+        self.cells = None if cells is None else np.asarray(cells, dtype=np.int32)
+        if self.cells is not None and len(self.cells) != self.grid_shape[-1]:
+            raise ValueError('%d cells for a grid with %d cells'%(len(self.cells), self.grid_shape[-1]))
+        self.horiz_fields = self.grid_shape[-1] if horiz_fields is None else int(horiz_fields)
+
+    @property
+    def column(self):
+        return len(self.grid_shape) == 2
+
+    def __len__(self):
+        return len(self.rows)
+
+    @property
+    def time(self):
+        return self.time_steps[self.rows//int(np.prod(self.grid_shape[1:]))]
+
+    @property
+    def layer(self):
+        if self.column:
+            raise ValueError('The samples of the column-based models contain all layers (see self.layers)')
+        return (self.rows//self.grid_shape[2] % self.grid_shape[1] + self.first_layer).astype(np.int16)
+
+    @property
+    def cell(self):
+        # Index on the ICON grid
+        position = self.rows % self.grid_shape[-1]
+        if self.cells is not None:
+            return self.cells[position]
+        return position.astype(np.int32)
+
+    def save(self, file_name):
+        arrays = encode_rows(self.rows)
+        arrays.update(grid_shape=np.array(self.grid_shape, dtype=np.int64), time_steps=self.time_steps,
+                      first_layer=np.array(self.first_layer))
+        if self.layers is not None:
+            arrays['layers'] = self.layers
+        if self.cells is not None:
+            arrays.update(cells=self.cells, horiz_fields=np.array(self.horiz_fields))
+        # Not np.savez_compressed, the rows are (almost) incompressible and loading should be fast
+        with open(file_name, 'wb') as file:
+            np.savez(file, **arrays)
+        return file_name
+
+    @classmethod
+    def load(cls, file_name):
+        with np.load(file_name) as arrays:
+            return cls(decode_rows(arrays), arrays['grid_shape'], arrays['time_steps'], int(arrays['first_layer']),
+                       arrays['layers'] if 'layers' in arrays else None, arrays['cells'] if 'cells' in arrays else None,
+                       int(arrays['horiz_fields']) if 'horiz_fields' in arrays else None)
+
+    def _grid_rows(self, values):
+        # Values of the column-based models: (samples, layers) -> rows in the (time steps, layers, cells) grid
+        (T, H) = self.grid_shape
+        no_layers = values.shape[1]
+        (t, h) = (self.rows//H, self.rows % H)
+        return ((t[:, None]*no_layers + np.arange(no_layers)[None, :])*H + h[:, None]).reshape(-1), \
+               (T, no_layers, H)
+
+    def to_grid(self, values, fill=np.nan, masked=False, dtype=np.float32):
+        '''
+            Scatters the values of the samples onto the grid. Grid cells without a sample get fill (or are masked).
+
+            values: (samples,), or (samples, layers) for the column-based models
+            Returns (time steps, layers, horiz_fields) on the ICON grid. The time steps are self.time_steps.
+        '''
+        values = np.asarray(values)
+        if self.column:
+            rows, shape = self._grid_rows(values)
+            values = values.reshape(-1)
+        else:
+            (rows, shape) = (self.rows, self.grid_shape)
+        if self.cells is not None:
+            # Rows of the ICON grid
+            rows = rows//shape[-1]*self.horiz_fields + self.cells[rows % shape[-1]]
+            shape = shape[:-1] + (self.horiz_fields,)
+        grid = np.full(int(np.prod(shape)), fill, dtype=dtype)
+        grid[rows] = values
+        grid = grid.reshape(shape)
+        if masked:
+            mask = np.ones(int(np.prod(shape)), dtype=bool)
+            mask[rows] = False
+            return np.ma.masked_array(grid, mask.reshape(shape))
+        return grid
+
+    def from_grid(self, grid):
+        '''
+            Gathers the values of the samples from a grid of shape (time steps, layers, cells) with the time steps
+            self.time_steps. The cells are either those of the ICON grid (inverse of to_grid) or the not_nan cells
+            (e.g. the variables of load_data).
+        '''
+        grid = np.asarray(grid)
+        if self.cells is not None and grid.shape[-1] != self.grid_shape[-1]:
+            grid = grid[..., self.cells]
+        if self.column:
+            (T, no_layers, H) = grid.shape
+            (t, h) = (self.rows//H, self.rows % H)
+            return grid[t[:, None], np.arange(no_layers)[None, :], h[:, None]]
+        return grid.reshape(-1)[self.rows]
+
+    def _groups(self, by):
+        if isinstance(by, str):
+            by = getattr(self, by)
+        (groups, inverse) = np.unique(np.asarray(by), return_inverse=True)
+        return groups, inverse.reshape(-1)
+
+    def aggregate(self, values, by='time'):
+        '''
+            Mean of the values (samples,) or (samples, layers) per group.
+
+            by: 'time', 'layer', 'cell' or an array with the group of every sample (e.g. index.time//8 for days or
+                region_of_cell[index.cell] for regions)
+            Returns: groups, means (groups,) or (groups, layers)
+        '''
+        groups, inverse = self._groups(by)
+        values = np.asarray(values, dtype=np.float64).reshape(len(self), -1)
+        counts = np.bincount(inverse, minlength=len(groups))
+        sums = np.stack([np.bincount(inverse, values[:, k], minlength=len(groups))
+                         for k in range(values.shape[1])], axis=1)
+        means = sums/np.maximum(counts, 1)[:, None]
+        return groups, (means[:, 0] if values.shape[1] == 1 else means)
+
+    def r2(self, pred, truth, by='time'):
+        '''
+            R2 = 1 - MSE/Var(truth) per group (see aggregate). For the column-based models over all layers.
+            Returns: groups, r2
+        '''
+        groups, inverse = self._groups(by)
+        pred = np.asarray(pred, dtype=np.float64).reshape(len(self), -1)
+        truth = np.asarray(truth, dtype=np.float64).reshape(len(self), -1)
+        counts = np.bincount(inverse, minlength=len(groups))*truth.shape[1]
+        sse = np.bincount(inverse, np.sum((pred - truth)**2, axis=1), minlength=len(groups))
+        sums = np.bincount(inverse, np.sum(truth, axis=1), minlength=len(groups))
+        sums_sq = np.bincount(inverse, np.sum(truth**2, axis=1), minlength=len(groups))
+        var = sums_sq/np.maximum(counts, 1) - (sums/np.maximum(counts, 1))**2
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return groups, np.where(var > 0, 1 - sse/np.maximum(counts, 1)/var, np.nan)
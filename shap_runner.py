@@ -0,0 +1,280 @@
+## Parallel, checkpointed computation of SHAP values ##
+# Replaces the single blocking explainer.shap_values(X=input_narval[rand_indices_narval]) call:
+# - The samples are split into chunks, which are processed by worker processes. Every worker loads the model
+#   and sets up the DeepExplainer only once.
+# - Every finished chunk is written to disk right away. If the run is interrupted, calling run_shap again
+#   only computes the missing chunks.
+# - The SHAP values of all outputs (all 27 layers of the column-based model) are computed in the same pass.
+#
+# Output (in output_dir):
+# - chunks/shap_<start>_<stop>.npy: (no_outputs, stop-start, no_features) for the samples start:stop
+# - shap_values.npy: All chunks assembled into one (no_outputs, no_samples, no_features) array
+# - meta.json: Settings, expected values and the timing (samples/s)
+#
+# Weighted background data: Instead of inserting a sample many times into the background data (to construct a
+# certain base value), we can pass per-sample weights. See WeightedDeepExplainer.
+
+import os
+import json
+import time
+import hashlib
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import get_context
+
+from input_cache import InputCache, files_fingerprint
+
+class WeightedDeepExplainer():
+    '''
+    DeepExplainer with a weighted background data set.
+
+    The SHAP values of DeepExplainer are the average of the attributions w.r.t. every single background sample.
+    So with weights w we need sum_j w_j*phi(x; b_j). We group the background samples by their weight. A single
+    DeepExplainer computes the (uniform) average over every group, one group after the other, and the SHAP values
+    are the group-weighted sum. This is exact and every background sample is evaluated only once. The constructed
+    base value (constructed_base_weights) has two groups.
+
+    E.g. inserting sample s k times into N background samples equals the weights (1/(N+k), ..., (k+1)/(N+k)).
+    '''
+    def __init__(self, model, data, weights=None, predictions=None):
+        '''
+            model:       The keras model
+            data:        The background data
+            weights:     Non-negative weight per background sample (normalized to sum to 1). Default: Uniform.
+            predictions: Model predictions on data (e.g. from background_predictions) for the expected value.
+                         Otherwise the model is run on data once more.
+        '''
+        import shap
+        if weights is None:
+            weights = np.ones(data.shape[0])
+        weights = np.asarray(weights, dtype=np.float64)
+        assert weights.shape == (data.shape[0],) and np.all(weights >= 0)
+        weights = weights/np.sum(weights)
+
+        self.model = model
+        self.data = np.asarray(data)
+        # DeepExplainer runs the model on its data for its expected value, so we set it up on one sample only.
+        # The background data of a group is set before every pass (see shap_values).
+        self.explainer = shap.DeepExplainer(model=model, data=self.data[:1])
+
+        # Equal weights up to rounding errors form one group
+        unique_weights, inverse = np.unique(np.round(weights/np.max(weights), 12), return_inverse=True)
+        self.groups = []
+        self.group_weights = []
+        for g in range(len(unique_weights)):
+            if unique_weights[g] == 0:
+                continue
+            group = np.where(inverse == g)[0]
+            self.groups.append(group)
+            self.group_weights.append(np.sum(weights[group]))
+
+        if predictions is None:
+            predictions = model.predict(self.data, batch_size=2**14)
+        self.expected_value = np.dot(weights, np.reshape(predictions, (data.shape[0], -1)))
+
+    def shap_values(self, X, check_additivity=False):
+        '''
+            Returns a list with the SHAP values per output, like DeepExplainer.shap_values.
+            check_additivity: Whether the SHAP values sum up to the prediction minus the expected value (as in shap)
+        '''
+        shap_values = None
+        for w, group in zip(self.group_weights, self.groups):
+            # The TensorFlow DeepExplainer reads its background data (a list of model inputs) from explainer.data
+            self.explainer.explainer.data = [self.data[group]]
+            values = self.explainer.shap_values(X=X, check_additivity=False)
+            if not isinstance(values, list):
+                values = [values]
+            if shap_values is None:
+                shap_values = [w*v for v in values]
+            else:
+                shap_values = [s + w*v for s, v in zip(shap_values, values)]
+        if check_additivity:
+            pred = np.reshape(self.model.predict(X), (X.shape[0], -1))
+            for k, values in enumerate(shap_values):
+                error = np.max(np.abs(np.sum(values, axis=1) + self.expected_value[k] - pred[:, k]))
+                if error > 1e-2:
+                    raise ValueError('The SHAP values of output %d do not sum up to the prediction (error %.4f)'%
+                                     (k, error))
+        return shap_values
+
+def constructed_base_weights(predictions, target, index):
+    '''
+        Weights for the background data such that the weighted mean prediction equals target.
+        Counterpart of inserting background sample index how_often times (but exact and without copying):
+        Uniform weights, plus an additional weight on sample index.
+
+        predictions: Model predictions on the background data (for the output/layer of interest)
+        index:       Background sample whose prediction is on the other side of target than the mean prediction
+    '''
+    predictions = np.asarray(predictions, dtype=np.float64)
+    mean = np.mean(predictions)
+    share = (target - mean)/(predictions[index] - mean)
+    if not 0 <= share < 1:
+        raise ValueError('Cannot reach %.4f with sample %d (mean prediction %.4f, its prediction %.4f)'%
+                         (target, index, mean, predictions[index]))
+    weights = np.full(len(predictions), (1 - share)/len(predictions))
+    weights[index] += share
+    return weights
+
+def background_predictions(model, model_file, background, cache_path, batch_size=2**14):
+    '''
+        Forward pass of the model on the background data. Cached on disk for this model file and background data,
+        so that other layers/seeds/runs with the same model and background reuse it.
+    '''
+    background = np.ascontiguousarray(background, dtype=np.float32)
+    cache = InputCache(cache_path)
+    arrays = cache.get_or_build(lambda: {'predictions': model.predict(background, batch_size=batch_size)},
+                                kind='background_predictions', model=files_fingerprint([model_file]),
+                                background=hashlib.sha256(background.tobytes()).hexdigest(),
+                                shape=list(background.shape))
+    return np.array(arrays['predictions'])
+
+# Set in every worker process by _init_worker
+_explainer = None
+
+def _init_worker(model_file, background_file, weights_file, predictions_file, threads_per_worker):
+    global _explainer
+    import tensorflow as tf
+    import shap
+    from tensorflow import nn
+    from tensorflow.keras.models import load_model
+    tf.config.threading.set_intra_op_parallelism_threads(threads_per_worker)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+
+    model = load_model(model_file, {'leaky_relu': nn.leaky_relu})
+    weights = None if weights_file is None else np.load(weights_file)
+    predictions = None if predictions_file is None else np.load(predictions_file)
+    if weights is None and predictions is None:
+        _explainer = shap.DeepExplainer(model=model, data=np.load(background_file))
+    else:
+        _explainer = WeightedDeepExplainer(model, np.load(background_file), weights, predictions)
+
+def _compute_chunk(samples_file, start, stop, chunk_file):
+    # Runs in a worker process
+    t0 = time.time()
+    samples = np.load(samples_file, mmap_mode='r')
+    shap_values = _explainer.shap_values(X=np.array(samples[start:stop]), check_additivity=False)
+    # One entry per output of the model
+    if not isinstance(shap_values, list):
+        shap_values = [shap_values]
+    shap_values = np.stack(shap_values).astype(np.float32)
+    # Write into a temporary file first, so that an interrupted run never leaves a corrupt chunk behind
+    np.save(chunk_file + '.tmp.npy', shap_values)
+    os.replace(chunk_file + '.tmp.npy', chunk_file)
+    expected_value = np.array(_explainer.expected_value, dtype=np.float64).reshape(-1)
+    return start, stop, time.time() - t0, expected_value
+
+def _chunk_file(output_dir, start, stop):
+    return os.path.join(output_dir, 'chunks', 'shap_%09d_%09d.npy'%(start, stop))
+
+def run_shap(model_file, background, samples, output_dir, chunk_size=1000, workers=4, threads_per_worker=1,
+             background_weights=None, predictions=None):
+    '''
+        Computes the SHAP values (DeepExplainer) of the model for all samples.
+
+        model_file: The (keras) h5-file of the model
+        background: Array (or npy-file) of the background data (already scaled). Used for the expected value.
+        samples:    Array (or npy-file) of the samples (already scaled) we want the SHAP values for
+        output_dir: The chunks, the assembled SHAP values and meta.json are stored here
+        chunk_size: Number of samples per task. Every chunk is stored separately (checkpoints).
+        workers:    Number of worker processes. Every worker holds its own model and explainer.
+        background_weights: Optional weight per background sample (see WeightedDeepExplainer)
+        predictions: Optional model predictions on the background data (e.g. from background_predictions). Passed to
+                     the workers, so that they do not run the model on the background data again.
+
+        Returns: The memory-mapped SHAP values of shape (no_outputs, no_samples, no_features)
+                 So shap_values[i] is what explainer.shap_values(...)[i] used to be.
+    '''
+    os.makedirs(os.path.join(output_dir, 'chunks'), exist_ok=True)
+
+    # The workers read the background data and the samples from disk
+    background_file = os.path.join(output_dir, 'background.npy')
+    samples_file = os.path.join(output_dir, 'samples.npy')
+    for (data, file_name) in [(background, background_file), (samples, samples_file)]:
+        if isinstance(data, str):
+            data = np.load(data, mmap_mode='r')
+        if os.path.exists(file_name):
+            # Resuming: Only allowed with the same data
+            stored = np.load(file_name, mmap_mode='r')
+            if stored.shape != data.shape or not np.array_equal(stored[:100], data[:100]):
+                raise ValueError('%s contains different data. Choose another output_dir.'%file_name)
+        else:
+            np.save(file_name, np.asarray(data, dtype=np.float32))
+    no_samples = np.load(samples_file, mmap_mode='r').shape[0]
+    weights_file = None
+    if background_weights is not None:
+        weights_file = os.path.join(output_dir, 'background_weights.npy')
+        if os.path.exists(weights_file) and not np.array_equal(np.load(weights_file), background_weights):
+            raise ValueError('%s contains different weights. Choose another output_dir.'%weights_file)
+        np.save(weights_file, np.asarray(background_weights, dtype=np.float64))
+    predictions_file = None
+    if predictions is not None:
+        predictions_file = os.path.join(output_dir, 'background_predictions.npy')
+        assert len(predictions) == np.load(background_file, mmap_mode='r').shape[0]
+        np.save(predictions_file, np.asarray(predictions))
+
+    meta_file = os.path.join(output_dir, 'meta.json')
+    meta = {'model_file': model_file, 'chunk_size': chunk_size, 'no_samples': no_samples,
+            'no_background_samples': int(np.load(background_file, mmap_mode='r').shape[0])}
+    if os.path.exists(meta_file):
+        with open(meta_file) as file:
+            stored_meta = json.load(file)
+        for key in meta.keys():
+            if stored_meta[key] != meta[key]:
+                raise ValueError('Cannot resume: %s was %s, now %s'%(key, stored_meta[key], meta[key]))
+        meta = stored_meta
+
+    chunks = [(start, min(start + chunk_size, no_samples)) for start in range(0, no_samples, chunk_size)]
+    todo = [(start, stop) for (start, stop) in chunks if not os.path.exists(_chunk_file(output_dir, start, stop))]
+    print('%d of %d chunks are still missing'%(len(todo), len(chunks)), flush=True)
+
+    if len(todo) > 0:
+        meta['assembled'] = False
+        with open(meta_file, 'w') as file:
+            json.dump(meta, file, indent=1)
+        t0 = time.time()
+        done_samples = 0
+        # Spawn instead of fork: TensorFlow is not fork-safe
+        with ProcessPoolExecutor(max_workers=workers, mp_context=get_context('spawn'), initializer=_init_worker,
+                                 initargs=(model_file, background_file, weights_file, predictions_file,
+                                           threads_per_worker)) as executor:
+            futures = [executor.submit(_compute_chunk, samples_file, start, stop, _chunk_file(output_dir, start, stop))
+                       for (start, stop) in todo]
+            for future in as_completed(futures):
+                start, stop, elapsed_time, expected_value = future.result()
+                done_samples += stop - start
+                meta['expected_value'] = expected_value.tolist()
+                print('Samples %d-%d: %.1fs. Overall: %.1f samples/s'%(start, stop, elapsed_time,
+                                                                       done_samples/(time.time() - t0)), flush=True)
+        meta.setdefault('runs', []).append({'samples': done_samples, 'elapsed_time': time.time() - t0,
+                                            'samples_per_second': done_samples/(time.time() - t0),
+                                            'workers': workers, 'threads_per_worker': threads_per_worker})
+        with open(meta_file, 'w') as file:
+            json.dump(meta, file, indent=1)
+
+    return assemble_shap_values(output_dir)
+
+def assemble_shap_values(output_dir):
+    '''
+        Puts all chunks into shap_values.npy (once all of them exist) and returns it memory-mapped.
+    '''
+    shap_file = os.path.join(output_dir, 'shap_values.npy')
+    with open(os.path.join(output_dir, 'meta.json')) as file:
+        meta = json.load(file)
+    if meta.get('assembled', False) and os.path.exists(shap_file):
+        return np.load(shap_file, mmap_mode='r')
+
+    no_samples, chunk_size = meta['no_samples'], meta['chunk_size']
+    chunks = [(start, min(start + chunk_size, no_samples)) for start in range(0, no_samples, chunk_size)]
+    first = np.load(_chunk_file(output_dir, *chunks[0]), mmap_mode='r')
+    shap_values = np.lib.format.open_memmap(shap_file, mode='w+', dtype=np.float32,
+                                            shape=(first.shape[0], no_samples, first.shape[2]))
+    for (start, stop) in chunks:
+        shap_values[:, start:stop] = np.load(_chunk_file(output_dir, start, stop))
+    shap_values.flush()
+    del shap_values
+
+    meta['assembled'] = True
+    with open(os.path.join(output_dir, 'meta.json'), 'w') as file:
+        json.dump(meta, file, indent=1)
+    return np.load(shap_file, mmap_mode='r')
@@ -0,0 +1,266 @@
+## Training/validation/test splits as index manifests over one canonical (memory-mapped) data set ##
+# The NARVAL models write six npy-files per split (<prefix>{input,output}_{train,valid,test}_<NUM>.npy), the random
+# forest baselines copy the folds of the QUBICC models once more (RFs/cell_based_R2B5_input_train.npy etc.). Every
+# split is a full copy of the data. Here, a split is a manifest (npz) that references one canonical pair of
+# npy-files (input (samples, features), output) and only stores
+#
+# - the rows of every set in the canonical data, in the smallest unsigned integer type or as ranges (run-length
+#   encoded, see provenance.encode_rows), so a temporal fold takes a few bytes and a random split 4 bytes per sample
+# - optionally the mean and standard deviation of the training set: The input is standardized when it is read,
+#   with the same operations as StandardScaler.transform (so the values are identical to those of the notebooks)
+#
+# Reading a set gathers its rows with ConcatenatedDataset.take in sorted blocks: Consecutive rows are one contiguous
+# read, the others are read in the order of the file. New split schemes (another NUM, another fold) are a new manifest, not a new copy of the data.
+#
+#   splits = SplitManifest.load('cloud_cover_all_days_splits_1.npz')
+#   input_train = splits.input('train')                 # SplitArray: Nothing is read yet
+#   input_train[:2**20], np.asarray(splits.output('train'))
+#
+# Convert existing split files (checks that the sets are read back unchanged before --remove deletes the old files):
+#   python splits.py migrate --path .../grid_cell_based_v3/based_on_var_interpolated_data --prefix cloud_cover_all_days_
+#       --NUM 1 --remove
+#   python splits.py fold --input_file path/cloud_cover_input_qubicc.npy --output_file path/cloud_cover_output_qubicc.npy
+#       --fold 1 --manifest RFs/cell_based_R2B5_splits.npz
+#   python splits.py verify --manifest RFs/cell_based_R2B5_splits.npz --names train valid
+#       --input_files RFs/cell_based_R2B5_input_train.npy RFs/cell_based_R2B5_input_valid.npy
+#       --output_files RFs/cell_based_R2B5_output_train.npy RFs/cell_based_R2B5_output_valid.npy --remove
+
+import os
+import argparse
+from collections import OrderedDict
+
+import numpy as np
+from sklearn.preprocessing import StandardScaler
+
+from provenance import encode_rows, decode_rows
+from concatenated_dataset import ConcatenatedDataset, fit_scaler
+
+def fold_indices(samples_total, fold):
+    '''
+        Temporal 3-fold cross-validation: Validate on the sixths fold and fold+3 (fold = 0, 1, 2)
+    '''
+    incr = samples_total//6
+    validation = np.append(np.arange(incr*fold, incr*(fold+1)), np.arange(incr*(fold+3), incr*(fold+4)))
+    training = np.delete(np.arange(samples_total), validation)
+    return training, validation
+
+class SplitArray():
+    '''
+    One set of a split: The rows of the canonical array, standardized when they are read (if mean is given).
+    Supports len, shape, slicing and indexing (which return arrays) and np.asarray.
+    '''
+    def __init__(self, array, rows, mean=None, std=None, block_size=2**16):
+        self.array = array
+        self.data = ConcatenatedDataset([array], transpose=False, block_size=block_size)
+        self.rows = rows
+        self.mean = mean
+        self.std = std
+        self.shape = (len(rows),) + tuple(array.shape[1:])
+        self.ndim = len(self.shape)
+        # As StandardScaler: float32 stays float32, everything else becomes float64
+        if mean is None or array.dtype in [np.float32, np.float64]:
+            self.dtype = array.dtype
+        else:
+            self.dtype = np.dtype(np.float64)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            values = self[key[0]]
+            # A single sample has lost the first dimension
+            if np.isscalar(key[0]):
+                return values[key[1:]]
+            return values[(slice(None),) + key[1:]]
+        if np.isscalar(key):
+            return self[[key]][0]
+        values = self.data.take(self.rows[key])
+        if self.mean is not None:
+            # The operations of StandardScaler.transform
+            values = values.astype(self.dtype, copy=False)
+            values -= self.mean
+            values /= self.std
+        return values
+
+    def __array__(self, dtype=None, copy=None):
+        values = self[:]
+        return values if dtype is None else values.astype(dtype, copy=False)
+
+class SplitManifest():
+    '''
+    The sets (e.g. train, valid, test) of a split as rows of the canonical input and output file.
+    '''
+    def __init__(self, input_file, output_file, splits, mean=None, std=None):
+        '''
+            input_file, output_file: The canonical npy-files (samples first)
+            splits:                  Dictionary name -> rows
+            mean, std:               Standardization of the input (e.g. StandardScaler.mean_, .scale_) or None
+        '''
+        self.input_file = input_file
+        self.output_file = output_file
+        self.splits = OrderedDict((name, np.asarray(rows, dtype=np.int64)) for name, rows in splits.items())
+        self.mean = None if mean is None else np.asarray(mean, dtype=np.float64)
+        self.std = None if std is None else np.asarray(std, dtype=np.float64)
+        self._data = {}
+
+    @property
+    def names(self):
+        return list(self.splits.keys())
+
+    def rows(self, name):
+        return self.splits[name]
+
+    def _array(self, file_name):
+        if file_name not in self._data:
+            self._data[file_name] = np.load(file_name, mmap_mode='r')
+        return self._data[file_name]
+
+    def input(self, name, block_size=2**16):
+        return SplitArray(self._array(self.input_file), self.splits[name], self.mean, self.std, block_size)
+
+    def output(self, name, block_size=2**16):
+        return SplitArray(self._array(self.output_file), self.splits[name], block_size=block_size)
+
+    def save(self, file_name):
+        # The files are stored relative to the manifest, so that the directory can be moved
+        directory = os.path.dirname(os.path.abspath(file_name))
+        arrays = {'input_file': np.array(os.path.relpath(os.path.abspath(self.input_file), directory)),
+                  'output_file': np.array(os.path.relpath(os.path.abspath(self.output_file), directory)),
+                  'names': np.array(self.names)}
+        for name, rows in self.splits.items():
+            arrays.update(('%s_%s'%(name, key), value) for key, value in encode_rows(rows).items())
+        if self.mean is not None:
+            arrays.update(mean=self.mean, std=self.std)
+        tmp_file = file_name + '.tmp%d'%os.getpid()
+        with open(tmp_file, 'wb') as file:
+            np.savez(file, **arrays)
+        os.replace(tmp_file, file_name)
+        return file_name
+
+    @classmethod
+    def load(cls, file_name):
+        directory = os.path.dirname(os.path.abspath(file_name))
+        with np.load(file_name) as arrays:
+            splits = OrderedDict()
+            for name in arrays['names']:
+                splits[str(name)] = decode_rows({key: arrays['%s_%s'%(name, key)] for key in
+                                                 ['rows', 'run_starts', 'run_lengths'] if '%s_%s'%(name, key) in arrays})
+            return cls(os.path.join(directory, str(arrays['input_file'])),
+                       os.path.join(directory, str(arrays['output_file'])), splits,
+                       arrays['mean'] if 'mean' in arrays else None, arrays['std'] if 'std' in arrays else None)
+
+def fold_manifest(input_file, output_file, fold, file_name=None, standardize=True):
+    '''
+        The temporal fold of the QUBICC models (train: 4/6, valid: 2/6 of the samples) over the canonical files,
+        standardized according to the training set. Written to file_name if given.
+    '''
+    input_data = ConcatenatedDataset([input_file], transpose=False)
+    training, validation = fold_indices(input_data.shape[0], fold)
+    (mean, std) = (None, None)
+    if standardize:
+        scaler = fit_scaler(StandardScaler(), input_data, training)
+        (mean, std) = (scaler.mean_, scaler.scale_)
+    manifest = SplitManifest(input_file, output_file, OrderedDict([('train', training), ('valid', validation)]),
+                             mean, std)
+    if file_name is not None:
+        manifest.save(file_name)
+    return manifest
+
+def _concatenate(file_names, out_file, chunk_size=2**20):
+    # Writes the npy-files one after another into out_file, chunk by chunk
+    arrays = [np.load(file_name, mmap_mode='r') for file_name in file_names]
+    shape = (sum([array.shape[0] for array in arrays]),) + arrays[0].shape[1:]
+    out = np.lib.format.open_memmap(out_file + '.tmp%d'%os.getpid(), mode='w+', dtype=arrays[0].dtype, shape=shape)
+    start = 0
+    for array in arrays:
+        for i in range(0, array.shape[0], chunk_size):
+            chunk = array[i:i+chunk_size]
+            out[start+i:start+i+len(chunk)] = chunk
+        start += array.shape[0]
+    out.flush()
+    del out
+    os.replace(out_file + '.tmp%d'%os.getpid(), out_file)
+    return [array.shape[0] for array in arrays]
+
+def _max_difference(split_array, file_name, chunk_size=2**20):
+    # Largest absolute difference between the set and the existing file (nan == nan), inf if the shapes differ
+    old = np.load(file_name, mmap_mode='r')
+    if old.shape != split_array.shape:
+        return np.inf
+    difference = 0.
+    for i in range(0, len(old), chunk_size):
+        (a, b) = (np.asarray(old[i:i+chunk_size], dtype=np.float64), split_array[i:i+chunk_size].astype(np.float64))
+        d = np.where(np.isnan(a) & np.isnan(b), 0, np.abs(a - b))
+        difference = max(difference, np.inf if np.any(np.isnan(d)) else float(np.max(d, initial=0)))
+    return difference
+
+def verify(manifest, names, input_files, output_files, tolerance=0., remove=False):
+    '''
+        Compares the sets of the manifest with existing copies. The copies are removed if remove is True and all
+        of them agree up to tolerance (0: identical). Returns the largest difference per file.
+    '''
+    differences = OrderedDict()
+    for name, input_file, output_file in zip(names, input_files, output_files):
+        differences[input_file] = _max_difference(manifest.input(name), input_file)
+        differences[output_file] = _max_difference(manifest.output(name), output_file)
+    for file_name, difference in differences.items():
+        print('%-80s max. difference %g'%(file_name, difference))
+    if remove:
+        if max(differences.values()) > tolerance:
+            print('Not removing the files, the differences exceed %g'%tolerance)
+        else:
+            for file_name in differences.keys():
+                os.remove(file_name)
+                print('Removed %s'%file_name)
+    return differences
+
+def migrate(path, prefix, NUM, names=('train', 'valid', 'test'), remove=False):
+    '''
+        Converts <prefix>{input,output}_{train,valid,test}_<NUM>.npy (as written by the NARVAL preprocessing) into
+        the canonical <prefix>{input,output}_<NUM>.npy (the sets one after another, already standardized) and the
+        manifest <prefix>splits_<NUM>.npz, in which every set is one range.
+    '''
+    input_files = [os.path.join(path, prefix + 'input_%s_%d.npy'%(name, NUM)) for name in names]
+    output_files = [os.path.join(path, prefix + 'output_%s_%d.npy'%(name, NUM)) for name in names]
+    lengths = _concatenate(input_files, os.path.join(path, prefix + 'input_%d.npy'%NUM))
+    assert _concatenate(output_files, os.path.join(path, prefix + 'output_%d.npy'%NUM)) == lengths
+    offsets = np.cumsum([0] + lengths)
+    manifest = SplitManifest(os.path.join(path, prefix + 'input_%d.npy'%NUM),
+                             os.path.join(path, prefix + 'output_%d.npy'%NUM),
+                             OrderedDict((name, np.arange(offsets[k], offsets[k+1])) for k, name in enumerate(names)))
+    manifest.save(os.path.join(path, prefix + 'splits_%d.npz'%NUM))
+    verify(manifest, names, input_files, output_files, remove=remove)
+    return manifest
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Splits as manifests over one canonical data set')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    parser_migrate = subparsers.add_parser('migrate', help='Convert the six split files of a NARVAL model')
+    parser_migrate.add_argument('--path', required=True)
+    parser_migrate.add_argument('--prefix', default='cloud_cover_all_days_')
+    parser_migrate.add_argument('--NUM', type=int, default=1)
+    parser_migrate.add_argument('--remove', action='store_true', help='Remove the split files afterwards')
+    parser_fold = subparsers.add_parser('fold', help='Manifest of a temporal fold of the QUBICC models')
+    parser_fold.add_argument('--input_file', required=True)
+    parser_fold.add_argument('--output_file', required=True)
+    parser_fold.add_argument('--fold', type=int, default=1)
+    parser_fold.add_argument('--manifest', required=True)
+    parser_verify = subparsers.add_parser('verify', help='Compare a manifest with existing copies of its sets')
+    parser_verify.add_argument('--manifest', required=True)
+    parser_verify.add_argument('--names', nargs='+', required=True)
+    parser_verify.add_argument('--input_files', nargs='+', required=True)
+    parser_verify.add_argument('--output_files', nargs='+', required=True)
+    parser_verify.add_argument('--tolerance', type=float, default=1e-5,
+                               help='The mean and std of the manifest are fitted chunk by chunk (partial_fit)')
+    parser_verify.add_argument('--remove', action='store_true', help='Remove the copies if they agree')
+    args = parser.parse_args()
+
+    if args.command == 'migrate':
+        migrate(args.path, args.prefix, args.NUM, remove=args.remove)
+    elif args.command == 'fold':
+        manifest = fold_manifest(args.input_file, args.output_file, args.fold, args.manifest)
+        print('%s: %s'%(args.manifest, ', '.join(['%s %d'%(name, len(manifest.rows(name))) for name in manifest.names])))
+    else:
+        verify(SplitManifest.load(args.manifest), args.names, args.input_files, args.output_files, args.tolerance,
+               args.remove)
@@ -0,0 +1,251 @@
+## Out-of-core multiple linear regression via streamed normal equations ##
+# The MLR baselines (additional_content/baselines/multiple_linear_regression_*) need the entire input data in
+# memory for LinearRegression.fit. But the least squares solution only depends on the means and the co-moment
+# matrix (X - mean)^T (X - mean) of the inputs and outputs. We accumulate those in float64, chunk by chunk from
+# the (memory-mapped) training arrays:
+# - Chunks are processed by a thread pool (the matrix products release the GIL) and merged with the pairwise
+#   update of Chan et al., which is stable also for billions of samples.
+# - The samples can be grouped (e.g. by vertical layer or land/sea), so that one regression per group is fitted.
+# - The data can be split into blocks, e.g. the six blocks that make up the three QUBICC folds. The statistics of
+#   the training (and validation) set of every fold are then merged from the block statistics, so that all
+#   folds are fitted in a single pass over the data.
+# - Training and validation MSEs follow from the same statistics without predicting anything.
+#
+# The solution is invariant to the standardization of the inputs, so the data can be passed unscaled.
+
+import time
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+class NormalEquations():
+    '''
+    Sample count, mean and co-moment matrix of Z = [X, y] (features and outputs) of one set of samples.
+    '''
+    def __init__(self, no_features, no_outputs):
+        self.no_features = no_features
+        self.no_outputs = no_outputs
+        self.count = 0
+        self.mean = np.zeros(no_features + no_outputs)
+        self.comoment = np.zeros((no_features + no_outputs, no_features + no_outputs))
+
+    def update(self, X, y):
+        '''
+            Adds the samples X (samples, no_features) and y (samples, no_outputs) or (samples,)
+        '''
+        Z = np.concatenate((np.asarray(X, dtype=np.float64).reshape(len(X), -1),
+                            np.asarray(y, dtype=np.float64).reshape(len(y), -1)), axis=1)
+        if Z.shape[0] == 0:
+            return
+        other = NormalEquations(self.no_features, self.no_outputs)
+        other.count = Z.shape[0]
+        other.mean = np.mean(Z, axis=0)
+        Z -= other.mean
+        other.comoment = Z.T @ Z
+        self.merge(other)
+
+    def merge(self, other):
+        if other.count == 0:
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.comoment = self.comoment + other.comoment + np.outer(delta, delta)*(self.count*other.count/count)
+        self.mean = self.mean + delta*(other.count/count)
+        self.count = count
+
+    def copy(self):
+        other = NormalEquations(self.no_features, self.no_outputs)
+        (other.count, other.mean, other.comoment) = (self.count, self.mean.copy(), self.comoment.copy())
+        return other
+
+    def solve(self, ridge=0, rcond=1e-10):
+        '''
+            Least squares coefficients (with intercept). Like LinearRegression, features that are constant
+            in this set of samples get the coefficient 0.
+
+            The normal equations are solved for the standardized features (i.e. with the correlation matrix) by a
+            Cholesky factorization. If that is (numerically) singular, we use the eigendecomposition and discard
+            eigenvalues below rcond times the largest one (the minimum-norm solution, as with lstsq).
+
+            ridge: Optional L2-penalty on the standardized coefficients
+
+            Returns: coef (no_outputs, no_features), intercept (no_outputs,)
+        '''
+        F = self.no_features
+        Sxx = self.comoment[:F, :F]
+        Sxy = self.comoment[:F, F:]
+        std = np.sqrt(np.maximum(np.diag(Sxx), 0))
+        varying = std > 1e-12*max(np.max(std), 1e-300)
+        scale = np.where(varying, std, 1)
+
+        A = (Sxx/np.outer(scale, scale))[varying][:, varying] + ridge*np.eye(np.sum(varying))
+        b = (Sxy/scale[:, None])[varying]
+        try:
+            L = np.linalg.cholesky(A)
+            if np.min(np.diag(L))**2 < rcond*np.max(np.diag(A)):
+                raise np.linalg.LinAlgError('Ill-conditioned')
+            beta = np.linalg.solve(L.T, np.linalg.solve(L, b))
+        except np.linalg.LinAlgError:
+            eigenvalues, eigenvectors = np.linalg.eigh(A)
+            keep = eigenvalues > rcond*np.max(eigenvalues)
+            beta = eigenvectors[:, keep] @ ((eigenvectors[:, keep].T @ b)/eigenvalues[keep][:, None])
+
+        coef = np.zeros((F, self.no_outputs))
+        coef[varying] = beta/scale[varying][:, None]
+        intercept = self.mean[F:] - self.mean[:F] @ coef
+        return coef.T, intercept
+
+    def mse(self, coef, intercept):
+        '''
+            Mean squared error of the linear model (coef, intercept) on these samples, per output
+        '''
+        if self.count == 0:
+            return np.full(self.no_outputs, np.nan)
+        F = self.no_features
+        # Residual r = y - X coef^T - intercept = (y - mean_y) - (X - mean_x) coef^T + bias
+        bias = self.mean[F:] - self.mean[:F] @ coef.T - intercept
+        W = np.concatenate((-coef.T, np.eye(self.no_outputs)), axis=0)
+        sum_sq = np.einsum('io,ij,jo->o', W, self.comoment, W)
+        return np.maximum(sum_sq, 0)/self.count + bias**2
+
+def qubicc_blocks(samples_total):
+    '''
+        The QUBICC data is split into six (temporally) contiguous blocks of samples_total//6 samples. The
+        remaining samples_total%6 samples form a seventh block, which always belongs to the training set.
+
+        Returns: Function of the sample indices that returns their block
+    '''
+    if samples_total < 6:
+        raise ValueError('The QUBICC data has %d samples, fewer than the six blocks'%samples_total)
+    block_size = samples_total//6
+    return lambda indices: np.minimum(indices//block_size, 6)
+
+# Validation blocks of the three QUBICC folds (see e.g. the random forest notebooks). The rest is for training.
+QUBICC_FOLDS = [[0, 3], [1, 4], [2, 5]]
+
+def _accumulate_chunk(input_data, output_data, start, stop, no_groups, no_blocks, groups, blocks):
+    X = np.asarray(input_data[start:stop], dtype=np.float64)
+    y = np.asarray(output_data[start:stop], dtype=np.float64).reshape(stop - start, -1)
+    if groups is None:
+        group = np.zeros(stop - start, dtype=np.int64)
+    elif callable(groups):
+        group = np.asarray(groups(X, start, stop))
+    else:
+        group = np.asarray(groups[start:stop])
+    block = np.zeros(stop - start, dtype=np.int64) if blocks is None else np.asarray(blocks(np.arange(start, stop)))
+
+    stats = {}
+    for b in range(no_blocks):
+        for g in range(no_groups):
+            stats[(b, g)] = NormalEquations(X.shape[1], y.shape[1])
+            samples = (block == b) & (group == g)
+            if np.all(samples):
+                stats[(b, g)].update(X, y)
+            elif np.any(samples):
+                stats[(b, g)].update(X[samples], y[samples])
+    return stats
+
+def accumulate(input_data, output_data, groups=None, no_groups=1, blocks=None, no_blocks=1, chunk_size=2**16,
+               workers=4):
+    '''
+        One pass over the (memory-mapped) data.
+
+        input_data:  (samples, no_features). Also works with np.transpose of a memory-mapped (features, samples) array.
+        output_data: (samples, no_outputs) or (samples,)
+        groups:      Group of every sample in [0, no_groups): An array (e.g. memory-mapped) or a function
+                     groups(X, start, stop) of the chunk X = input_data[start:stop]. See layer_groups, land_sea_groups.
+        blocks:      Function of the sample indices that returns their block in [0, no_blocks), e.g. qubicc_blocks
+        workers:     Number of threads
+
+        Returns: Dictionary {(block, group): NormalEquations}
+    '''
+    t0 = time.time()
+    chunks = [(start, min(start + chunk_size, input_data.shape[0])) for start in range(0, input_data.shape[0], chunk_size)]
+    stats = None
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # map keeps the order of the chunks, so the result does not depend on the timing of the threads
+        for chunk_stats in executor.map(lambda chunk: _accumulate_chunk(input_data, output_data, chunk[0], chunk[1],
+                                                                        no_groups, no_blocks, groups, blocks), chunks):
+            if stats is None:
+                stats = chunk_stats
+            else:
+                for key in stats.keys():
+                    stats[key].merge(chunk_stats[key])
+    print('Accumulated %d samples in %.1fs'%(input_data.shape[0], time.time() - t0))
+    return stats
+
+def merge_blocks(stats, blocks, group=0):
+    '''
+        The merged statistics of the given blocks for one group
+    '''
+    merged = None
+    for b in blocks:
+        if merged is None:
+            merged = stats[(b, group)].copy()
+        else:
+            merged.merge(stats[(b, group)])
+    return merged
+
+def fit_folds(stats, folds=QUBICC_FOLDS, ridge=0):
+    '''
+        Fits one linear model per fold and group, with the training set of a fold being all blocks except its
+        validation blocks. E.g. with qubicc_blocks and QUBICC_FOLDS, all three QUBICC folds.
+        folds=[[]] fits a single model on all data.
+
+        Returns: List (per fold) of lists (per group) of dictionaries with coef, intercept, the training and the
+                 validation MSE (per output) and the number of samples
+    '''
+    all_blocks = sorted(set([b for (b, g) in stats.keys()]))
+    no_groups = len(set([g for (b, g) in stats.keys()]))
+    results = []
+    for valid_blocks in folds:
+        results.append([])
+        train_blocks = [b for b in all_blocks if b not in valid_blocks]
+        for g in range(no_groups):
+            train = merge_blocks(stats, train_blocks, g)
+            coef, intercept = train.solve(ridge)
+            result = {'coef': coef, 'intercept': intercept, 'train_mse': train.mse(coef, intercept),
+                      'train_samples': train.count}
+            if len(valid_blocks) > 0:
+                valid = merge_blocks(stats, valid_blocks, g)
+                result['valid_mse'] = valid.mse(coef, intercept)
+                result['valid_samples'] = valid.count
+            results[-1].append(result)
+    return results
+
+def overall_mse(group_results, key='valid'):
+    '''
+        MSE over all groups of one fold (weighted by their number of samples), averaged over the outputs like
+        sklearn's mean_squared_error
+    '''
+    counts = np.array([result['%s_samples'%key] for result in group_results])
+    mses = np.array([np.mean(result['%s_mse'%key]) if result['%s_samples'%key] > 0 else 0 for result in group_results])
+    return np.sum(counts*mses)/np.sum(counts)
+
+def predict(group_results, X, group=None):
+    '''
+        Predictions of the linear model(s) of one fold for X. group: Group of every sample (if there are groups).
+    '''
+    X = np.asarray(X, dtype=np.float64)
+    if group is None:
+        return X @ group_results[0]['coef'].T + group_results[0]['intercept']
+    y = np.zeros((X.shape[0], group_results[0]['coef'].shape[0]))
+    for g, result in enumerate(group_results):
+        y[group == g] = X[group == g] @ result['coef'].T + result['intercept']
+    return y
+
+def land_sea_groups(fr_land_column, threshold=0.5):
+    '''
+        Groups for accumulate: 0 over sea, 1 over land (land fraction in the given input column > threshold).
+        Works with unscaled data; for scaled data, pass the threshold in the scaled units.
+    '''
+    return lambda X, start, stop: (X[:, fr_land_column] > threshold).astype(np.int64)
+
+def layer_groups(no_layers, samples_per_layer=None):
+    '''
+        Groups for accumulate: The vertical layer of every sample, if the samples are ordered by layer
+        (first all samples of the first layer, ...) with samples_per_layer samples per layer.
+        Without samples_per_layer, the layers are assumed to cycle fastest (sample i is on layer i%no_layers).
+    '''
+    if samples_per_layer is None:
+        return lambda X, start, stop: np.arange(start, stop)%no_layers
+    return lambda X, start, stop: np.minimum(np.arange(start, stop)//samples_per_layer, no_layers - 1)
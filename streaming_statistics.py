@@ -0,0 +1,397 @@
+## One-pass statistics (histograms, quantiles, min/max, NaN/inf counts) of many variables at once ##
+# Instead of loading entire variables and calling plt.hist on billions of values, we accumulate the statistics
+# chunk by chunk (from load_data output, (memory-mapped) feature arrays or directly from the NetCDF files in parallel).
+# Statistics of different chunks/files can be merged. The result is stored in a small npz-file, from which the
+# density functions can be plotted without touching the raw data again.
+
+import glob
+import numpy as np
+import xarray as xr
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from compact_netcdf import cell_values
+
+# (lower bound, upper bound) of the fixed bins per variable. Values outside are counted in underflow/overflow.
+DEFAULT_RANGES = {'qv': (0, 0.03), 'hus': (0, 0.03), 'qc': (0, 0.003), 'clw': (0, 0.003), 'qclw_phy': (0, 0.003),
+                  'qi': (0, 0.001), 'cli': (0, 0.001), 'temp': (150, 350), 'ta': (150, 350),
+                  'pres': (0, 110000), 'pfull': (0, 110000), 'pres_sfc': (40000, 110000), 'rho': (0, 1.5),
+                  'u': (-100, 100), 'v': (-100, 100), 'ua': (-100, 100), 'va': (-100, 100), 'zg': (0, 30000),
+                  'coriolis': (-1.5e-4, 1.5e-4), 'fr_land': (0, 1), 'fr_lake': (0, 1), 'fr_seaice': (0, 1),
+                  'clc': (0, 100), 'cl': (0, 100), 'cl_area': (0, 100), 'rh': (0, 1.5), 'dT': (-150, 50),
+                  'lts': (-20, 60), 'eis': (-40, 40)}
+# The log-bins cover 10^LOG_RANGE[0] to 10^LOG_RANGE[1] (only for positive values)
+LOG_RANGE = (-15, 6)
+
+class VariableStatistics():
+    '''
+    Mergeable one-pass statistics of a single variable:
+    - count, nan_count, inf_count, min, max, sum, sum of squares (-> mean, std)
+      (NaNs and +-inf are counted separately and excluded from all other statistics)
+    - Histogram with fixed (linear) bins and with logarithmic bins (for the positive values)
+    - A quantile sketch with relative accuracy alpha (DDSketch: logarithmically spaced buckets that are
+      created on demand). Merging two sketches only means adding the bucket counts.
+    '''
+    def __init__(self, value_range=None, bins=200, log_range=LOG_RANGE, log_bins_per_decade=10, alpha=0.005):
+        '''
+            value_range: (lower, upper) bound of the fixed bins. If None, no fixed-bin histogram is accumulated.
+        '''
+        self.value_range = None if value_range is None else (float(value_range[0]), float(value_range[1]))
+        self.bins = bins
+        self.log_range = log_range
+        self.log_bins = log_bins_per_decade*(log_range[1] - log_range[0])
+        self.alpha = alpha
+        self.log_gamma = np.log((1 + alpha)/(1 - alpha))
+
+        self.count = 0
+        self.nan_count = 0
+        self.inf_count = 0
+        self.min = np.inf
+        self.max = -np.inf
+        self.sum = 0.
+        self.sum_sq = 0.
+        # [underflow, bins..., overflow]
+        self.hist = None if value_range is None else np.zeros(bins + 2, dtype=np.int64)
+        # [non-positive, bins..., overflow]
+        self.log_hist = np.zeros(self.log_bins + 2, dtype=np.int64)
+        # Sketch: sorted bucket indices and their counts for positive/negative values, plus the zeros
+        self.zero_count = 0
+        self.pos_keys = np.zeros(0, dtype=np.int64)
+        self.pos_counts = np.zeros(0, dtype=np.int64)
+        self.neg_keys = np.zeros(0, dtype=np.int64)
+        self.neg_counts = np.zeros(0, dtype=np.int64)
+
+    @staticmethod
+    def _add_buckets(keys, counts, new_keys, new_counts):
+        keys, inverse = np.unique(np.concatenate((keys, new_keys)), return_inverse=True)
+        merged = np.zeros(len(keys), dtype=np.int64)
+        np.add.at(merged, inverse, np.concatenate((counts, new_counts)))
+        return keys, merged
+
+    def _bucket_keys(self, x):
+        return np.ceil(np.log(x)/self.log_gamma).astype(np.int64)
+
+    def update(self, values):
+        '''
+            Adds an array of values (of any shape) to the statistics.
+        '''
+        values = np.asarray(values).reshape(-1)
+        finite = np.isfinite(values)
+        self.nan_count += int(np.count_nonzero(np.isnan(values)))
+        self.inf_count += int(np.count_nonzero(np.isinf(values)))
+        if not np.all(finite):
+            values = values[finite]
+        if values.size == 0:
+            return
+        # float64 accumulators (the data itself can stay float32)
+        self.count += values.size
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+        self.sum += float(np.sum(values, dtype=np.float64))
+        self.sum_sq += float(np.dot(values.astype(np.float64), values.astype(np.float64)))
+
+        if self.hist is not None:
+            lo, hi = self.value_range
+            # The uniform-range histogram is much faster than searching in an array of bin edges
+            self.hist[1:-1] += np.histogram(values, bins=self.bins, range=(lo, hi))[0]
+            self.hist[0] += np.count_nonzero(values < lo)
+            self.hist[-1] += np.count_nonzero(values > hi)
+
+        positive = values[values > 0]
+        negative = -values[values < 0]
+        self.zero_count += values.size - positive.size - negative.size
+
+        log_values = np.log10(positive)
+        self.log_hist[0] += values.size - positive.size
+        self.log_hist[1:-1] += np.histogram(log_values, bins=self.log_bins, range=self.log_range)[0]
+        self.log_hist[-1] += np.count_nonzero(log_values > self.log_range[1])
+        # Positive values below 10^log_range[0] are counted with the non-positive ones
+        self.log_hist[0] += np.count_nonzero(log_values < self.log_range[0])
+
+        for (x, sign) in [(positive, 'pos'), (negative, 'neg')]:
+            if x.size > 0:
+                new_keys, new_counts = np.unique(self._bucket_keys(x), return_counts=True)
+                keys, counts = self._add_buckets(getattr(self, sign + '_keys'), getattr(self, sign + '_counts'),
+                                                 new_keys, new_counts)
+                setattr(self, sign + '_keys', keys)
+                setattr(self, sign + '_counts', counts)
+
+    def merge(self, other):
+        '''
+            Adds the statistics of other (which needs to have the same bins and alpha) to self.
+        '''
+        assert self.value_range == other.value_range and self.bins == other.bins
+        assert self.log_range == other.log_range and self.log_bins == other.log_bins and self.alpha == other.alpha
+        self.count += other.count
+        self.nan_count += other.nan_count
+        self.inf_count += other.inf_count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.sum += other.sum
+        self.sum_sq += other.sum_sq
+        if self.hist is not None:
+            self.hist += other.hist
+        self.log_hist += other.log_hist
+        self.zero_count += other.zero_count
+        self.pos_keys, self.pos_counts = self._add_buckets(self.pos_keys, self.pos_counts, other.pos_keys, other.pos_counts)
+        self.neg_keys, self.neg_counts = self._add_buckets(self.neg_keys, self.neg_counts, other.neg_keys, other.neg_counts)
+        return self
+
+    @property
+    def mean(self):
+        return self.sum/self.count
+
+    @property
+    def std(self):
+        return np.sqrt(max(self.sum_sq/self.count - self.mean**2, 0))
+
+    def quantile(self, q):
+        '''
+            Quantiles q (float or array in [0,1]) with a relative error of at most alpha.
+        '''
+        q = np.asarray(q, dtype=np.float64)
+        gamma = np.exp(self.log_gamma)
+        # All buckets in increasing order of their values: negative ones (reversed), zero, positive ones
+        values = np.concatenate((-2*gamma**self.neg_keys[::-1]/(gamma + 1), [0.],
+                                 2*gamma**self.pos_keys/(gamma + 1)))
+        counts = np.concatenate((self.neg_counts[::-1], [self.zero_count], self.pos_counts))
+        ranks = q*(self.count - 1)
+        ind = np.searchsorted(np.cumsum(counts), ranks, side='right')
+        # The extreme quantiles are known exactly
+        return np.clip(values[np.minimum(ind, len(values) - 1)], self.min, self.max)
+
+    def density(self, kind='fixed'):
+        '''
+            Returns the bin edges and the density (normalized by all finite values, incl. those outside of the bins).
+            kind: 'fixed' (linear bins) or 'log' (log10-bins of the positive values, density w.r.t. log10(x))
+        '''
+        if kind == 'fixed':
+            edges = np.linspace(self.value_range[0], self.value_range[1], self.bins + 1)
+            counts = self.hist[1:-1]
+        else:
+            edges = np.linspace(self.log_range[0], self.log_range[1], self.log_bins + 1)
+            counts = self.log_hist[1:-1]
+        return edges, counts/(self.count*np.diff(edges))
+
+    def to_arrays(self):
+        arrays = {'scalars': np.array([self.count, self.nan_count, self.zero_count, self.min, self.max, self.sum,
+                                       self.sum_sq, self.bins, self.log_range[0], self.log_range[1], self.log_bins,
+                                       self.alpha, self.inf_count], dtype=np.float64),
+                  'log_hist': self.log_hist, 'pos_keys': self.pos_keys, 'pos_counts': self.pos_counts,
+                  'neg_keys': self.neg_keys, 'neg_counts': self.neg_counts}
+        if self.hist is not None:
+            arrays['value_range'] = np.array(self.value_range)
+            arrays['hist'] = self.hist
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        s = arrays['scalars']
+        log_range = (int(s[8]), int(s[9]))
+        stats = cls(tuple(arrays['value_range']) if 'value_range' in arrays else None, bins=int(s[7]),
+                    log_range=log_range, log_bins_per_decade=int(s[10])//(log_range[1] - log_range[0]), alpha=s[11])
+        (stats.count, stats.nan_count, stats.zero_count) = (int(s[0]), int(s[1]), int(s[2]))
+        (stats.min, stats.max, stats.sum, stats.sum_sq) = (s[3], s[4], s[5], s[6])
+        stats.inf_count = int(s[12])
+        stats.log_hist = np.array(arrays['log_hist'])
+        if 'hist' in arrays:
+            stats.hist = np.array(arrays['hist'])
+        for key in ['pos_keys', 'pos_counts', 'neg_keys', 'neg_counts']:
+            setattr(stats, key, np.array(arrays[key]))
+        return stats
+
+class StreamingStatistics():
+    '''
+    VariableStatistics for every variable of a data set.
+    '''
+    def __init__(self, ranges=None, **kwargs):
+        '''
+            ranges: Dictionary of (lower, upper) bounds for the fixed bins. Default: DEFAULT_RANGES
+            kwargs: Passed to VariableStatistics (bins, log_range, log_bins_per_decade, alpha)
+        '''
+        self.ranges = dict(DEFAULT_RANGES)
+        if ranges is not None:
+            self.ranges.update(ranges)
+        self.kwargs = kwargs
+        self.variables = {}
+
+    def __getitem__(self, name):
+        return self.variables[name]
+
+    def keys(self):
+        return self.variables.keys()
+
+    def update(self, name, values):
+        if name not in self.variables:
+            self.variables[name] = VariableStatistics(self.ranges.get(name), **self.kwargs)
+        self.variables[name].update(values)
+
+    def update_dict(self, data_dict):
+        for name in data_dict.keys():
+            self.update(name, data_dict[name])
+
+    def merge(self, other):
+        for name in other.variables.keys():
+            if name in self.variables:
+                self.variables[name].merge(other.variables[name])
+            else:
+                self.variables[name] = other.variables[name]
+        return self
+
+    def save(self, file_name):
+        arrays = {}
+        for name in self.variables.keys():
+            for key, array in self.variables[name].to_arrays().items():
+                arrays['%s/%s'%(name, key)] = array
+        np.savez_compressed(file_name, **arrays)
+
+    @classmethod
+    def load(cls, file_name):
+        stats = cls()
+        with np.load(file_name) as file:
+            names = sorted(set([key.split('/')[0] for key in file.files]))
+            for name in names:
+                arrays = {key.split('/')[1]: file[key] for key in file.files if key.split('/')[0] == name}
+                stats.variables[name] = VariableStatistics.from_arrays(arrays)
+        return stats
+
+    def summary(self):
+        for name in self.variables.keys():
+            s = self.variables[name]
+            print('%s: %d values (%d NaNs, %d inf), min %.4g, max %.4g, mean %.4g, std %.4g, median %.4g'%
+                  (name, s.count, s.nan_count, s.inf_count, s.min, s.max, s.mean, s.std, s.quantile(0.5)))
+
+def statistics_from_dict(data_dict, derived=None, time_chunk=36, layers=None, stats=None):
+    '''
+        Statistics of the output of load_data, computed over chunks of time steps.
+
+        derived:    Dictionary of additional variables computed per chunk: name -> function(chunk_dict) -> array
+                    (e.g. relative humidity).
+        time_chunk: Number of time steps per chunk (for variables with a time dimension)
+        layers:     If provided, only these vertical layers of the 3D variables are considered (e.g. range(4, 31))
+    '''
+    if stats is None:
+        stats = StreamingStatistics()
+    no_time_steps = max([data_dict[key].shape[0] for key in data_dict.keys() if data_dict[key].ndim == 3] + [1])
+    for t0 in range(0, no_time_steps, time_chunk):
+        chunk = {}
+        for key in data_dict.keys():
+            values = data_dict[key]
+            if values.ndim == 3:
+                values = values[t0:t0+time_chunk]
+                if layers is not None:
+                    values = values[:, layers]
+            elif values.ndim == 2 and values.shape[0] == no_time_steps:
+                # (time, cells), e.g. fr_seaice
+                values = values[t0:t0+time_chunk]
+            elif t0 > 0:
+                # Time-invariant fields (zg, coriolis, fr_land, ...) are only counted once
+                continue
+            chunk[key] = values
+        stats.update_dict(chunk)
+        if derived is not None:
+            for name in derived.keys():
+                stats.update(name, derived[name](chunk))
+    return stats
+
+def statistics_from_array(data, names, chunk_size=2**20, stats=None):
+    '''
+        Statistics of the columns of a (memory-mapped) (samples, features) array, e.g. cloud_cover_input_qubicc.npy.
+        data can also be a ConcatenatedDataset.
+    '''
+    if stats is None:
+        stats = StreamingStatistics()
+    assert len(names) == data.shape[1]
+    for start in range(0, data.shape[0], chunk_size):
+        chunk = np.asarray(data[start:start+chunk_size])
+        for j, name in enumerate(names):
+            stats.update(name, chunk[:, j])
+    return stats
+
+def _file_statistics(file_name, name, nc_name, layers, not_nan, ranges, kwargs):
+    # Statistics of one variable in one NetCDF file (runs in a worker process)
+    stats = StreamingStatistics(ranges, **kwargs)
+    DS = xr.open_dataset(file_name)
+    values = cell_values(DS, nc_name)
+    DS.close()
+    if layers is not None:
+        values = values[:, layers]
+    if not_nan is not None:
+        values = values[..., not_nan]
+    stats.update(name, values)
+    return stats
+
+def statistics_from_files(variables, layers=None, not_nan=None, workers=None, ranges=None, **kwargs):
+    '''
+        Statistics of variables directly from the NetCDF files, one (file, variable) per task in a process pool.
+
+        variables: Dictionary name -> (file or glob pattern, name of the variable in the NetCDF file),
+                   e.g. from files_for_statistics
+        layers:    If provided, only these vertical layers are considered (the files have (time, height, cells))
+        not_nan:   Boolean mask of the horizontal cells to keep (see load_data)
+    '''
+    stats = StreamingStatistics(ranges, **kwargs)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        for name in variables.keys():
+            pattern, nc_name = variables[name]
+            file_names = sorted(glob.glob(pattern))
+            if len(file_names) == 0:
+                raise FileNotFoundError('No files match %s'%pattern)
+            for file_name in file_names:
+                futures.append(executor.submit(_file_statistics, file_name, name, nc_name, layers, not_nan,
+                                               ranges, kwargs))
+        for future in as_completed(futures):
+            stats.merge(future.result())
+    return stats
+
+def files_for_statistics(source, days, resolution='R02B04', order_of_vars=None):
+    '''
+        The hourly 3D variables of load_data as input for statistics_from_files.
+        Returns the variables dictionary and the not_nan mask of the horizontal cells.
+    '''
+    from my_classes import get_data_files
+    files = get_data_files(source, days, True, resolution, order_of_vars)
+
+    # The variable names in the NetCDF files (see load_data)
+    if source == 'narval':
+        hourly_vars = ['qv', 'qc', 'qi', 'temp', 'pres', 'rho', 'u', 'v', 'clc', 'cl_area']
+        nc_names = {'cl_area': 'clc'}
+        not_nan = ~np.isnan(cell_values(xr.open_dataset(files['not_nan']), 'clc')[0, -1, :])
+    else:
+        hourly_vars = ['hus', 'clw', 'cli', 'ta', 'pfull', 'rho', 'ua', 'va', 'cl', 'cl_area']
+        nc_names = {'clw': 'qclw_phy', 'cl_area': 'cl'}
+        not_nan = ~np.isnan(cell_values(xr.open_dataset(files['not_nan']), 'cl')[0, 30, :])
+
+    variables = {}
+    for name in hourly_vars:
+        if name in files and (order_of_vars is None or name in order_of_vars):
+            variables[name] = (files[name], nc_names.get(name, name))
+    return variables, not_nan
+
+def plot_density(stats_list, name, labels=None, kind='fixed', ax=None, **plot_kwargs):
+    '''
+        Plots the density function of the variable name for every StreamingStatistics in stats_list
+    '''
+    import matplotlib.pyplot as plt
+    if ax is None:
+        ax = plt.gca()
+    for k, stats in enumerate(stats_list):
+        edges, density = stats[name].density(kind)
+        label = None if labels is None else labels[k]
+        ax.stairs(density, edges, label=label, **plot_kwargs)
+    if kind == 'log':
+        ax.set_xlabel('log10(%s)'%name)
+    else:
+        ax.set_xlabel(name)
+    if labels is not None:
+        ax.legend()
+    return ax
+
+def extrap_measure(stats_x, stats_y):
+    '''
+        Counterpart of extrap_measure in density_functions/narval_and_qubicc.ipynb based on the statistics.
+        The lower the extrap_measure (non-negative number), the less extrapolation is necessary from x to y.
+    '''
+    max_gen = (stats_x.max - stats_y.mean)/stats_y.std - (stats_y.max - stats_y.mean)/stats_y.std
+    min_gen = (stats_y.min - stats_y.mean)/stats_y.std - (stats_x.min - stats_y.mean)/stats_y.std
+    return np.maximum(0, max_gen) + np.maximum(0, min_gen)
@@ -0,0 +1,254 @@
+## Synthetic NARVAL/QUBICC data in the directory layout that load_data and the coarse-graining scripts expect ##
+# Writes a small, but realistic data tree below root. Use it with export ICONML_DATA_ROOT=root (see data_paths.py).
+# - Horizontal grid: As many cells as the ICON grid (R02B04: 20480, R02B05: 81920), evenly spread over the sphere
+#   (a Fibonacci lattice instead of the icosahedral triangles, the order of the cells does not matter to us)
+# - NARVAL only covers the tropical Atlantic: All other cells are NaN, so that only ~5.5% of the cells remain (about
+#   1131 cells on R02B04). In QUBICC the surface-nearest layer is NaN above high mountains.
+# - 31 vertical layers (zg and the half levels zghalf) following the orography, with roughly the heights of the capped
+#   ICON-A grid: The top at ~27.6km, the lowest 27 layers below 21km
+# - Hourly 3D variables of a plausible tropical/global atmosphere with the variable names and file name patterns of
+#   get_data_files (NARVAL: qv, qc, qi, temp, pres, rho, u, v, clc, cl_area, QUBICC: hus, clw (qclw_phy), cli, ta,
+#   pfull, rho, ua, va, cl, cl_area). Days: NARVAL 2013120100 (dec_1st), 2013123100 and 2016080100, QUBICC 20041102
+#   (nov_2nd), 20041107 and 20041120. The files of every day end with the hour load_data takes the not_nan mask from.
+# - The time-invariant fields: zg, Coriolis (grid file with lat_cell_centre), fr_lake, fr_land (and fr_seaice)
+# - NARVAL input of the coarse-graining scripts: 75 high-res layers with their half levels (z_ifc) for
+#   vert_interp_variability.py, and clc with the overlap weights for cloud_area_fraction_narval.py. These use the
+#   same horizontal grid as the rest instead of the native R02B10 grid.
+#
+# Usage: python synthetic_data.py /tmp/iconml_synthetic --resolution R02B04 --hours 6
+
+import os
+import argparse
+import numpy as np
+import xarray as xr
+
+from compact_netcdf import write_cell_data
+from coarse_graining import overlap_weights
+
+CELLS = {'R02B04': 20480, 'R02B05': 81920}
+VERT_LAYERS = 31
+VERT_LAYERS_HR = 75
+TOP = 27600
+
+NARVAL_DAYS = ['2013120100', '2013123100', '2016080100']
+QUBICC_DAYS = ['20041102', '20041107', '20041120']
+NARVAL_VARS = ['qv', 'qc', 'qi', 'temp', 'pres', 'rho', 'u', 'v', 'clc', 'cl_area']
+# Folder name -> variable name in the file
+QUBICC_VARS = {'hus': 'hus', 'clw': 'qclw_phy', 'cli': 'cli', 'ta': 'ta', 'pfull': 'pfull', 'rho': 'rho', 'ua': 'ua',
+               'va': 'va', 'cl': 'cl', 'cl_area': 'cl'}
+# Names of the NARVAL variables in QUBICC
+TO_QUBICC = {'qv': 'hus', 'qc': 'clw', 'qi': 'cli', 'temp': 'ta', 'pres': 'pfull', 'rho': 'rho', 'u': 'ua', 'v': 'va',
+             'clc': 'cl', 'cl_area': 'cl_area'}
+
+def icon_like_grid(no_cells):
+    '''
+        Latitudes and longitudes (in radians) of no_cells evenly spread cell centers
+    '''
+    i = np.arange(no_cells) + 0.5
+    lat = np.arcsin(1 - 2*i/no_cells)
+    lon = np.mod(i*np.pi*(3 - np.sqrt(5)), 2*np.pi) - np.pi
+    return lat, lon
+
+def _smooth_field(lat, lon, rng, waves=6):
+    # A random, smooth field on the sphere in [0, 1]
+    field = np.zeros(len(lat))
+    for k in range(waves):
+        (m, n, phase) = (rng.integers(1, 6), rng.integers(1, 6), rng.uniform(0, 2*np.pi))
+        field += np.cos(m*lon + phase)*np.cos(n*lat)**2/(k + 1)
+    return (field - field.min())/(field.max() - field.min())
+
+def surface(lat, lon, seed=0):
+    '''
+        fr_land, fr_lake, fr_seaice and the orography [m] of every cell
+    '''
+    rng = np.random.default_rng(seed)
+    land = _smooth_field(lat, lon, rng)
+    fr_land = np.clip((land - 0.62)*12, 0, 1)
+    fr_lake = np.where((fr_land > 0.5) & (rng.random(len(lat)) < 0.05), rng.uniform(0, 0.3, len(lat)), 0)
+    fr_seaice = ((np.abs(lat) > np.radians(65)) & (fr_land < 0.5)).astype(np.float64)
+    orography = fr_land*4500*_smooth_field(lat, lon, rng)**2
+    return fr_land, fr_lake, fr_seaice, orography
+
+def half_levels(orography, layers, top=TOP):
+    '''
+        Heights of the layers+1 half levels (from top to bottom) of a terrain-following grid, denser near the surface
+    '''
+    eta = (np.arange(layers + 1)/layers)[:, None]
+    return top - (top - orography[None, :])*(1 - (1 - eta)**1.8)
+
+def atmosphere(z, lat, hour, rng, source='narval'):
+    '''
+        Plausible 3D fields on the heights z (layers, cells) with the NARVAL names. clc and cl_area in % (NARVAL) or
+        as fraction (QUBICC).
+    '''
+    (lat, cells) = (lat[None, :], z.shape[1])
+    diurnal = np.sin(2*np.pi*hour/24)
+    temp = np.maximum(300 - 25*np.sin(lat)**2 + 2*diurnal - 0.0065*z, 195 + 0*z)
+    pres = 101325*np.exp(-z/8000)
+    rho = pres/(287.05*temp)
+    rh = np.clip(0.9*np.exp(-z/9000) + 0.25*rng.standard_normal(z.shape).astype(np.float32), 0, 1.05)
+    qsat = 0.622*611.2*np.exp(17.67*(temp - 273.15)/(temp - 29.65))/pres
+    qv = rh*qsat
+    clc = np.where(rh > 0.85, np.sqrt(np.clip((rh - 0.85)/0.2, 0, 1)), 0)
+    condensate = clc*np.exp(-z/6000)*rng.random(z.shape)
+    qc = np.where(temp > 253, 2e-4*condensate, 0)
+    qi = np.where(temp < 268, 5e-5*condensate, 0)
+    cl_area = np.minimum(clc*(1 + 0.3*rng.random(z.shape)), 1)
+    u = 10*np.cos(2*lat) + 0.003*z*np.sin(lat) + 3*rng.standard_normal(z.shape)
+    v = 3*rng.standard_normal((z.shape[0], cells))
+    fields = {'qv': qv, 'qc': qc, 'qi': qi, 'temp': temp, 'pres': pres, 'rho': rho, 'u': u, 'v': v,
+              'clc': clc, 'cl_area': cl_area}
+    if source == 'narval':
+        fields['clc'] = 100*clc
+        fields['cl_area'] = 100*cl_area
+    return fields
+
+def _file_hours(hours, last):
+    # The hours of a day (file numbers), ending with last, so that the file that load_data takes not_nan from exists
+    return list(range(max(last + 1 - hours, 0), max(last + 1, hours)))
+
+def _write(values, name, file_name, times, heights, not_nan, lat=None, lon=None):
+    os.makedirs(os.path.dirname(file_name), exist_ok=True)
+    cell_coords = None if lat is None else {'clon': lon, 'clat': lat}
+    write_cell_data(values, name, file_name, coords={'time': times, 'height': heights},
+                    dims=['time', 'height', 'cell'], not_nan=not_nan, cell_coords=cell_coords)
+
+def _write_2d(values, name, file_name, dims=('cell',)):
+    os.makedirs(os.path.dirname(file_name), exist_ok=True)
+    xr.DataArray(values, dims=list(dims), name=name).to_netcdf(file_name)
+
+def generate_narval(root, resolution='R02B04', hours=6, seed=0, coarse_graining=True):
+    lat, lon = icon_like_grid(CELLS[resolution])
+    fr_land, fr_lake, fr_seaice, orography = surface(lat, lon, seed)
+    # The NARVAL domain in the tropical Atlantic
+    region = (lat > np.radians(-10)) & (lat < np.radians(20)) & (lon > np.radians(-65)) & (lon < np.radians(15))
+    zghalf = half_levels(orography, VERT_LAYERS)
+    zg = (zghalf[:-1] + zghalf[1:])/2
+    heights = np.arange(1, VERT_LAYERS + 1)
+
+    base = os.path.join(root, 'my_work', 'NARVAL')
+    path = os.path.join(base, 'data_var_vertinterp' if resolution == 'R02B04' else 'data_var_vertinterp_R02B05')
+    grid_path = os.path.join(base, 'grid_extpar')
+    grid_name = {'R02B04': 'icon_grid_0005_R02B04_G.nc', 'R02B05': 'icon_grid_0019_R02B05_G.nc'}[resolution]
+
+    ## Time-invariant fields
+    os.makedirs(grid_path, exist_ok=True)
+    xr.Dataset({'lat_cell_centre': ('cell', lat), 'lon_cell_centre': ('cell', lon)}).to_netcdf(os.path.join(grid_path, grid_name))
+    _write_2d(fr_lake, 'FR_LAKE', os.path.join(grid_path, 'fr_lake_%s_NARVAL_fg_DOM01.nc'%resolution))
+    _write_2d(fr_land, 'fr_land', os.path.join(grid_path, 'fr_land_%s_NARVAL_fg_DOM01.nc'%resolution))
+    _write_2d(np.where(region, zg, np.nan), 'zg', os.path.join(path, 'zg', 'zg_icon-a_capped.nc'), ('height', 'cell'))
+    _write_2d(np.where(region, zghalf, np.nan), 'zghalf', os.path.join(path, 'zg', 'zghalf_icon-a_capped.nc'),
+              ('height_2', 'cell'))
+
+    ## Hourly data
+    for day in NARVAL_DAYS:
+        experiment = 'NARVALI' if day.startswith('2013') else 'NARVALII'
+        rng = np.random.default_rng([seed, int(day)])
+        for hour in _file_hours(hours, 34):
+            time = [np.datetime64('%s-%s-%sT00'%(day[:4], day[4:6], day[6:8])) + np.timedelta64(hour, 'h')]
+            fields = atmosphere(zg, lat, hour, rng)
+            for var in NARVAL_VARS:
+                file_type = 'cloud' if var in ['clc', 'cl_area'] else 'fg'
+                file_name = os.path.join(path, var, 'int_var_%s_%s_%s_%s_%s_DOM01_%04d.nc'%(var, resolution, experiment,
+                                                                                           day, file_type, hour))
+                name = 'clc' if var == 'cl_area' else var
+                _write(fields[var][None, :, region], name, file_name, time, heights, region)
+
+    if coarse_graining:
+        generate_coarse_graining_input(root, resolution, lat, lon, orography, region, zghalf, hours, seed)
+
+def generate_coarse_graining_input(root, resolution, lat, lon, orography, region, zghalf, hours, seed):
+    '''
+        The input of vert_interp_variability.py (NARVAL, R02B05) and cloud_area_fraction_narval.py
+    '''
+    base = os.path.join(root, 'my_work', 'NARVAL')
+    z_ifc = half_levels(orography, VERT_LAYERS_HR)
+    z_hr = (z_ifc[:-1] + z_ifc[1:])/2
+    _write_2d(zghalf, 'zghalf', os.path.join(base, 'grid_extpar', 'zghalf_icon-a_capped_%s.nc'%resolution),
+              ('height_2', 'cell'))
+    _write_2d(z_ifc, 'z_ifc', os.path.join(base, 'grid_extpar', 'z_ifc_%s_NARVAL_fg_DOM01_ML_capped.nc'%resolution),
+              ('height_2', 'cell'))
+    # For the cloud area fraction (in place of the R02B10 grid)
+    _write_2d(zghalf, 'zghalf', os.path.join(base, 'grid_extpar', 'zghalf_icon-a_capped_upsampled_R02B05.nc'),
+              ('height_2', 'cell'))
+    _write_2d(z_ifc, 'z_ifc', os.path.join(base, 'grid_extpar', 'z_ifc_R02B10_NARVAL_fg_DOM01_ML.nc'),
+              ('height_2', 'cell'))
+    np.save(os.path.join(base, 'grid_extpar', 'weights_NARVAL_R02B10_cloud_area_fraction.npy'),
+            overlap_weights(zghalf, z_ifc))
+    os.makedirs(os.path.join(base, 'data_R02B05', 'cl_area_frac'), exist_ok=True)
+
+    heights = np.arange(1, VERT_LAYERS_HR + 1)
+    day = NARVAL_DAYS[0]
+    rng = np.random.default_rng([seed, int(day), 1])
+    for hour in _file_hours(hours, 34):
+        time = [np.datetime64('%s-%s-%sT00'%(day[:4], day[4:6], day[6:8])) + np.timedelta64(hour, 'h')]
+        fields = atmosphere(z_hr, lat, hour, rng)
+        for var in ['qv', 'pres', 'rho', 'temp', 'u', 'v', 'clc', 'qi', 'qc']:
+            file_name = os.path.join(root, 'bd1179_work', 'narval', 'hcg_files', var,
+                                     '%s_%s_NARVALI_%s_fg_DOM01_%04d.nc'%(var, resolution, day, hour))
+            _write(np.where(region, fields[var], np.nan)[None], var, file_name, time, heights, None, lat, lon)
+            os.makedirs(os.path.join(root, 'bd1179_work', 'narval', 'hvcg_files', var), exist_ok=True)
+        # The first folder in orig_files is skipped by the script
+        for folder in ['0000000000', day]:
+            file_name = os.path.join(root, 'scratch', 'orig_files', folder, 'clc_R02B10_NARVALI_%s_cloud_DOM01_%04d.nc'%(day, hour))
+            _write(fields['clc'][None], 'clc', file_name, time, heights, None)
+
+def generate_qubicc(root, resolution='R02B04', hours=6, seed=0):
+    lat, lon = icon_like_grid(CELLS[resolution])
+    fr_land, fr_lake, fr_seaice, orography = surface(lat, lon, seed)
+    zghalf = half_levels(orography, VERT_LAYERS)
+    zg = (zghalf[:-1] + zghalf[1:])/2
+    heights = np.arange(1, VERT_LAYERS + 1)
+    # The coarse grid extends below the surface of the high-res grid above high mountains
+    below_surface = orography > 1500
+
+    base = os.path.join(root, 'my_work', 'QUBICC')
+    path = os.path.join(base, 'data_var_vertinterp' if resolution == 'R02B04' else 'data_var_vertinterp_R02B05')
+    grid_path = os.path.join(base, 'grids')
+    grid_name = {'R02B04': 'icon_grid_0013_R02B04_G.nc', 'R02B05': 'icon_grid_0019_R02B05_G.nc'}[resolution]
+
+    ## Time-invariant fields
+    os.makedirs(grid_path, exist_ok=True)
+    xr.Dataset({'lat_cell_centre': ('cell', lat), 'lon_cell_centre': ('cell', lon)}).to_netcdf(os.path.join(grid_path, grid_name))
+    _write_2d(zg, 'zg', os.path.join(grid_path, 'zg_icon-a_capped.nc' if resolution == 'R02B04' else
+                                     'zg_icon-a_capped_R02B05.nc'), ('height', 'cell'))
+    _write_2d(fr_lake, 'lake', os.path.join(path, 'fr_lake', 'fr_lake_%s.nc'%resolution))
+    _write_2d(fr_land, 'land', os.path.join(path, 'fr_land', 'fr_land_%s.nc'%resolution))
+    if resolution == 'R02B04':
+        _write_2d(fr_seaice[None], 'siconcbcs', os.path.join(path, 'fr_seaice', 'fr_seaice_%s.nc'%resolution),
+                  ('time', 'cell'))
+
+    ## Hourly data
+    for day in QUBICC_DAYS:
+        rng = np.random.default_rng([seed, int(day)])
+        for hour in _file_hours(hours, 10):
+            time = [np.datetime64('%s-%s-%sT00'%(day[:4], day[4:6], day[6:8])) + np.timedelta64(hour, 'h')]
+            fields = atmosphere(zg, lat, hour, rng, source='qubicc')
+            for var in NARVAL_VARS:
+                values = fields[var].copy()
+                values[-1, below_surface] = np.nan
+                folder = TO_QUBICC[var]
+                file_name = os.path.join(path, folder, 'int_var_hc2_02_p1m_%s_ml_%sT%02d0000Z_%s.nc'%(folder, day, hour,
+                                                                                                     resolution))
+                _write(values[None], QUBICC_VARS[folder], file_name, time, heights, None)
+
+def generate(root, sources=('narval', 'qubicc'), resolution='R02B04', hours=6, seed=0, coarse_graining=True):
+    '''
+        Writes the synthetic data tree of the given sources and resolution below root
+    '''
+    if 'narval' in sources:
+        generate_narval(root, resolution, hours, seed, coarse_graining)
+    if 'qubicc' in sources:
+        generate_qubicc(root, resolution, hours, seed)
+    return root
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write a synthetic NARVAL/QUBICC data tree (see ICONML_DATA_ROOT)')
+    parser.add_argument('root')
+    parser.add_argument('--resolution', default='R02B04', choices=list(CELLS.keys()))
+    parser.add_argument('--sources', nargs='+', default=['narval', 'qubicc'])
+    parser.add_argument('--hours', type=int, default=6, help='Hourly files per day')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no_coarse_graining', action='store_true', help='Skip the input of the coarse-graining scripts')
+    args = parser.parse_args()
+    generate(args.root, args.sources, args.resolution, args.hours, args.seed, not args.no_coarse_graining)
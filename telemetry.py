@@ -0,0 +1,227 @@
+## Lightweight profiling of the stages of a run (loading, coarse-graining, feature building, training, evaluation) ##
+# Off by default. Enable it with telemetry.enable() in a notebook/script or by setting the environment variable
+# ICONML_TRACE to a directory (e.g. in the batch script). Disabled, stage() returns a shared no-op object, so the
+# instrumentation costs one function call per stage.
+#
+# Per stage we record:
+# - wall time and CPU time (of the entire process, i.e. including the threads it started)
+# - peak RSS of the process at the end of the stage and by how much the stage raised it (rss_growth_mb). The
+#   stage with the largest rss_growth_mb is the one that sets the memory requirement of the job.
+# - bytes read/written by the process (rchar/wchar in /proc/self/io, Linux only, memory-mapped reads are not included)
+# - samples (set by the caller) and any additional information (file names, epochs, ...)
+# Stages can be nested. The name of a nested stage is prefixed by the names of its parents, e.g. load_data/qv.
+#
+# Every run (process) writes one JSON trace with its settings and all stages when it exits (or with flush()).
+# Summary of one or several traces: python telemetry.py trace_*.json
+
+import os
+import sys
+import json
+import time
+import atexit
+import socket
+import argparse
+import resource
+import functools
+import threading
+
+_trace = None
+_lock = threading.Lock()
+_local = threading.local()
+
+def enable(trace_file=None):
+    '''
+        Start recording. trace_file: Where to write the trace. Default: trace_<time>_<pid>.json in the directory
+        given by ICONML_TRACE (or in the current directory).
+    '''
+    global _trace
+    if trace_file is None:
+        trace_file = os.path.join(os.environ.get('ICONML_TRACE', '.'),
+                                  'trace_%s_%d.json'%(time.strftime('%Y%m%dT%H%M%S'), os.getpid()))
+    if _trace is None:
+        atexit.register(flush)
+    _trace = {'file': trace_file,
+              'meta': {'argv': sys.argv, 'host': socket.gethostname(), 'pid': os.getpid(),
+                       'start': time.strftime('%Y-%m-%d %H:%M:%S'), 'cpus': os.cpu_count()},
+              'stages': []}
+    return trace_file
+
+def disable():
+    global _trace
+    flush()
+    _trace = None
+
+def enabled():
+    return _trace is not None
+
+def flush():
+    '''
+        Writes the trace so far (into a temporary file first, so that the trace is never corrupt)
+    '''
+    if _trace is None:
+        return
+    with _lock:
+        content = json.dumps({'meta': _trace['meta'], 'stages': _trace['stages']}, indent=1)
+    os.makedirs(os.path.dirname(os.path.abspath(_trace['file'])), exist_ok=True)
+    with open(_trace['file'] + '.tmp', 'w') as file:
+        file.write(content)
+    os.replace(_trace['file'] + '.tmp', _trace['file'])
+
+def _io_bytes():
+    try:
+        with open('/proc/self/io') as file:
+            counters = dict(line.split(':') for line in file.read().splitlines())
+        return int(counters['rchar']), int(counters['wchar'])
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+def _peak_rss():
+    # In kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024
+
+def _json_value(value):
+    # NumPy scalars (e.g. a loss from keras) as Python numbers, everything else that JSON does not know as string
+    if hasattr(value, 'item') and getattr(value, 'size', 0) == 1:
+        value = value.item()
+    return value if isinstance(value, (int, float, str, bool, type(None))) else str(value)
+
+def _counters():
+    return (time.time(), time.process_time(), _peak_rss()) + _io_bytes()
+
+class Stage():
+    '''
+    One stage of a run. Use it as context manager (via stage) or with start() and stop() (e.g. in keras callbacks).
+    Set samples (or other information) while it runs: s.samples = 10**6 or s.info['file'] = input_file
+    '''
+    def __init__(self, name, samples=None, **info):
+        self.name = name
+        self.samples = samples
+        self.info = info
+
+    def start(self):
+        stack = getattr(_local, 'stack', None)
+        if stack is None:
+            stack = _local.stack = []
+        self.path = '/'.join([s.name for s in stack] + [self.name])
+        stack.append(self)
+        self.begin = _counters()
+        return self
+
+    def stop(self, samples=None, **info):
+        end = _counters()
+        if samples is not None:
+            self.samples = samples
+        self.info.update(info)
+        stack = _local.stack
+        if self in stack:
+            stack.remove(self)
+        record = {'stage': self.path, 'start': self.begin[0], 'wall_s': end[0] - self.begin[0],
+                  'cpu_s': end[1] - self.begin[1], 'peak_rss_mb': end[2]/2**20,
+                  'rss_growth_mb': (end[2] - self.begin[2])/2**20, 'read_mb': (end[3] - self.begin[3])/2**20,
+                  'written_mb': (end[4] - self.begin[4])/2**20}
+        if self.samples is not None:
+            record['samples'] = int(self.samples)
+        if len(self.info) > 0:
+            record['info'] = {key: _json_value(value) for key, value in self.info.items()}
+        if _trace is not None:
+            with _lock:
+                _trace['stages'].append(record)
+        return record
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.info['error'] = exc_type.__name__
+        self.stop()
+        return False
+
+class _NoStage():
+    # Returned by stage() while disabled. Ignores everything that is set.
+    @property
+    def info(self):
+        return {}
+    def start(self):
+        return self
+    def stop(self, samples=None, **info):
+        return None
+    def __enter__(self):
+        return self
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+    def __setattr__(self, key, value):
+        pass
+
+_NO_STAGE = _NoStage()
+
+def stage(name, samples=None, **info):
+    '''
+        with stage('load_data', days=days) as s:
+            ...
+            s.samples = len(output_data)
+    '''
+    if _trace is None:
+        return _NO_STAGE
+    return Stage(name, samples, **info)
+
+def profiled(name=None, samples=None):
+    '''
+        Decorator that records every call of the function as a stage.
+
+        name:    Name of the stage. Default: The name of the function.
+        samples: Function of the return value that gives the number of samples, e.g. lambda output: len(output)
+    '''
+    def decorator(function):
+        stage_name = function.__name__ if name is None else name
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if _trace is None:
+                return function(*args, **kwargs)
+            with Stage(stage_name) as s:
+                result = function(*args, **kwargs)
+                if samples is not None:
+                    s.samples = samples(result)
+            return result
+        return wrapper
+    return decorator
+
+def summarize(trace_files):
+    '''
+        Aggregates the stages of the traces by name: Number of calls, total wall/CPU time, max peak RSS, max RSS growth,
+        MB read/written and samples. Sorted by the total wall time.
+    '''
+    summary = {}
+    for trace_file in trace_files:
+        with open(trace_file) as file:
+            trace = json.load(file)
+        for record in trace['stages']:
+            s = summary.setdefault(record['stage'], {'calls': 0, 'wall_s': 0, 'cpu_s': 0, 'peak_rss_mb': 0,
+                                                     'rss_growth_mb': 0, 'read_mb': 0, 'written_mb': 0, 'samples': 0})
+            s['calls'] += 1
+            for key in ['wall_s', 'cpu_s', 'read_mb', 'written_mb']:
+                s[key] += record[key]
+            for key in ['peak_rss_mb', 'rss_growth_mb']:
+                s[key] = max(s[key], record[key])
+            s['samples'] += record.get('samples', 0)
+    return sorted(summary.items(), key=lambda item: -item[1]['wall_s'])
+
+def print_summary(trace_files):
+    rows = summarize(trace_files)
+    width = max([len('stage')] + [len(name) for name, s in rows])
+    print('%-*s %6s %10s %10s %10s %10s %10s %10s %12s'%(width, 'stage', 'calls', 'wall [s]', 'cpu [s]', 'peak [MB]',
+                                                           'growth', 'read [MB]', 'write [MB]', 'samples/s'))
+    for name, s in rows:
+        rate = '%12.0f'%(s['samples']/s['wall_s']) if s['samples'] > 0 and s['wall_s'] > 0 else '%12s'%'-'
+        print('%-*s %6d %10.1f %10.1f %10.0f %10.0f %10.1f %10.1f %s'%(width, name, s['calls'], s['wall_s'], s['cpu_s'],
+              s['peak_rss_mb'], s['rss_growth_mb'], s['read_mb'], s['written_mb'], rate))
+
+# Enabled for the entire run by the environment (e.g. in a batch script: export ICONML_TRACE=~/traces)
+if 'ICONML_TRACE' in os.environ and __name__ != '__main__':
+    enable()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Summary of the stages in one or several telemetry traces')
+    parser.add_argument('trace_files', nargs='+')
+    args = parser.parse_args()
+    print_summary(args.trace_files)